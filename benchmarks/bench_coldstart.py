@@ -0,0 +1,133 @@
+"""Measure the cold start of the handler: module import and time to the first scan request.
+
+Each sample runs in a fresh interpreter, so nothing is cached between
+them. Clients are real botocore clients whose requests are answered
+locally just before they would go on the wire, so the time to the
+DescribeRegions request covers session and client construction and
+request signing but no network.
+
+The lazy variant is the handler as it is; the eager variant reproduces
+the previous start-up, which imported boto3 with the module and built
+the EC2, RDS, EFS, Backup, S3 and SNS clients and called STS before
+scanning anything.
+
+Usage:
+    python benchmarks/bench_coldstart.py [--samples 10] [--json]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+# Canned responses of the calls made before the scan starts
+RESPONSES = {
+    'DescribeRegions': (b'<DescribeRegionsResponse xmlns="http://ec2.amazonaws.com/doc/2016-11-15/">'
+                        b'<regionInfo><item><regionName>us-east-1</regionName></item></regionInfo>'
+                        b'</DescribeRegionsResponse>'),
+    'GetCallerIdentity': (b'<GetCallerIdentityResponse xmlns="https://sts.amazonaws.com/doc/2011-06-15/">'
+                          b'<GetCallerIdentityResult><Account>123456789012</Account></GetCallerIdentityResult>'
+                          b'</GetCallerIdentityResponse>')
+}
+
+CHILD_ENV = {
+    'AWS_ACCESS_KEY_ID': 'AKIDBENCHMARK', 'AWS_SECRET_ACCESS_KEY': 'benchmark',
+    'AWS_REGION': 'us-east-1', 'AWS_DEFAULT_REGION': 'us-east-1', 'AWS_EC2_METADATA_DISABLED': 'true',
+    'S3_BUCKET_NAME': 'benchmark-bucket', 'SNS_TOPIC_ARN': 'arn:aws:sns:us-east-1:123456789012:benchmark'
+}
+
+
+class Context:
+    invoked_function_arn = 'arn:aws:lambda:us-east-1:123456789012:function:snapshot-inventory'
+
+
+class RawBody:
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+
+def measure(variant):
+    """Import the module and start a scan the way the variant does, in this process"""
+    start = time.perf_counter()
+    if variant == 'eager':
+        import boto3  # noqa: F401
+    sys.path.insert(0, SRC)
+    import lambda_function
+    imported = time.perf_counter()
+
+    from botocore.awsrequest import AWSResponse
+    sent = {}
+
+    def answer(request, **kwargs):
+        operation = kwargs['event_name'].rsplit('.', 1)[-1]
+        sent.setdefault(operation, time.perf_counter())
+        return AWSResponse(request.url, 200, {}, RawBody(RESPONSES[operation]))
+
+    # Registered before any client exists, as clients copy the session's handlers
+    lambda_function.get_session().events.register('before-send', answer)
+    if variant == 'eager':
+        for service in ('ec2', 'rds', 'efs', 'backup', 's3', 'sns'):
+            lambda_function.get_client(service)
+        inventory = lambda_function.SnapshotInventory()
+        # Regions were listed with the home region client built above
+        inventory.call_api('ec2', None, 'describe_regions', 'REGIONS')
+    else:
+        lambda_function.SnapshotInventory(context=Context()).get_all_regions()
+
+    return {
+        'import_ms': (imported - start) * 1000,
+        'first_request_ms': (sent['DescribeRegions'] - start) * 1000,
+        'clients': len(lambda_function._CLIENT_POOL),
+        'sts_calls': int('GetCallerIdentity' in sent)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--samples', type=int, default=10, help='fresh interpreters per variant')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    parser.add_argument('--variant', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.variant:
+        # Child process: one cold start reported on stdout
+        print(json.dumps(measure(args.variant)))
+        return
+
+    env = dict(os.environ, **CHILD_ENV)
+    results = []
+    for variant in ('eager', 'lazy'):
+        samples = []
+        for _ in range(args.samples):
+            child = subprocess.run([sys.executable, os.path.abspath(__file__), '--variant', variant],
+                                   capture_output=True, text=True, check=True, env=env)
+            samples.append(json.loads(child.stdout.strip().splitlines()[-1]))
+        results.append({
+            'variant': variant,
+            'samples': args.samples,
+            'import_ms': round(statistics.median(s['import_ms'] for s in samples), 1),
+            'first_request_ms': round(statistics.median(s['first_request_ms'] for s in samples), 1),
+            'clients': samples[0]['clients'],
+            'sts_calls': samples[0]['sts_calls']
+        })
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'variant':>8} {'import ms':>10} {'first request ms':>17} {'clients':>8} {'sts calls':>10}")
+    for r in results:
+        print(f"{r['variant']:>8} {r['import_ms']:>10} {r['first_request_ms']:>17} "
+              f"{r['clients']:>8} {r['sts_calls']:>10}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,265 @@
+"""End-to-end lambda_handler benchmark against synthetic offline accounts.
+
+Every boto3 client is replaced by a synthetic one that serves generated
+snapshots, backup jobs and volumes page by page, sleeping a simulated
+latency per call, and discards uploads. The handler gets a Lambda
+context that never runs out of time, as a deployed invocation has, so
+finished units are kept for a checkpoint that is never needed;
+--no-context runs it as a local call. Each scenario runs in a fresh
+subprocess so its peak RSS is its own.
+
+Usage:
+    python benchmarks/bench_handler.py [--snapshots 1000,10000] [--regions 17] [--no-context] [--json]
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+
+from botocore.exceptions import ClientError
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import lambda_function  # noqa: E402
+
+REGIONS = ['us-east-1', 'us-east-2', 'us-west-1', 'us-west-2', 'eu-west-1', 'eu-west-2',
+           'eu-west-3', 'eu-central-1', 'eu-north-1', 'ap-south-1', 'ap-northeast-1',
+           'ap-northeast-2', 'ap-northeast-3', 'ap-southeast-1', 'ap-southeast-2',
+           'ca-central-1', 'sa-east-1']
+
+# Response key holding the items of each paginated operation
+RESULT_KEYS = {
+    'describe_snapshots': 'Snapshots',
+    'describe_db_snapshots': 'DBSnapshots',
+    'list_backup_jobs': 'BackupJobs',
+    'describe_volumes': 'Volumes'
+}
+
+NOW = datetime.now(timezone.utc)
+
+
+class SyntheticAccount:
+    """Item generators and call accounting shared by all synthetic clients"""
+
+    def __init__(self, regions, snapshots, db_snapshots, backup_jobs, volumes, latency):
+        extra = [f'xx-synthetic-{i}' for i in range(max(0, regions - len(REGIONS)))]
+        self.regions = (REGIONS + extra)[:regions]
+        # Items per region served by each paginated operation
+        self.counts = {
+            'describe_snapshots': snapshots,
+            'describe_db_snapshots': db_snapshots,
+            'list_backup_jobs': backup_jobs,
+            'describe_volumes': volumes
+        }
+        self.latency = latency
+        self.calls = Counter()
+        self.bytes_uploaded = 0
+        self._lock = threading.Lock()
+
+    def record(self, service, operation, uploaded=0):
+        with self._lock:
+            self.calls[f'{service}.{operation}'] += 1
+            self.bytes_uploaded += uploaded
+        if self.latency:
+            time.sleep(self.latency)
+
+    def item(self, operation, region, index):
+        created = NOW - timedelta(days=index % 1000, hours=index % 24)
+        if operation == 'describe_snapshots':
+            return {'SnapshotId': f'snap-{region}-{index:09d}', 'StartTime': created,
+                    'VolumeSize': index % 500 + 1}
+        if operation == 'describe_db_snapshots':
+            return {'DBSnapshotIdentifier': f'db-{region}-{index:09d}', 'SnapshotCreateTime': created,
+                    'AllocatedStorage': index % 200 + 20, 'Status': 'available'}
+        if operation == 'list_backup_jobs':
+            return {'BackupJobId': f'job-{region}-{index:09d}', 'State': 'COMPLETED',
+                    'CreationDate': NOW - timedelta(hours=index % 700),
+                    'BackupSizeInBytes': (index % 64 + 1) * 1024 ** 3}
+        return {'VolumeId': f'vol-{region}-{index:09d}', 'Size': index % 100 + 1, 'State': 'available',
+                'Attachments': [], 'VolumeType': 'gp3', 'CreateTime': created,
+                'StateTransitionTime': created}
+
+
+class SyntheticClient:
+    """Stand-in for one boto3 client, generating each page on request"""
+
+    def __init__(self, account, service, region):
+        self.account = account
+        self.service = service
+        self.region = region or account.regions[0]
+
+    def __getattr__(self, operation):
+        if operation not in RESULT_KEYS:
+            raise AttributeError(operation)
+        return lambda **kwargs: self.page(operation, **kwargs)
+
+    def page(self, operation, **kwargs):
+        self.account.record(self.service, operation)
+        input_token, output_token, limit_key = lambda_function.PAGINATION_TOKENS[operation]
+        start = int(kwargs.get(input_token) or 0)
+        size = kwargs.get(limit_key) or 1000
+        end = min(start + size, self.account.counts[operation])
+        response = {RESULT_KEYS[operation]: [self.account.item(operation, self.region, index)
+                                 for index in range(start, end)]}
+        if end < self.account.counts[operation]:
+            response[output_token] = str(end)
+        return response
+
+    def describe_regions(self, **kwargs):
+        self.account.record(self.service, 'describe_regions')
+        return {'Regions': [{'RegionName': region} for region in self.account.regions]}
+
+    def get_metric_data(self, **kwargs):
+        # Unattached volumes publish no metrics, as for volumes never attached
+        self.account.record(self.service, 'get_metric_data')
+        return {'MetricDataResults': []}
+
+    def get_caller_identity(self, **kwargs):
+        self.account.record(self.service, 'get_caller_identity')
+        return {'Account': '123456789012'}
+
+    def put_object(self, **kwargs):
+        self.account.record(self.service, 'put_object', len(kwargs['Body']))
+        return {}
+
+    def create_multipart_upload(self, **kwargs):
+        self.account.record(self.service, 'create_multipart_upload')
+        return {'UploadId': 'upload'}
+
+    def upload_part(self, **kwargs):
+        self.account.record(self.service, 'upload_part', len(kwargs['Body']))
+        return {'ETag': f"etag-{kwargs['PartNumber']}"}
+
+    def complete_multipart_upload(self, **kwargs):
+        self.account.record(self.service, 'complete_multipart_upload')
+        return {}
+
+    def abort_multipart_upload(self, **kwargs):
+        self.account.record(self.service, 'abort_multipart_upload')
+        return {}
+
+    def get_object(self, **kwargs):
+        self.account.record(self.service, 'get_object')
+        raise ClientError({'Error': {'Code': 'NoSuchKey', 'Message': 'Not found'}},
+                          'GetObject')
+
+    def delete_objects(self, **kwargs):
+        self.account.record(self.service, 'delete_objects')
+        return {}
+
+    def publish(self, **kwargs):
+        self.account.record(self.service, 'publish')
+        return {'MessageId': 'message'}
+
+
+class SyntheticSession:
+    region_name = 'us-east-1'
+
+    def __init__(self, account):
+        self.account = account
+
+    def client(self, service, region_name=None, **kwargs):
+        return SyntheticClient(self.account, service, region_name)
+
+
+class SyntheticContext:
+    """Lambda context of an invocation that never runs out of time"""
+
+    invoked_function_arn = 'arn:aws:lambda:us-east-1:123456789012:function:benchmark'
+
+    def get_remaining_time_in_millis(self):
+        return 900000
+
+
+def run_scenario(scenario):
+    """Run lambda_handler once against a synthetic account and measure it"""
+    account = SyntheticAccount(scenario['regions'], scenario['snapshots'], scenario['db_snapshots'],
+                               scenario['backup_jobs'], scenario['volumes'],
+                               scenario['latency_ms'] / 1000)
+    env = {'S3_BUCKET_NAME': 'benchmark-bucket',
+           'SNS_TOPIC_ARN': 'arn:aws:sns:us-east-1:123456789012:benchmark'}
+    env.update(scenario['env'])
+    patches = [patch.dict(os.environ, env),
+               patch('boto3.session.Session',
+                            return_value=SyntheticSession(account))]
+    for p in patches:
+        p.start()
+    try:
+        lambda_function._reset_client_pool()
+        start = time.perf_counter()
+        response = lambda_function.lambda_handler({}, SyntheticContext() if scenario['context'] else None)
+        wall_seconds = time.perf_counter() - start
+    finally:
+        for p in reversed(patches):
+            p.stop()
+
+    body = json.loads(response['body'])
+    return {
+        'scenario': scenario,
+        'wall_seconds': round(wall_seconds, 3),
+        # ru_maxrss is in KiB on Linux
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'api_calls': dict(sorted(account.calls.items())),
+        'total_api_calls': sum(account.calls.values()),
+        # Stage timings are the handler's own instrumentation
+        'stage_seconds': {stage: data['seconds'] for stage, data in body['api_stats']['stages'].items()},
+        'bytes_uploaded': account.bytes_uploaded,
+        'snapshots': body['summary']['total_count'],
+        'volumes': body['summary']['volume_count']
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--snapshots', default='1000,10000',
+                        help='comma-separated EBS snapshots per region, one scenario each')
+    parser.add_argument('--regions', type=int, default=17, help='regions per account')
+    parser.add_argument('--db-snapshots', type=int, default=100, help='RDS snapshots per region')
+    parser.add_argument('--backup-jobs', type=int, default=200, help='EFS backup jobs per region')
+    parser.add_argument('--volumes', type=int, default=500, help='unattached volumes per region')
+    parser.add_argument('--latency-ms', type=float, default=20, help='simulated latency of every API call')
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help='extra environment for the handler, e.g. OUTPUT_FORMAT=both')
+    parser.add_argument('--no-context', action='store_true', help='call the handler without a Lambda context')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    parser.add_argument('--scenario', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.scenario:
+        # Child process: run one scenario and report it on stdout
+        print(json.dumps(run_scenario(json.loads(args.scenario))))
+        return
+
+    results = []
+    for snapshots in (int(size) for size in args.snapshots.split(',')):
+        scenario = {
+            'regions': args.regions, 'snapshots': snapshots, 'db_snapshots': args.db_snapshots,
+            'backup_jobs': args.backup_jobs, 'volumes': args.volumes, 'latency_ms': args.latency_ms,
+            'context': not args.no_context, 'env': dict(item.split('=', 1) for item in args.env)
+        }
+        child = subprocess.run([sys.executable, os.path.abspath(__file__), '--scenario', json.dumps(scenario)],
+                               capture_output=True, text=True, check=True)
+        # The handler's own progress output precedes the result line
+        results.append(json.loads(child.stdout.strip().splitlines()[-1]))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'snapshots':>10} {'regions':>8} {'wall s':>8} {'rss MB':>8} {'api calls':>10}  stages")
+    for r in results:
+        stages = ', '.join(f'{stage} {seconds}s' for stage, seconds in r['stage_seconds'].items())
+        print(f"{r['scenario']['snapshots']:>10} {r['scenario']['regions']:>8} {r['wall_seconds']:>8} "
+              f"{r['peak_rss_mb']:>8} {r['total_api_calls']:>10}  {stages}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""Compare the run-over-run delta from the binary snapshot index with re-parsing the CSV.
+
+The CSV variant reads yesterday's snapshot_inventory CSV back and diffs
+ID sets, as the delta had to be computed before the index existed; the
+index variant decodes the previous index and merge joins it with the
+current scan.
+
+Usage:
+    python benchmarks/bench_index.py [--sizes 100000,1000000] [--json]
+"""
+
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from lambda_function import AGE_GROUPS, SNAPSHOT_CSV_FIELDS, SnapshotIndex, SnapshotRecord  # noqa: E402
+
+REGIONS = ['us-east-1', 'us-west-2', 'eu-west-1', 'eu-central-1', 'ap-southeast-2']
+TYPES = ['EBS', 'RDS', 'EFS']
+
+
+def synthetic_records(count, offset=0):
+    """Snapshots offset..offset+count, so two runs overlap except at the ends"""
+    now = datetime.now(timezone.utc)
+    return [SnapshotRecord(f'snap-{i:017x}', TYPES[i % 3], REGIONS[i % 5], now - timedelta(days=i % 1000),
+                           (i % 500) + 1, i % 1000, AGE_GROUPS[i % 8], '123456789012')
+            for i in range(offset, offset + count)]
+
+
+def write_csv(records):
+    stream = io.StringIO()
+    writer = csv.writer(stream)
+    writer.writerow(SNAPSHOT_CSV_FIELDS)
+    for record in records:
+        writer.writerow(record.to_row())
+    return stream.getvalue().encode('utf-8')
+
+
+def csv_delta(previous_csv, current):
+    rows = {row['Id']: row for row in csv.DictReader(io.StringIO(previous_csv.decode('utf-8')))}
+    current_ids = {record.Id for record in current}
+    added = [record for record in current if record.Id not in rows]
+    removed = [row for snapshot_id, row in rows.items() if snapshot_id not in current_ids]
+    return len(added) + len(removed)
+
+
+def index_delta(previous_index, current):
+    previous = SnapshotIndex.decode(previous_index)
+    return len(SnapshotIndex.from_records(datetime.now(timezone.utc), current).diff(previous))
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='100000,1000000', help='comma-separated snapshot counts')
+    parser.add_argument('--churn', type=float, default=0.01, help='fraction of snapshots replaced between runs')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    results = []
+    for count in (int(size) for size in args.sizes.split(',')):
+        previous = synthetic_records(count)
+        current = synthetic_records(count, offset=int(count * args.churn))
+        previous_csv = write_csv(previous)
+        previous_index = SnapshotIndex.from_records(datetime.now(timezone.utc), previous).encode()
+
+        csv_changes, csv_seconds = timed(csv_delta, previous_csv, current)
+        index_changes, index_seconds = timed(index_delta, previous_index, current)
+        assert csv_changes == index_changes
+        results.append({
+            'snapshots': count,
+            'changes': index_changes,
+            'csv_bytes': len(previous_csv),
+            'index_bytes': len(previous_index),
+            'csv_seconds': round(csv_seconds, 3),
+            'index_seconds': round(index_seconds, 3),
+            'speedup': round(csv_seconds / index_seconds, 2)
+        })
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'snapshots':>10} {'changes':>8} {'csv bytes':>11} {'index bytes':>12} "
+          f"{'csv s':>7} {'index s':>8} {'speedup':>8}")
+    for r in results:
+        print(f"{r['snapshots']:>10} {r['changes']:>8} {r['csv_bytes']:>11} {r['index_bytes']:>12} "
+              f"{r['csv_seconds']:>7} {r['index_seconds']:>8} {r['speedup']:>8}")
+
+
+if __name__ == '__main__':
+    main()
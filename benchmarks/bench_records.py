@@ -0,0 +1,127 @@
+"""Compare the memory and time cost of dict rows and SnapshotRecord tuples.
+
+Builds N synthetic snapshots in the original seven-key dict form (with an
+eagerly formatted ISO timestamp) and as SnapshotRecord instances, then
+writes both as CSV to an in-memory sink.
+
+Usage:
+    python benchmarks/bench_records.py [--sizes 100000,1000000] [--json]
+"""
+
+import argparse
+import csv
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from lambda_function import SNAPSHOT_CSV_FIELDS, SnapshotRecord  # noqa: E402
+
+AGE_GROUPS = ['7 days', '15 days', '30 days', '90 days', '180 days', '365 days', '730 days', '> 730 days']
+REGIONS = ['us-east-1', 'us-west-2', 'eu-west-1', 'eu-central-1', 'ap-southeast-2']
+TYPES = ['EBS', 'RDS', 'EFS']
+
+
+class NullSink:
+    """Text sink that only counts what is written"""
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, text):
+        self.size += len(text)
+        return len(text)
+
+
+def synthetic_source(count):
+    """Raw (id, type, region, start time, size, age, age group) values"""
+    now = datetime.now(timezone.utc)
+    for i in range(count):
+        age = i % 1000
+        yield (f'snap-{i:017x}', TYPES[i % 3], REGIONS[i % 5], now - timedelta(days=age),
+               (i % 500) + 1, age, AGE_GROUPS[i % 8])
+
+
+def build_dicts(count):
+    return [{'Id': sid, 'Type': stype, 'Region': region, 'StartTime': start.isoformat(),
+             'Size': size, 'Age': age, 'AgeGroup': group}
+            for sid, stype, region, start, size, age, group in synthetic_source(count)]
+
+
+def build_records(count):
+    return [SnapshotRecord(*values) for values in synthetic_source(count)]
+
+
+def write_dicts(rows):
+    writer = csv.DictWriter(NullSink(), fieldnames=SNAPSHOT_CSV_FIELDS)
+    writer.writeheader()
+    writer.writerows(rows)
+
+
+def write_records(records):
+    writer = csv.writer(NullSink())
+    writer.writerow(SNAPSHOT_CSV_FIELDS)
+    for record in records:
+        writer.writerow(record.to_row())
+
+
+def measure(count, build, write):
+    # Memory is traced in a separate build so tracing does not skew timings
+    gc.collect()
+    tracemalloc.start()
+    rows = build(count)
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del rows
+    gc.collect()
+
+    start = time.perf_counter()
+    rows = build(count)
+    build_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    write(rows)
+    write_seconds = time.perf_counter() - start
+    del rows
+    gc.collect()
+    return {
+        'bytes_per_record': round(retained / count, 1),
+        'build_seconds': round(build_seconds, 3),
+        'csv_seconds': round(write_seconds, 3)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='100000,1000000',
+                        help='comma-separated record counts')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    results = []
+    for count in (int(size) for size in args.sizes.split(',')):
+        results.append({
+            'records': count,
+            'dict': measure(count, build_dicts, write_dicts),
+            'SnapshotRecord': measure(count, build_records, write_records)
+        })
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'records':>10} {'variant':>15} {'bytes/record':>13} {'build s':>9} {'csv s':>8}")
+    for result in results:
+        for variant in ('dict', 'SnapshotRecord'):
+            r = result[variant]
+            print(f"{result['records']:>10} {variant:>15} {r['bytes_per_record']:>13} "
+                  f"{r['build_seconds']:>9} {r['csv_seconds']:>8}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""Time trend queries and growth from the daily rollup against re-reading the daily CSV reports.
+
+The rollup variant decodes a rollup holding --days days of summary cells,
+once to compute the email's growth and once for a trend by region over
+all those days. The CSV variant parses and aggregates one day's
+snapshot_inventory CSV; a trend over the same days has to do that once
+per day, so its time is that of one day multiplied by --days.
+
+Usage:
+    python benchmarks/bench_rollup.py [--cells 200,2000] [--snapshots 100000] [--json]
+"""
+
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from lambda_function import (AGE_GROUPS, GROWTH_PERIODS, SNAPSHOT_CSV_FIELDS, SnapshotRecord,  # noqa: E402
+                             SnapshotRollup)
+
+REGIONS = ['us-east-1', 'us-west-2', 'eu-west-1', 'eu-central-1', 'ap-southeast-2',
+           'ap-northeast-1', 'ca-central-1', 'sa-east-1']
+TYPES = ['EBS', 'RDS', 'EFS', 'AURORA', 'AMI']
+
+
+def synthetic_rollup(cells, days):
+    """Rollup of days days with cells (account, region, type, age group) cells each"""
+    keys = sorted({(f'{100000000000 + i // 320:012d}', REGIONS[i % 8], TYPES[i // 8 % 5], AGE_GROUPS[i // 40 % 8])
+                   for i in range(cells)})
+    today = SnapshotRollup.day_number(datetime.now(timezone.utc).date())
+    return SnapshotRollup.from_rows([(day, key, 10 + day % 7, 80.0 + day % 13)
+                                     for day in range(today - days + 1, today + 1) for key in keys])
+
+
+def write_csv(count):
+    now = datetime.now(timezone.utc)
+    stream = io.StringIO()
+    writer = csv.writer(stream)
+    writer.writerow(SNAPSHOT_CSV_FIELDS)
+    for i in range(count):
+        writer.writerow(SnapshotRecord(f'snap-{i:017x}', TYPES[i % 5], REGIONS[i % 8], now - timedelta(days=i % 1000),
+                                       (i % 500) + 1, i % 1000, AGE_GROUPS[i % 8], '123456789012').to_row())
+    return stream.getvalue().encode('utf-8')
+
+
+def csv_day(data):
+    """Count and GB per region of one day's report"""
+    totals = {}
+    for row in csv.DictReader(io.StringIO(data.decode('utf-8'))):
+        total = totals.setdefault(row['Region'], [0, 0.0])
+        total[0] += 1
+        total[1] += float(row['Size'])
+    return totals
+
+
+def growth(data):
+    """What a run does for the email: decode the rollup and compute the growth of its latest day"""
+    rollup = SnapshotRollup.decode(data)
+    today = rollup.latest_day()
+    return {name: rollup.growth(today, period) for name, period in GROWTH_PERIODS}
+
+
+def trend(data, days):
+    return SnapshotRollup.decode(data).trend(days, ('region',))
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--cells', default='200,2000', help='comma-separated summary cells per day')
+    parser.add_argument('--days', type=int, default=365, help='days of history')
+    parser.add_argument('--snapshots', type=int, default=100000, help='snapshots per daily CSV report')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    _, csv_seconds = timed(csv_day, write_csv(args.snapshots))
+
+    results = []
+    for cells in (int(size) for size in args.cells.split(',')):
+        data = synthetic_rollup(cells, args.days).encode()
+        _, growth_seconds = timed(growth, data)
+        points, trend_seconds = timed(trend, data, args.days)
+        results.append({
+            'cells_per_day': cells,
+            'days': args.days,
+            'rollup_bytes': len(data),
+            'growth_ms': round(growth_seconds * 1000, 1),
+            'trend_ms': round(trend_seconds * 1000, 1),
+            'trend_points': len(points),
+            'csv_seconds_per_day': round(csv_seconds, 3),
+            'csv_seconds_total': round(csv_seconds * args.days, 1)
+        })
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'cells':>6} {'days':>5} {'rollup bytes':>13} {'growth ms':>10} {'trend ms':>9} "
+          f"{'csv s/day':>10} {'csv s total':>12}")
+    for r in results:
+        print(f"{r['cells_per_day']:>6} {r['days']:>5} {r['rollup_bytes']:>13} {r['growth_ms']:>10} "
+              f"{r['trend_ms']:>9} {r['csv_seconds_per_day']:>10} {r['csv_seconds_total']:>12}")
+
+
+if __name__ == '__main__':
+    main()
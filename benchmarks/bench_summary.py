@@ -0,0 +1,119 @@
+"""Compare SummaryAggregator with the original nested-dict summary loop.
+
+Usage:
+    python benchmarks/bench_summary.py [--sizes 100000,1000000] [--json]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from lambda_function import AGE_GROUPS, SnapshotRecord, SummaryAggregator, VolumeRecord  # noqa: E402
+
+REGIONS = ['us-east-1', 'us-east-2', 'us-west-1', 'us-west-2', 'eu-west-1', 'eu-west-2',
+           'eu-west-3', 'eu-central-1', 'eu-north-1', 'ap-south-1', 'ap-northeast-1',
+           'ap-northeast-2', 'ap-northeast-3', 'ap-southeast-1', 'ap-southeast-2',
+           'ca-central-1', 'sa-east-1']
+TYPES = ['EBS', 'RDS', 'EFS']
+
+
+def synthetic_records(count):
+    now = datetime.now(timezone.utc)
+    snapshots = [SnapshotRecord(f'snap-{i:017x}', TYPES[i % 3], REGIONS[i % 17], now,
+                                (i % 500) + 1, i % 1000, AGE_GROUPS[i % 8])
+                 for i in range(count)]
+    volumes = [VolumeRecord(f'vol-{i:017x}', REGIONS[i % 17], (i % 200) + 1, 'available',
+                            i % 400, 'gp3', now - timedelta(days=i % 400))
+               for i in range(max(count // 100, 1))]
+    return snapshots, volumes
+
+
+def legacy_summary(snapshots, volumes):
+    """The aggregation generate_summary performed before SummaryAggregator"""
+    summary = {'total_count': len(snapshots), 'by_region': {}, 'by_type': {}, 'by_age_group': {}}
+    snapshots.sort(key=lambda x: x.Age, reverse=True)
+    for snapshot in snapshots:
+        region = snapshot.Region
+        stype = snapshot.Type
+        if region not in summary['by_region']:
+            summary['by_region'][region] = {'count': 0, 'size': 0, 'by_type': {}}
+        summary['by_region'][region]['count'] += 1
+        summary['by_region'][region]['size'] += snapshot.Size
+        if stype not in summary['by_region'][region]['by_type']:
+            summary['by_region'][region]['by_type'][stype] = {'count': 0, 'size': 0}
+        summary['by_region'][region]['by_type'][stype]['count'] += 1
+        summary['by_region'][region]['by_type'][stype]['size'] += snapshot.Size
+        if stype not in summary['by_type']:
+            summary['by_type'][stype] = {'count': 0, 'size': 0}
+        summary['by_type'][stype]['count'] += 1
+        summary['by_type'][stype]['size'] += snapshot.Size
+        age_group = snapshot.AgeGroup
+        if age_group not in summary['by_age_group']:
+            summary['by_age_group'][age_group] = {'count': 0, 'size': 0}
+        summary['by_age_group'][age_group]['count'] += 1
+        summary['by_age_group'][age_group]['size'] += snapshot.Size
+
+    volumes_by_region = {}
+    for volume in volumes:
+        volumes_by_region.setdefault(volume.Region, []).append(volume)
+    top = {region: sorted(region_volumes, key=lambda x: x.IdleDays, reverse=True)[:5]
+           for region, region_volumes in volumes_by_region.items()}
+    return summary, top
+
+
+def aggregator_summary(snapshots, volumes):
+    aggregator = SummaryAggregator()
+    aggregator.add_snapshots(snapshots)
+    aggregator.add_volumes(volumes)
+    return aggregator.result('123456789012', datetime.now())
+
+
+def best_of(func, snapshots, volumes, repeat):
+    timings = []
+    for _ in range(repeat):
+        # The legacy loop sorts in place, so each run gets a fresh list
+        rows = list(snapshots)
+        start = time.perf_counter()
+        func(rows, volumes)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='100000,1000000', help='comma-separated snapshot counts')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per variant, best is reported')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    results = []
+    for count in (int(size) for size in args.sizes.split(',')):
+        snapshots, volumes = synthetic_records(count)
+        legacy = best_of(legacy_summary, snapshots, volumes, args.repeat)
+        aggregated = best_of(aggregator_summary, snapshots, volumes, args.repeat)
+        results.append({
+            'snapshots': count,
+            'volumes': len(volumes),
+            'legacy_seconds': round(legacy, 4),
+            'aggregator_seconds': round(aggregated, 4),
+            'legacy_records_per_second': round(count / legacy),
+            'aggregator_records_per_second': round(count / aggregated),
+            'speedup': round(legacy / aggregated, 2)
+        })
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'snapshots':>10} {'legacy s':>9} {'aggregator s':>13} {'speedup':>8}")
+    for r in results:
+        print(f"{r['snapshots']:>10} {r['legacy_seconds']:>9} {r['aggregator_seconds']:>13} {r['speedup']:>8}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,445 +1,3977 @@
 # Description: Lambda function to generate a snapshot inventory and send a summary via SNS
 
-import boto3
+# boto3, botocore and cProfile are imported where first needed: boto3
+# alone is most of the module's import time, which a cold start pays
+# before the handler runs
+from abc import ABC, abstractmethod
+from array import array
+import bisect
 import csv
+import heapq
+import html
 import io
 import json
-from datetime import datetime, timezone
+import struct
+import zlib
+from datetime import date, datetime, timezone
 import os
-from typing import Dict, List, Any
+import queue
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from functools import partial
+from dataclasses import dataclass, field
+from datetime import timedelta
+from typing import Dict, List, Any, Callable, Iterator, NamedTuple, Optional, Set, Tuple
+
+# Default number of region x service collectors scanned concurrently
+DEFAULT_SCAN_MAX_WORKERS = 8
+
+# Default size of the botocore HTTP connection pool of each pooled client
+DEFAULT_MAX_POOL_CONNECTIONS = 10
+
+# Order in which per-region snapshot collectors are reported
+SNAPSHOT_COLLECTORS = ('EBS', 'RDS', 'EFS', 'AURORA', 'DYNAMODB', 'FSX', 'AMI', 'BACKUP')
+
+# Collectors run unless COLLECTORS lists others, e.g. "EBS,RDS,EFS,AURORA,DYNAMODB"
+DEFAULT_COLLECTORS = ('EBS', 'RDS', 'EFS')
+
+# Upper bounds in days of the age groups; override with AGE_BUCKETS, e.g.
+# "7,30,90,365,1095,1825" for 1, 3 and 5 year buckets
+DEFAULT_AGE_BUCKET_EDGES = (7, 15, 30, 90, 180, 365, 730)
+
+# Idle volumes listed per region in the summary
+TOP_IDLE_VOLUMES = 5
+
+# Filters each collector pushes to the API where it supports them:
+#   states             - only keep items in these states
+#   created_after_days - only keep items created within this many days
+#   page_size          - maximum number of items requested per API page
+# Override per type with the COLLECTOR_FILTERS environment variable, e.g.
+# {"EFS": {"created_after_days": 365}, "EBS": {"states": ["completed"]}}
+DEFAULT_COLLECTOR_FILTERS: Dict[str, Dict[str, Any]] = {
+    'EBS': {'states': [], 'created_after_days': None, 'page_size': 1000},
+    'RDS': {'states': [], 'created_after_days': None, 'page_size': 100},
+    'EFS': {'states': ['COMPLETED'], 'created_after_days': None, 'page_size': 1000},
+    'AURORA': {'states': [], 'created_after_days': None, 'page_size': 100},
+    'DYNAMODB': {'states': ['AVAILABLE'], 'created_after_days': None, 'page_size': 100},
+    'FSX': {'states': ['AVAILABLE'], 'created_after_days': None, 'page_size': 1000},
+    'AMI': {'states': ['available'], 'created_after_days': None, 'page_size': 1000},
+    'BACKUP': {'states': ['COMPLETED'], 'created_after_days': None, 'page_size': 1000},
+    'VOLUMES': {'states': ['available', 'creating', 'deleting', 'error'], 'page_size': 500}
+}
+
+# Prefix of the per-region incremental scan state objects in S3_BUCKET_NAME
+STATE_PREFIX = 'state'
+STATE_VERSION = 1
+
+# Only AWS Backup can filter by creation time server-side, so EFS is the
+# collector scanned incrementally; EBS and RDS listings are re-read each
+# run, which also reconciles their deletions
+INCREMENTAL_COLLECTORS = ('EFS',)
+
+# Backup jobs can complete after the previous watermark was taken
+INCREMENTAL_OVERLAP = timedelta(hours=24)
+
+# list_backup_jobs only returns jobs of the last 30 days, so stored jobs
+# older than that are dropped to match what a full scan would report
+BACKUP_JOB_HISTORY_DAYS = 30
+
+# Size of each part of a streamed S3 upload; S3 requires at least 5 MiB
+# for every part except the last one
+DEFAULT_UPLOAD_PART_SIZE_MB = 8
+MIN_UPLOAD_PART_SIZE = 5 * 1024 * 1024
+
+# Report formats selectable with OUTPUT_FORMAT
+OUTPUT_FORMATS = ('csv', 'parquet', 'both')
+
+# Column types of the Parquet reports; 'category' columns are dictionary
+# encoded. Size stays a float because EFS backup sizes are fractional GB
+SNAPSHOT_PARQUET_TYPES = {
+    'Id': 'string', 'Type': 'category', 'Region': 'category', 'StartTime': 'timestamp',
+    'Size': 'float64', 'Age': 'int32', 'AgeGroup': 'category', 'AccountId': 'category',
+    'BilledSize': 'float64', 'SourceId': 'string', 'Lineage': 'category'
+}
+VOLUME_PARQUET_TYPES = {
+    'VolumeId': 'string', 'Region': 'category', 'Size': 'int32', 'State': 'category',
+    'IdleDays': 'int32', 'VolumeType': 'category', 'CreateTime': 'timestamp',
+    'AccountId': 'category'
+}
+
+# Rows converted to Arrow per Parquet row group
+PARQUET_ROW_GROUP_SIZE = 100000
+DEFAULT_PARQUET_COMPRESSION = 'snappy'
+
+# Default sustained request rate per (service, region) and retry policy of
+# the collector API calls
+DEFAULT_API_RATE_LIMIT = 10
+DEFAULT_API_MAX_RETRIES = 8
+DEFAULT_API_RETRY_BASE_DELAY = 0.5
+API_RETRY_MAX_DELAY = 20
+
+# Services whose calls go through the rate limiter. Their clients have
+# botocore's own retries disabled so every throttle is seen and counted
+# here, which makes call_api responsible for every retry botocore would do
+RATE_LIMITED_SERVICES = ('ec2', 'rds', 'backup', 'dynamodb', 'fsx', 'ebs', 'cloudwatch', 'cloudtrail')
+
+# Error codes AWS services use to signal throttling, on top of those of
+# botocore's standard retry mode
+THROTTLING_ERROR_CODES = frozenset([
+    'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottled',
+    'RequestThrottledException', 'RequestLimitExceeded', 'TooManyRequestsException',
+    'SlowDown', 'ProvisionedThroughputExceededException', 'RequestLimitExceededException'
+])
+
+# Transient errors retried with the same backoff as throttles, on top of
+# botocore's; connection errors and 5xx responses are transient too
+TRANSIENT_ERROR_CODES = frozenset([
+    'InternalError', 'InternalFailure', 'InternalServerError', 'ServiceUnavailable',
+    'ServiceUnavailableException', 'RequestTimeout', 'RequestTimeoutException'
+])
+
+# (input token, output token, page size parameter) of each paginated operation
+PAGINATION_TOKENS = {
+    'describe_snapshots': ('NextToken', 'NextToken', 'MaxResults'),
+    'describe_volumes': ('NextToken', 'NextToken', 'MaxResults'),
+    'describe_db_snapshots': ('Marker', 'Marker', 'MaxRecords'),
+    'list_backup_jobs': ('NextToken', 'NextToken', 'MaxResults'),
+    'list_accounts': ('NextToken', 'NextToken', 'MaxResults'),
+    'describe_db_cluster_snapshots': ('Marker', 'Marker', 'MaxRecords'),
+    'list_backups': ('ExclusiveStartBackupArn', 'LastEvaluatedBackupArn', 'Limit'),
+    'describe_backups': ('NextToken', 'NextToken', 'MaxResults'),
+    'describe_images': ('NextToken', 'NextToken', 'MaxResults'),
+    'list_backup_vaults': ('NextToken', 'NextToken', 'MaxResults'),
+    'list_recovery_points_by_backup_vault': ('NextToken', 'NextToken', 'MaxResults'),
+    'list_changed_blocks': ('NextToken', 'NextToken', 'MaxResults'),
+    'list_snapshot_blocks': ('NextToken', 'NextToken', 'MaxResults'),
+    'get_metric_data': ('NextToken', 'NextToken', 'MaxDatapoints'),
+    'lookup_events': ('NextToken', 'NextToken', 'MaxResults'),
+    'describe_db_instances': ('Marker', 'Marker', 'MaxRecords')
+}
+
+# Key of the snapshot ID index each run leaves for the next run's delta,
+# under INDEX_PREFIX/{account}/
+INDEX_PREFIX = 'index'
+INDEX_NAME = 'snapshot_index.bin'
+
+# Index header: magic, generation time, entry count and the length of the
+# JSON string table. The zlib-compressed body holds the string table, one
+# little-endian column per INDEX_COLUMNS entry and the newline-separated IDs
+INDEX_MAGIC = b'SNAPIDX1'
+INDEX_HEADER = struct.Struct('<8sqII')
+
+# Array type codes of the index columns: string table codes of account,
+# region and type, size and start time in microseconds
+INDEX_COLUMNS = ('H', 'H', 'H', 'd', 'q')
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MICROSECOND = timedelta(microseconds=1)
+
+# Key of the daily rollup of snapshot counts and sizes behind the trend
+# reports, under ROLLUP_PREFIX/{account}/. It is rewritten by every run,
+# so the bucket's expiration of old reports never reaches it
+ROLLUP_PREFIX = 'rollup'
+ROLLUP_NAME = 'snapshot_rollup.bin'
+
+# Rollup header: magic, row count and the length of the JSON string table.
+# The zlib-compressed body holds the string table and one little-endian
+# column per ROLLUP_COLUMNS entry: day since the epoch, string table codes
+# of account, region, type and age group, snapshot count and size in GB
+ROLLUP_MAGIC = b'SNAPRLP1'
+ROLLUP_HEADER = struct.Struct('<8sII')
+ROLLUP_COLUMNS = ('I', 'H', 'H', 'H', 'H', 'I', 'd')
+
+# Days of history kept in the rollup: a year of trends plus a month of
+# margin for month-over-month growth
+DEFAULT_ROLLUP_RETENTION_DAYS = 400
+
+# Dimensions a trend query can group by, in rollup key order
+TREND_DIMENSIONS = ('account', 'region', 'type', 'age_group')
+
+# Growth periods of the email: name and days back. The run compared
+# against is the latest one at least that many days old, but less than
+# twice that many
+GROWTH_PERIODS = (('week', 7), ('month', 30))
+
+# Prefix of the per-account region activity maps (REGION_ACTIVITY_MAP)
+ACTIVITY_PREFIX = 'activity'
+ACTIVITY_VERSION = 1
+
+# Days between the probes of a region the activity map holds as dormant
+DEFAULT_DORMANT_PROBE_INTERVAL_DAYS = 7
+
+# Prefix of the per-region caches of measured EBS snapshot sizes (BILLED_SIZE)
+BILLED_SIZE_PREFIX = 'billed-size'
+BILLED_SIZE_VERSION = 1
+
+# EBS snapshots measured with the EBS direct APIs per run; the others keep
+# an empty BilledSize until a later run measures them
+DEFAULT_BILLED_SIZE_MAX_SNAPSHOTS = 200
+
+# Blocks per ListChangedBlocks / ListSnapshotBlocks page, the API maximum
+EBS_BLOCKS_PAGE_SIZE = 10000
+
+# The EBS direct APIs address snapshots in blocks of 512 KiB
+EBS_BLOCK_SIZE = 512 * 1024
+
+# Volume ID of EBS snapshots that were copied rather than taken of a volume
+EBS_NO_VOLUME_ID = 'vol-ffffffff'
+
+# Prefix of the per-region caches of the last activity of unattached volumes
+IDLE_PREFIX = 'idle'
+IDLE_VERSION = 1
+
+# Days of CloudWatch metrics (and CloudTrail events) searched for the last
+# activity of an unattached volume; CloudTrail keeps 90 days of events
+DEFAULT_IDLE_LOOKBACK_DAYS = 90
+
+# GetMetricData takes up to 500 metric queries per call; each volume needs
+# one per metric, with IDs made of the prefix and the volume's batch position
+METRIC_QUERIES_PER_CALL = 500
+IDLE_METRICS = {'r': 'VolumeReadOps', 'w': 'VolumeWriteOps'}
+
+# Lineage classes (SNAPSHOT_LINEAGE): an AMI references the snapshot, its
+# source volume or DB instance still exists, or neither does
+LINEAGE_CLASSES = ('ami', 'attached', 'orphaned')
+
+# Sweep listing the existing sources of each classified snapshot type:
+# service, operation, result key, ID field and page size (the API maximum)
+LINEAGE_SOURCES = {
+    'EBS': ('ec2', 'describe_volumes', 'Volumes', 'VolumeId', 500),
+    'RDS': ('rds', 'describe_db_instances', 'DBInstances', 'DBInstanceIdentifier', 100)
+}
+LINEAGE_IMAGES_PAGE_SIZE = 1000
+
+# Prefix of the checkpoints a run that is out of time leaves for its continuation
+CHECKPOINT_PREFIX = 'checkpoints'
+CHECKPOINT_VERSION = 4
+
+# Keys per DeleteObjects request, the most S3 accepts
+S3_DELETE_BATCH_SIZE = 1000
+
+# Rows of a finished unit encoded at a time when it is spilled to S3
+UNIT_SPILL_BATCH_SIZE = 1000
+
+# Records of finished units held in memory for a checkpoint before they are
+# spilled to S3 together
+DEFAULT_CHECKPOINT_BUFFER_RECORDS = 100000
+
+# Time kept back from the Lambda timeout for the checkpoint, or for the
+# reports and email of the final invocation
+DEFAULT_TIME_BUDGET_RESERVE_SECONDS = 60
+
+# Continuations a run may chain before it reports what it has
+DEFAULT_MAX_CONTINUATIONS = 10
+
+# SNS rejects messages larger than 256 KB
+SNS_MAX_MESSAGE_BYTES = 256 * 1024
+
+# Formats the summary can be rendered in; SUMMARY_FORMATS selects which of
+# html and json are also written to S3 next to the reports
+SUMMARY_FORMATS = ('text', 'html', 'json')
+
+# CloudWatch namespace of the Embedded Metric Format lines logged per run
+DEFAULT_METRICS_NAMESPACE = 'SnapshotInventory'
+
+# Functions listed when a run is profiled with {"profile": true}
+PROFILE_TOP_FUNCTIONS = 30
+
+# Role an organization scan assumes in each member account (ORG_ROLE_NAME)
+DEFAULT_ORG_ROLE_NAME = 'SnapshotInventoryRole'
+
+# Assumed-role sessions are renewed this long before their credentials expire
+ASSUMED_ROLE_REFRESH_MARGIN = timedelta(minutes=10)
+
+# Clients and the account ID live at module level so warm Lambda
+# invocations reuse them instead of rebuilding them on every run
+_SESSION = None
+_CLIENT_POOL: Dict[Tuple[str, Optional[str], Optional[str]], Any] = {}
+_CLIENT_POOL_LOCK = threading.Lock()
+_ACCOUNT_ID: Optional[str] = None
+_ACCOUNT_SESSIONS: Dict[str, Tuple[Any, datetime]] = {}
+_RATE_LIMITERS: Dict[Tuple[str, Optional[str], Optional[str]], 'RateLimiter'] = {}
+_RATE_LIMITERS_LOCK = threading.Lock()
+
+
+class SnapshotRecord(NamedTuple):
+    """One snapshot or backup; fields are the snapshot CSV columns in order.
+
+    Size is the provisioned size. BilledSize is the data an EBS snapshot
+    adds to its volume's lineage, None where it was not measured. SourceId
+    is the volume or DB instance a snapshot was taken of and Lineage its
+    class in LINEAGE_CLASSES, empty where it was not classified.
+    """
+    Id: str
+    Type: str
+    Region: str
+    StartTime: datetime
+    Size: float
+    Age: int
+    AgeGroup: str
+    AccountId: str = ''
+    BilledSize: Optional[float] = None
+    SourceId: str = ''
+    Lineage: str = ''
+
+    def to_row(self) -> tuple:
+        """Serialize for CSV, formatting the timestamp only now"""
+        return (self.Id, self.Type, self.Region, self.StartTime.isoformat(),
+                self.Size, self.Age, self.AgeGroup, self.AccountId, self.BilledSize,
+                self.SourceId, self.Lineage)
+
+    @classmethod
+    def from_row(cls, row) -> 'SnapshotRecord':
+        """Inverse of to_row, for rows read back from a checkpoint"""
+        return cls(row[0], row[1], row[2], datetime.fromisoformat(row[3]), *row[4:])
+
+
+class VolumeRecord(NamedTuple):
+    """One unattached EBS volume; fields are the volume CSV columns in order"""
+    VolumeId: str
+    Region: str
+    Size: int
+    State: str
+    IdleDays: int
+    VolumeType: str
+    CreateTime: datetime
+    AccountId: str = ''
+
+    def to_row(self) -> tuple:
+        """Serialize for CSV, formatting the timestamp only now"""
+        return (self.VolumeId, self.Region, self.Size, self.State,
+                self.IdleDays, self.VolumeType, self.CreateTime.isoformat(), self.AccountId)
+
+    @classmethod
+    def from_row(cls, row) -> 'VolumeRecord':
+        """Inverse of to_row, for rows read back from a checkpoint"""
+        return cls(*row[:6], datetime.fromisoformat(row[6]), *row[7:])
+
+
+class DeltaRecord(NamedTuple):
+    """One added, removed or resized snapshot; fields are the delta CSV columns in order"""
+    Change: str
+    Id: str
+    Type: str
+    Region: str
+    Size: float
+    SizeChange: float
+    StartTime: datetime
+    AccountId: str
+
+    def to_row(self) -> tuple:
+        """Serialize for CSV, formatting the timestamp only now"""
+        return (self.Change, self.Id, self.Type, self.Region, self.Size,
+                self.SizeChange, self.StartTime.isoformat(), self.AccountId)
+
+
+# Column order of the CSV reports
+SNAPSHOT_CSV_FIELDS = list(SnapshotRecord._fields)
+VOLUME_CSV_FIELDS = list(VolumeRecord._fields)
+DELTA_CSV_FIELDS = list(DeltaRecord._fields)
+
+
+class SnapshotIndex:
+    """Sorted (account, region, type, ID) keys of a run's snapshots with their sizes and start times.
+
+    Each run stores its index as a small binary object for the next run to
+    diff against. The columns are kept apart so that neither decoding nor
+    the merge join builds an object per snapshot; only the snapshots that
+    changed become DeltaRecords.
+    """
+
+    def __init__(self, generated_at: datetime, keys: List[Tuple[str, str, str, str]],
+                 sizes: List[float], start_times: List[int]):
+        self.generated_at = generated_at
+        self.keys = keys
+        self.sizes = sizes
+        # Microseconds since the epoch
+        self.start_times = start_times
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    @classmethod
+    def from_columns(cls, generated_at: datetime, keys: List[Tuple[str, str, str, str]],
+                     sizes: List[float], start_times: List[int]) -> 'SnapshotIndex':
+        """Build from unsorted columns"""
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        return cls(generated_at, [keys[i] for i in order], [sizes[i] for i in order],
+                   [start_times[i] for i in order])
+
+    @classmethod
+    def from_records(cls, generated_at: datetime, records: List[SnapshotRecord]) -> 'SnapshotIndex':
+        builder = SnapshotIndexBuilder()
+        builder.add(records)
+        return builder.build(generated_at)
+
+    def carry_over(self, previous: 'SnapshotIndex', units) -> 'SnapshotIndex':
+        """Add the snapshots of the given (account, region, type) units that only the previous index has"""
+        present = set(self.keys)
+        carried = [i for i, key in enumerate(previous.keys) if key[:3] in units and key not in present]
+        return SnapshotIndex.from_columns(
+            self.generated_at, self.keys + [previous.keys[i] for i in carried],
+            self.sizes + [previous.sizes[i] for i in carried],
+            self.start_times + [previous.start_times[i] for i in carried])
+
+    def encode(self) -> bytes:
+        """Pack the index into its compact binary form"""
+        strings: Dict[str, int] = {}
+        columns = [array(typecode, values) for typecode, values in zip(INDEX_COLUMNS, (
+            [strings.setdefault(key[0], len(strings)) for key in self.keys],
+            [strings.setdefault(key[1], len(strings)) for key in self.keys],
+            [strings.setdefault(key[2], len(strings)) for key in self.keys],
+            self.sizes, self.start_times))]
+        if sys.byteorder == 'big':
+            for column in columns:
+                column.byteswap()
+        ids = '\n'.join(key[3] for key in self.keys).encode('utf-8')
+        table = json.dumps(list(strings), separators=(',', ':')).encode('utf-8')
+        header = INDEX_HEADER.pack(INDEX_MAGIC, (self.generated_at - EPOCH) // MICROSECOND,
+                                   len(self.keys), len(table))
+        return header + zlib.compress(b''.join([table] + [column.tobytes() for column in columns] + [ids]))
+
+    @classmethod
+    def decode(cls, data: bytes) -> 'SnapshotIndex':
+        """Unpack an index written by encode"""
+        magic, generated_at, count, table_size = INDEX_HEADER.unpack_from(data)
+        if magic != INDEX_MAGIC:
+            raise ValueError('not a snapshot index')
+        body = zlib.decompress(data[INDEX_HEADER.size:])
+        strings = json.loads(body[:table_size])
+
+        # Each column is copied out of the body in one piece
+        columns = []
+        offset = table_size
+        for typecode in INDEX_COLUMNS:
+            column = array(typecode)
+            end = offset + count * column.itemsize
+            column.frombytes(body[offset:end])
+            if sys.byteorder == 'big':
+                column.byteswap()
+            columns.append(column.tolist())
+            offset = end
+        accounts, regions, types, sizes, start_times = columns
+        ids = body[offset:].decode('utf-8').split('\n') if count else []
+
+        lookup = strings.__getitem__
+        keys = list(zip(map(lookup, accounts), map(lookup, regions), map(lookup, types), ids))
+        return cls(EPOCH + generated_at * MICROSECOND, keys, sizes, start_times)
+
+    def change(self, kind: str, position: int, size_change: float) -> DeltaRecord:
+        account_id, region, stype, snapshot_id = self.keys[position]
+        return DeltaRecord(kind, snapshot_id, stype, region, self.sizes[position], size_change,
+                           EPOCH + self.start_times[position] * MICROSECOND, account_id)
+
+    def diff(self, previous: 'SnapshotIndex') -> List[DeltaRecord]:
+        """Merge join with the previous run's index into the snapshots added, removed or resized, in key order"""
+        changes = []
+        old_keys, new_keys = previous.keys, self.keys
+        i = j = 0
+        while i < len(old_keys) and j < len(new_keys):
+            old, new = old_keys[i], new_keys[j]
+            if old == new:
+                if previous.sizes[i] != self.sizes[j]:
+                    changes.append(self.change('resized', j, self.sizes[j] - previous.sizes[i]))
+                i += 1
+                j += 1
+            elif old < new:
+                changes.append(previous.change('removed', i, -previous.sizes[i]))
+                i += 1
+            else:
+                changes.append(self.change('added', j, self.sizes[j]))
+                j += 1
+        changes += [previous.change('removed', k, -previous.sizes[k]) for k in range(i, len(old_keys))]
+        changes += [self.change('added', k, self.sizes[k]) for k in range(j, len(new_keys))]
+        return changes
+
+
+class SnapshotIndexBuilder:
+    """Collects the index columns of snapshots streamed in chunks"""
 
-class SnapshotInventory:
     def __init__(self):
-        self.ec2_client = boto3.client('ec2')
-        self.rds_client = boto3.client('rds')
-        self.efs_client = boto3.client('efs')
-        self.backup_client = boto3.client('backup')  # Add AWS Backup client
-        self.s3_client = boto3.client('s3')
-        self.sns_client = boto3.client('sns')
-        self.account_id = boto3.client('sts').get_caller_identity()['Account']
+        self.keys: List[Tuple[str, str, str, str]] = []
+        self.sizes: List[float] = []
+        self.start_times: List[int] = []
+
+    def add(self, records: List[SnapshotRecord]):
+        self.keys += [(r.AccountId, r.Region, r.Type, r.Id) for r in records]
+        self.sizes += [r.Size for r in records]
+        self.start_times += [(r.StartTime - EPOCH) // MICROSECOND for r in records]
+
+    def build(self, generated_at: datetime) -> SnapshotIndex:
+        return SnapshotIndex.from_columns(generated_at, self.keys, self.sizes, self.start_times)
+
+
+class SnapshotRollup:
+    """Snapshot count and GB per day and (account, region, type, age group), the history behind trends.
+
+    Each run replaces its day's rows with its summary cells, so the rollup
+    grows by a few hundred fixed-width rows a day however many snapshots
+    there are. Rows are sorted by day and key and kept in the columns they
+    are stored in, the key as string table codes, so the growth of a day
+    or a trend query never builds an object per row.
+    """
+
+    def __init__(self, strings: List[str], days: List[int], codes: List[List[int]],
+                 counts: List[int], sizes: List[float]):
+        self.strings = strings
+        # Days since the epoch
+        self.days = days
+        # One column of string table codes per TREND_DIMENSIONS entry
+        self.codes = codes
+        self.counts = counts
+        self.sizes = sizes
+
+    def __len__(self) -> int:
+        return len(self.days)
+
+    @classmethod
+    def from_rows(cls, rows: List[Tuple[int, Tuple[str, str, str, str], int, float]]) -> 'SnapshotRollup':
+        """Build from unsorted (day, key, count, size) rows"""
+        rows = sorted(rows)
+        strings: Dict[str, int] = {}
+        codes = [[strings.setdefault(row[1][position], len(strings)) for row in rows]
+                 for position in range(len(TREND_DIMENSIONS))]
+        return cls(list(strings), [row[0] for row in rows], codes,
+                   [row[2] for row in rows], [row[3] for row in rows])
+
+    @staticmethod
+    def day_number(day: date) -> int:
+        return (day - EPOCH.date()).days
+
+    @staticmethod
+    def day_date(number: int) -> date:
+        return EPOCH.date() + timedelta(days=number)
+
+    def key(self, i: int) -> Tuple[str, str, str, str]:
+        strings = self.strings
+        return tuple(strings[column[i]] for column in self.codes)
+
+    def rows(self, positions) -> List[Tuple[int, Tuple[str, str, str, str], int, float]]:
+        """(day, key, count, size) of the rows at the given positions"""
+        return [(self.days[i], self.key(i), self.counts[i], self.sizes[i]) for i in positions]
+
+    def latest_day(self, before: Optional[int] = None) -> Optional[int]:
+        """Latest day with rows, optionally only among the days before another"""
+        end = len(self.days) if before is None else bisect.bisect_left(self.days, before)
+        return self.days[end - 1] if end else None
+
+    def day_rows(self, day: int) -> range:
+        return range(bisect.bisect_left(self.days, day), bisect.bisect_right(self.days, day))
+
+    def record(self, day: int, cells: List[Tuple[Tuple[str, str, str, str], int, float]],
+               failed: Set[Tuple[str, str, str]] = frozenset(), first_day: Optional[int] = None) -> 'SnapshotRollup':
+        """Rollup with the rows of a day replaced by the given cells, and the days before first_day dropped.
+
+        Cells of the (account, region, type) units that failed this run are
+        kept from an earlier run of the same day, or else taken from the
+        latest earlier day, rather than recorded short.
+        """
+        carried: List[Tuple[Tuple[str, str, str, str], int, float]] = []
+        remaining = set(failed)
+        for source in (day, self.latest_day(before=day)):
+            if remaining and source is not None:
+                found = [(key, count, size) for _, key, count, size in self.rows(self.day_rows(source))
+                         if key[:3] in remaining]
+                remaining -= {key[:3] for key, _, _ in found}
+                carried += found
+        if carried:
+            carried_units = {key[:3] for key, _, _ in carried}
+            cells = [cell for cell in cells if cell[0][:3] not in carried_units] + carried
+
+        start = bisect.bisect_left(self.days, first_day) if first_day is not None else 0
+        return SnapshotRollup.from_rows(
+            self.rows(range(start, bisect.bisect_left(self.days, day)))
+            + [(day, key, count, size) for key, count, size in cells]
+            + self.rows(range(bisect.bisect_right(self.days, day), len(self.days))))
+
+    def units(self, day: int) -> Set[Tuple[str, str, str]]:
+        """(account, region, type) units with rows on a day"""
+        return {self.key(i)[:3] for i in self.day_rows(day)}
+
+    def totals(self, day: int) -> Tuple[int, float]:
+        rows = self.day_rows(day)
+        return sum(self.counts[rows.start:rows.stop]), sum(self.sizes[rows.start:rows.stop])
+
+    def growth(self, day: int, period: int) -> Optional[Dict[str, Any]]:
+        """Change of the totals of a day since the latest day at least period days earlier"""
+        since = self.latest_day(before=day - period + 1)
+        if since is None or since <= day - 2 * period:
+            return None
+        count, size = self.totals(day)
+        since_count, since_size = self.totals(since)
+        return {
+            'since': self.day_date(since).isoformat(),
+            'count': count - since_count,
+            'size': round(size - since_size, 2),
+            'size_percent': round(100 * (size - since_size) / since_size, 1) if since_size else None
+        }
+
+    def trend(self, days: int, by: Tuple[str, ...] = ()) -> List[Dict[str, Any]]:
+        """Daily count and GB over the last days of the rollup, grouped by TREND_DIMENSIONS names"""
+        last = self.latest_day()
+        if last is None:
+            return []
+        start = bisect.bisect_left(self.days, last - days + 1)
+        columns = [self.codes[TREND_DIMENSIONS.index(name)][start:] for name in by]
+        groups: Dict[tuple, List[Any]] = {}
+        for group, count, size in zip(zip(self.days[start:], *columns), self.counts[start:], self.sizes[start:]):
+            total = groups.get(group)
+            if total is None:
+                total = groups[group] = [0, 0]
+            total[0] += count
+            total[1] += size
+
+        strings = self.strings
+        trend = [(self.day_date(group[0]).isoformat(), tuple(strings[code] for code in group[1:]), count, size)
+                 for group, (count, size) in groups.items()]
+        return [dict(zip(by, values), date=day, count=count, size=round(size, 2))
+                for day, values, count, size in sorted(trend)]
+
+    def encode(self) -> bytes:
+        """Pack the rollup into its compact binary form"""
+        columns = [array(typecode, values) for typecode, values in zip(
+            ROLLUP_COLUMNS, [self.days] + self.codes + [self.counts, self.sizes])]
+        if sys.byteorder == 'big':
+            for column in columns:
+                column.byteswap()
+        table = json.dumps(self.strings, separators=(',', ':')).encode('utf-8')
+        header = ROLLUP_HEADER.pack(ROLLUP_MAGIC, len(self.days), len(table))
+        return header + zlib.compress(b''.join([table] + [column.tobytes() for column in columns]))
+
+    @classmethod
+    def decode(cls, data: bytes) -> 'SnapshotRollup':
+        """Unpack a rollup written by encode"""
+        magic, count, table_size = ROLLUP_HEADER.unpack_from(data)
+        if magic != ROLLUP_MAGIC:
+            raise ValueError('not a snapshot rollup')
+        body = zlib.decompress(data[ROLLUP_HEADER.size:])
+        strings = json.loads(body[:table_size])
+
+        columns = []
+        offset = table_size
+        for typecode in ROLLUP_COLUMNS:
+            column = array(typecode)
+            end = offset + count * column.itemsize
+            column.frombytes(body[offset:end])
+            if sys.byteorder == 'big':
+                column.byteswap()
+            # Arrays are kept as they are; queries only slice and sum them
+            columns.append(column)
+            offset = end
+        return cls(strings, columns[0], columns[1:5], columns[5], columns[6])
+
+
+def summarize_delta(since: datetime, changes: List[DeltaRecord]) -> Dict[str, Any]:
+    """Totals of a delta and its growth per (region, type)"""
+    delta = {'since': since.isoformat(), 'added': 0, 'added_size': 0, 'removed': 0,
+             'removed_size': 0, 'growth': 0, 'by_region_type': []}
+    by_region_type: Dict[Tuple[str, str], Dict[str, Any]] = {}
+    for change in changes:
+        data = by_region_type.setdefault((change.Region, change.Type), {
+            'region': change.Region, 'type': change.Type, 'added': 0, 'removed': 0, 'growth': 0})
+        if change.Change in ('added', 'removed'):
+            data[change.Change] += 1
+            delta[change.Change] += 1
+            delta[f'{change.Change}_size'] += change.Size
+        data['growth'] += change.SizeChange
+        delta['growth'] += change.SizeChange
+
+    # Sizes are rounded once, after summing
+    for data in [delta] + list(by_region_type.values()):
+        for key in ('added_size', 'removed_size', 'growth'):
+            if key in data:
+                data[key] = round(data[key], 2)
+
+    type_order = {stype: index for index, stype in enumerate(SNAPSHOT_COLLECTORS)}
+    delta['by_region_type'] = [by_region_type[key] for key in sorted(
+        by_region_type, key=lambda key: (key[0], type_order.get(key[1], len(type_order)), key[1]))]
+    return delta
+
+
+class AgeBucketer:
+    """Ages items against a single reference clock and maps ages to groups.
+
+    Each edge is the inclusive upper bound of a group labelled "N days";
+    ages above the last edge fall into "> N days". Lookups are a bisect
+    over the sorted edges.
+    """
+
+    def __init__(self, edges=DEFAULT_AGE_BUCKET_EDGES, now: Optional[datetime] = None):
+        self.edges = sorted(set(edges))
+        self.now = now or datetime.now(timezone.utc)
+        self.labels = tuple(f"{edge} days" for edge in self.edges) + (f"> {self.edges[-1]} days",)
+
+    def age(self, start_time: datetime) -> int:
+        """Whole days between start_time and the reference clock"""
+        return (self.now - start_time).days
+
+    def group(self, age: int) -> str:
+        return self.labels[bisect.bisect_left(self.edges, age)]
+
+
+AGE_GROUPS = AgeBucketer().labels
+
+
+def load_age_bucketer(now: Optional[datetime] = None) -> AgeBucketer:
+    """Build the age bucketer from AGE_BUCKETS, falling back to the defaults"""
+    value = os.environ.get('AGE_BUCKETS')
+    if not value:
+        return AgeBucketer(now=now)
+    try:
+        edges = [int(edge) for edge in value.split(',') if edge.strip()]
+        if not edges:
+            raise ValueError('no bucket edges')
+    except ValueError as e:
+        print(f"Invalid AGE_BUCKETS {value!r}, using defaults: {str(e)}")
+        return AgeBucketer(now=now)
+    return AgeBucketer(edges, now=now)
+
+
+def _env_int(name: str, default: int) -> int:
+    """Read an integer environment variable, falling back to default"""
+    value = os.environ.get(name)
+    if value is None or value == '':
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        print(f"Invalid value for {name}: {value!r}, using {default}")
+        return default
+
+
+def _env_bool(name: str, default: bool = False) -> bool:
+    """Read a boolean environment variable such as 'true' or '1'"""
+    value = os.environ.get(name)
+    if value is None or value == '':
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def _env_list(name: str) -> List[str]:
+    """Read a comma-separated environment variable, skipping blank entries"""
+    return [item.strip() for item in os.environ.get(name, '').split(',') if item.strip()]
+
+
+def load_collector_filters() -> Dict[str, Dict[str, Any]]:
+    """Merge COLLECTOR_FILTERS overrides into the default collector filters"""
+    filters = {rtype: dict(values) for rtype, values in DEFAULT_COLLECTOR_FILTERS.items()}
+    overrides = os.environ.get('COLLECTOR_FILTERS')
+    if not overrides:
+        return filters
+
+    try:
+        for rtype, values in json.loads(overrides).items():
+            filters.setdefault(rtype.upper(), {}).update(values)
+    except (ValueError, AttributeError) as e:
+        print(f"Invalid COLLECTOR_FILTERS, using defaults: {str(e)}")
+        return {rtype: dict(values) for rtype, values in DEFAULT_COLLECTOR_FILTERS.items()}
+    return filters
+
+
+class ScanStats:
+    """Thread-safe counters of API pages and items fetched per region and collector,
+    and of the duration of each stage of the run"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters: Dict[Tuple[str, str], Dict[str, int]] = {}
+        self.errors: Dict[Tuple[str, str], int] = {}
+        # (account, region, collector) units whose records are incomplete
+        self.failed_units: Set[Tuple[str, str, str]] = set()
+        # Accounts whose units are all incomplete, e.g. as their regions are unknown
+        self.failed_accounts: Set[str] = set()
+        self.durations: Dict[Tuple[str, str], float] = {}
+        self.stages: Dict[str, Dict[str, Any]] = {}
+
+    def record_page(self, region: str, collector: str, items: int):
+        with self._lock:
+            counter = self.counters.setdefault((region, collector), {'pages': 0, 'items': 0})
+            counter['pages'] += 1
+            counter['items'] += items
+
+    def record_retry(self, region: str, collector: str, throttled: bool):
+        with self._lock:
+            counter = self.counters.setdefault((region, collector), {'pages': 0, 'items': 0})
+            counter['retries'] = counter.get('retries', 0) + 1
+            if throttled:
+                counter['throttles'] = counter.get('throttles', 0) + 1
+
+    def record_error(self, region: str, collector: str, account_id: Optional[str] = None):
+        """Count an error; given the account, the collector's unit is also marked failed"""
+        with self._lock:
+            self.errors[(region, collector)] = self.errors.get((region, collector), 0) + 1
+            if account_id is not None:
+                self.failed_units.add((account_id, region, collector))
+
+    def record_failed_unit(self, account_id: str, region: str, collector: str):
+        """Mark a unit failed without counting an error, e.g. every unit of an unreachable account"""
+        with self._lock:
+            self.failed_units.add((account_id, region, collector))
+
+    def record_failed_account(self, account_id: str):
+        """Mark every unit of an account failed, including those never scheduled"""
+        with self._lock:
+            self.failed_accounts.add(account_id)
+
+    def record_duration(self, region: str, collector: str, seconds: float):
+        with self._lock:
+            self.durations[(region, collector)] = self.durations.get((region, collector), 0) + seconds
+
+    def record_stage(self, name: str, seconds: float, bytes: int = 0, errors: int = 0):
+        with self._lock:
+            stage = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'bytes': 0, 'errors': 0})
+            stage['calls'] += 1
+            stage['seconds'] += seconds
+            stage['bytes'] += bytes
+            stage['errors'] += errors
+
+    @contextmanager
+    def stage(self, name: str):
+        """Time a stage of the run; counters such as 'bytes' can be set on the yielded dict"""
+        extra: Dict[str, int] = {}
+        start = time.perf_counter()
+        try:
+            yield extra
+        except Exception:
+            self.record_stage(name, time.perf_counter() - start, errors=1, **extra)
+            raise
+        self.record_stage(name, time.perf_counter() - start, **extra)
+
+    def merge(self, other: 'ScanStats'):
+        """Add the counters and errors of another scan, e.g. of a worker"""
+        with other._lock:
+            counters = {key: dict(counter) for key, counter in other.counters.items()}
+            errors = dict(other.errors)
+            failed_units = set(other.failed_units)
+            failed_accounts = set(other.failed_accounts)
+        with self._lock:
+            self.failed_units |= failed_units
+            self.failed_accounts |= failed_accounts
+            for key, counter in counters.items():
+                total = self.counters.setdefault(key, {'pages': 0, 'items': 0})
+                for name, value in counter.items():
+                    total[name] = total.get(name, 0) + value
+            for key, count in errors.items():
+                self.errors[key] = self.errors.get(key, 0) + count
+            for key, seconds in other.durations.items():
+                self.durations[key] = self.durations.get(key, 0) + seconds
+
+    def to_state(self) -> Dict[str, Any]:
+        """JSON-serializable copy of the stats, carried over by a checkpoint"""
+        with self._lock:
+            return {
+                'counters': [[region, collector, counter]
+                             for (region, collector), counter in self.counters.items()],
+                'errors': [[region, collector, count] for (region, collector), count in self.errors.items()],
+                'failed_units': sorted(self.failed_units),
+                'failed_accounts': sorted(self.failed_accounts),
+                'durations': [[region, collector, seconds]
+                              for (region, collector), seconds in self.durations.items()],
+                'stages': self.stages
+            }
+
+    def merge_state(self, state: Dict[str, Any]):
+        """Add stats saved by to_state, e.g. those of earlier invocations of a run"""
+        other = ScanStats()
+        other.counters = {(region, collector): counter for region, collector, counter in state['counters']}
+        other.errors = {(region, collector): count for region, collector, count in state['errors']}
+        other.failed_units = {tuple(unit) for unit in state.get('failed_units', [])}
+        other.failed_accounts = set(state.get('failed_accounts', []))
+        other.durations = {(region, collector): seconds for region, collector, seconds in state['durations']}
+        self.merge(other)
+        with self._lock:
+            for name, stage in state['stages'].items():
+                total = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'bytes': 0, 'errors': 0})
+                for counter, value in stage.items():
+                    total[counter] += value
+
+    def has_errors(self, region: str, collector: str) -> bool:
+        with self._lock:
+            return (region, collector) in self.errors
+
+    def has_failed(self, account_id: str, region: str, collector: str) -> bool:
+        """Whether the records of an account's collector unit are incomplete"""
+        with self._lock:
+            return account_id in self.failed_accounts or (account_id, region, collector) in self.failed_units
+
+    def by_collector(self) -> Dict[str, Dict[str, int]]:
+        """Counters summed over regions, keyed by collector"""
+        totals: Dict[str, Dict[str, int]] = {}
+        with self._lock:
+            for (_, collector), counter in sorted(self.counters.items()):
+                total = totals.setdefault(collector, {'pages': 0, 'items': 0,
+                                                      'throttles': 0, 'retries': 0})
+                for name in total:
+                    total[name] += counter.get(name, 0)
+        return totals
+
+    def to_dict(self) -> Dict[str, Any]:
+        by_collector = self.by_collector()
+        return {
+            'pages': sum(c['pages'] for c in by_collector.values()),
+            'items': sum(c['items'] for c in by_collector.values()),
+            'throttles': sum(c['throttles'] for c in by_collector.values()),
+            'retries': sum(c['retries'] for c in by_collector.values()),
+            'errors': sum(self.errors.values()),
+            'by_collector': by_collector,
+            'by_region': self.by_region(),
+            'stages': self.stage_totals()
+        }
+
+    def by_region(self) -> List[Dict[str, Any]]:
+        """Counters, errors and duration of every (region, collector)"""
+        with self._lock:
+            keys = sorted(set(self.counters) | set(self.errors) | set(self.durations))
+            return [{
+                'region': region,
+                'collector': collector,
+                'pages': self.counters.get((region, collector), {}).get('pages', 0),
+                'items': self.counters.get((region, collector), {}).get('items', 0),
+                'throttles': self.counters.get((region, collector), {}).get('throttles', 0),
+                'retries': self.counters.get((region, collector), {}).get('retries', 0),
+                'errors': self.errors.get((region, collector), 0),
+                'seconds': round(self.durations.get((region, collector), 0), 3)
+            } for region, collector in keys]
+
+    def stage_totals(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {name: dict(stage, seconds=round(stage['seconds'], 3))
+                    for name, stage in self.stages.items()}
+
+    def to_emf(self, namespace: str, account_id: str) -> List[Dict[str, Any]]:
+        """CloudWatch Embedded Metric Format documents, one per collector and per stage"""
+        timestamp = int(time.time() * 1000)
+
+        def document(dimensions, metrics, values):
+            return dict(values, AccountId=account_id, _aws={
+                'Timestamp': timestamp,
+                'CloudWatchMetrics': [{
+                    'Namespace': namespace,
+                    'Dimensions': [dimensions],
+                    'Metrics': [{'Name': name, 'Unit': unit} for name, unit in metrics]
+                }]
+            })
+
+        collector_metrics = [('Duration', 'Seconds'), ('Pages', 'Count'), ('Items', 'Count'),
+                             ('Throttles', 'Count'), ('Retries', 'Count'), ('Errors', 'Count')]
+        documents = [document(['Region', 'Collector'], collector_metrics, {
+            'Region': row['region'], 'Collector': row['collector'], 'Duration': row['seconds'],
+            'Pages': row['pages'], 'Items': row['items'], 'Throttles': row['throttles'],
+            'Retries': row['retries'], 'Errors': row['errors']
+        }) for row in self.by_region()]
+
+        stage_metrics = [('Duration', 'Seconds'), ('Bytes', 'Bytes'), ('Errors', 'Count')]
+        documents += [document(['Stage'], stage_metrics, {
+            'Stage': name, 'Duration': stage['seconds'], 'Bytes': stage['bytes'],
+            'Errors': stage['errors']
+        }) for name, stage in self.stage_totals().items()]
+        return documents
+
+
+class S3MultipartWriter:
+    """Text stream that uploads to S3 in fixed-size multipart parts.
+
+    Only one part is buffered at a time, optionally gzip-compressed on the
+    fly, so memory stays bounded however much is written. Objects smaller
+    than one part are sent with a single put_object instead.
+    """
+
+    def __init__(self, s3_client, bucket: str, key: str, gzip: bool = False,
+                 part_size: int = DEFAULT_UPLOAD_PART_SIZE_MB * 1024 * 1024,
+                 content_type: str = 'text/csv'):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, MIN_UPLOAD_PART_SIZE)
+        self.content_type = 'application/gzip' if gzip else content_type
+        # wbits=31 produces a gzip container rather than a raw zlib stream
+        self._compressor = zlib.compressobj(wbits=31) if gzip else None
+        self._buffer = bytearray()
+        self._upload_id: Optional[str] = None
+        self._parts: List[Dict[str, Any]] = []
+        self._position = 0
+        self.bytes_written = 0
+        self.upload_seconds = 0.0
+        self.closed = False
+
+    def write(self, data) -> int:
+        """Write text (encoded as UTF-8) or bytes"""
+        length = len(data)
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self._position += len(data)
+        if self._compressor:
+            data = self._compressor.compress(data)
+        self._buffer += data
+        # A single large write, e.g. a Parquet row group, can fill several parts
+        while len(self._buffer) >= self.part_size:
+            self._upload_part(bytes(self._buffer[:self.part_size]))
+            del self._buffer[:self.part_size]
+        return length
+
+    def tell(self) -> int:
+        """Number of uncompressed bytes written so far"""
+        return self._position
+
+    def flush(self):
+        # Parts are only uploaded once full, so there is nothing to flush
+        pass
+
+    def _upload_part(self, data: bytes):
+        start = time.perf_counter()
+        if self._upload_id is None:
+            self._upload_id = self.s3_client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key, ContentType=self.content_type)['UploadId']
+        part_number = len(self._parts) + 1
+        response = self.s3_client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+            PartNumber=part_number, Body=data)
+        self._parts.append({'PartNumber': part_number, 'ETag': response['ETag']})
+        self.bytes_written += len(data)
+        self.upload_seconds += time.perf_counter() - start
+
+    def close(self):
+        """Flush the remaining data and complete the upload"""
+        if self.closed:
+            return
+        self.closed = True
+        if self._compressor:
+            self._buffer += self._compressor.flush()
+
+        if self._upload_id is None:
+            start = time.perf_counter()
+            self.s3_client.put_object(Bucket=self.bucket, Key=self.key,
+                                      Body=bytes(self._buffer), ContentType=self.content_type)
+            self.bytes_written += len(self._buffer)
+            self.upload_seconds += time.perf_counter() - start
+        else:
+            if self._buffer:
+                self._upload_part(bytes(self._buffer))
+            start = time.perf_counter()
+            self.s3_client.complete_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                MultipartUpload={'Parts': self._parts})
+            self.upload_seconds += time.perf_counter() - start
+        self._buffer = bytearray()
+
+    def abort(self):
+        """Discard the upload so no incomplete parts are left behind"""
+        self.closed = True
+        self._buffer = bytearray()
+        if self._upload_id is not None:
+            self.s3_client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+@dataclass
+class InventorySummary:
+    """Aggregates of one inventory run, shared by every report output.
+
+    Breakdowns map a key to {'count', 'size'}; regions additionally carry
+    'by_type', volume regions carry their top idle 'volumes', and accounts
+    carry 'volume_count' and 'volume_size'.
+    """
+    account_id: str
+    generated_at: datetime
+    total_count: int = 0
+    total_size: float = 0
+    by_region: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+    by_type: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+    by_age_group: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+    volume_count: int = 0
+    volume_size: int = 0
+    volumes_by_region: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+    by_account: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+    api_stats: Dict[str, Any] = field(default_factory=dict)
+    skipped_regions: List[str] = field(default_factory=list)
+    delta: Optional[Dict[str, Any]] = None
+    # {'count', 'size', 'provisioned_size'} of the snapshots with a BilledSize
+    billed: Optional[Dict[str, Any]] = None
+    # {'by_class': {lineage: {'count', 'size'}}, 'orphaned_by_region':
+    # {region: {'count', 'size'}}} of the classified snapshots
+    lineage: Optional[Dict[str, Any]] = None
+    # Change since an earlier run per GROWTH_PERIODS name, from the rollup
+    growth: Optional[Dict[str, Any]] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        """JSON-serializable form of the summary"""
+        return {
+            'account_id': self.account_id,
+            'generated_at': self.generated_at.isoformat(),
+            'total_count': self.total_count,
+            'total_size': round(self.total_size, 2),
+            'by_region': self.by_region,
+            'by_type': self.by_type,
+            'by_age_group': self.by_age_group,
+            'volume_count': self.volume_count,
+            'volume_size': self.volume_size,
+            'volumes_by_region': {
+                region: dict(data, volumes=[
+                    dict(zip(VolumeRecord._fields, volume.to_row())) for volume in data['volumes']])
+                for region, data in self.volumes_by_region.items()
+            },
+            'by_account': self.by_account,
+            'api_stats': self.api_stats,
+            'skipped_regions': self.skipped_regions,
+            'delta': self.delta,
+            'billed': self.billed,
+            'lineage': self.lineage,
+            'growth': self.growth
+        }
+
+
+class SummaryAggregator:
+    """Single-pass group-by of snapshot and volume records.
+
+    Every distinct (account, region, type, age group) combination gets an integer
+    cell code the first time it is seen, so each record costs one lookup
+    and two flat list updates. The region, type and age breakdowns are
+    then rolled up from the handful of cells. Idle volumes are ranked with
+    a bounded heap per region instead of sorting every volume.
+    """
+
+    def __init__(self, age_groups=AGE_GROUPS, top_n: int = TOP_IDLE_VOLUMES):
+        self.age_groups = list(age_groups)
+        self.top_n = top_n
+        self._cell_codes: Dict[Tuple[str, str, str, str], int] = {}
+        self._cell_counts: List[int] = []
+        self._cell_sizes: List[float] = []
+        self._volume_regions: Dict[str, List[Any]] = {}
+        self._volume_accounts: Dict[str, List[int]] = {}
+        self._volume_seq = 0
+        # Count, billed and provisioned size of the snapshots with a BilledSize
+        self._billed = [0, 0.0, 0.0]
+        # [count, size] of the classified snapshots per (lineage, region)
+        self._lineage: Dict[Tuple[str, str], List[Any]] = {}
+
+    def add_snapshots(self, snapshots):
+        cell_codes = self._cell_codes
+        counts = self._cell_counts
+        sizes = self._cell_sizes
+        billed = self._billed
+        lineage = self._lineage
+        for snapshot in snapshots:
+            key = (snapshot.AccountId, snapshot.Region, snapshot.Type, snapshot.AgeGroup)
+            code = cell_codes.get(key)
+            if code is None:
+                code = cell_codes[key] = len(counts)
+                counts.append(0)
+                sizes.append(0)
+            counts[code] += 1
+            sizes[code] += snapshot.Size
+            if snapshot.BilledSize is not None:
+                billed[0] += 1
+                billed[1] += snapshot.BilledSize
+                billed[2] += snapshot.Size
+            if snapshot.Lineage:
+                cell = lineage.get((snapshot.Lineage, snapshot.Region))
+                if cell is None:
+                    cell = lineage[(snapshot.Lineage, snapshot.Region)] = [0, 0]
+                cell[0] += 1
+                cell[1] += snapshot.Size
+
+    def cells(self) -> List[Tuple[Tuple[str, str, str, str], int, float]]:
+        """(account, region, type, age group) key, count and size of every cell"""
+        return [(key, self._cell_counts[code], self._cell_sizes[code]) for key, code in self._cell_codes.items()]
+
+    def add_volumes(self, volumes):
+        for volume in volumes:
+            # [count, size, heap of (idle days, -sequence, volume)]
+            region = self._volume_regions.setdefault(volume.Region or 'unknown', [0, 0, []])
+            region[0] += 1
+            region[1] += volume.Size
+            account = self._volume_accounts.setdefault(volume.AccountId, [0, 0])
+            account[0] += 1
+            account[1] += volume.Size
+            # The sequence keeps the earlier volume first among equal idle days
+            self._volume_seq += 1
+            entry = (volume.IdleDays, -self._volume_seq, volume)
+            if len(region[2]) < self.top_n:
+                heapq.heappush(region[2], entry)
+            elif entry > region[2][0]:
+                heapq.heapreplace(region[2], entry)
+
+    def result(self, account_id: str, generated_at: datetime,
+               api_stats: Optional[Dict[str, Any]] = None) -> InventorySummary:
+        summary = InventorySummary(account_id, generated_at, api_stats=api_stats or {})
+
+        def bucket(groups, key):
+            return groups.setdefault(key, {'count': 0, 'size': 0})
+
+        def account_bucket(account_id):
+            return by_account.setdefault(account_id, {'count': 0, 'size': 0,
+                                                      'volume_count': 0, 'volume_size': 0})
+
+        # Roll the cells up in a stable order: regions by name, types in
+        # collector order, age groups from youngest to oldest
+        type_order = {stype: index for index, stype in enumerate(SNAPSHOT_COLLECTORS)}
+        age_order = {group: index for index, group in enumerate(self.age_groups)}
+        cells = sorted(self._cell_codes.items(), key=lambda item: (
+            item[0][1] or 'unknown', type_order.get(item[0][2], len(type_order)), item[0][2],
+            age_order.get(item[0][3], len(age_order)), item[0][0]))
+
+        by_age_group = {}
+        by_account: Dict[str, Dict[str, Any]] = {}
+        for (account_id, region, stype, age_group), code in cells:
+            count, size = self._cell_counts[code], self._cell_sizes[code]
+            summary.total_count += count
+            summary.total_size += size
+            region_data = summary.by_region.setdefault(
+                region or 'unknown', {'count': 0, 'size': 0, 'by_type': {}})
+            for data in (region_data, bucket(region_data['by_type'], stype),
+                         bucket(summary.by_type, stype), bucket(by_age_group, age_group),
+                         account_bucket(account_id)):
+                data['count'] += count
+                data['size'] += size
+
+        summary.by_age_group = {group: by_age_group[group]
+                                for group in sorted(by_age_group,
+                                                    key=lambda g: age_order.get(g, len(age_order)))}
+
+        for region in sorted(self._volume_regions):
+            count, size, heap = self._volume_regions[region]
+            summary.volume_count += count
+            summary.volume_size += size
+            summary.volumes_by_region[region] = {
+                'count': count,
+                'size': size,
+                'volumes': [volume for _, _, volume in sorted(heap, reverse=True)]
+            }
+
+        for account_id, (count, size) in self._volume_accounts.items():
+            data = account_bucket(account_id)
+            data['volume_count'] += count
+            data['volume_size'] += size
+        summary.by_account = {account_id: by_account[account_id] for account_id in sorted(by_account)}
+
+        if self._billed[0]:
+            count, size, provisioned_size = self._billed
+            summary.billed = {'count': count, 'size': round(size, 2),
+                              'provisioned_size': round(provisioned_size, 2)}
+
+        if self._lineage:
+            by_class = {lineage: {'count': 0, 'size': 0} for lineage in LINEAGE_CLASSES}
+            orphaned = {}
+            for (lineage, region), (count, size) in sorted(self._lineage.items(),
+                                                           key=lambda item: item[0][1] or 'unknown'):
+                data = by_class[lineage]
+                data['count'] += count
+                data['size'] += size
+                if lineage == 'orphaned':
+                    orphaned[region or 'unknown'] = {'count': count, 'size': size}
+            summary.lineage = {'by_class': by_class, 'orphaned_by_region': orphaned}
+        return summary
+
+
+class ReportSection(NamedTuple):
+    """One titled section of a rendered summary.
+
+    Lines are always rendered. Entries are the repeated items (one line,
+    or a block of lines headed by its first one) and are dropped from the
+    end, lowest priority section first, when the report exceeds its budget.
+    """
+    title: str
+    lines: List[str]
+    entries: List[List[str]]
+    noun: str = 'entries'
+    priority: int = 0
+
+
+class SummaryRenderer:
+    """Render an InventorySummary as plain text, HTML or JSON within a byte budget.
+
+    The summary is first laid out as ReportSections, independent of the
+    output format. Every line is measured once and the budget is enforced
+    by dropping whole entries, replaced by an "…and N more" line, so the
+    output is assembled in a single join whatever its size.
+    """
+
+    RULE = '-' * 40
+
+    def __init__(self, budget: Optional[int] = None, measure: Optional[Callable[[str], int]] = None):
+        self.budget = budget
+        # Size of a line in the output channel; UTF-8 bytes by default
+        self.measure = measure or (lambda text: len(text.encode('utf-8')))
+
+    def layout(self, summary: InventorySummary) -> Tuple[List[str], List[ReportSection]]:
+        """Header lines and sections of a summary"""
+        multi_account = len(summary.by_account) > 1
+        scope = (f"{len(summary.by_account)} Accounts (Organization {summary.account_id})"
+                 if multi_account else f"Account {summary.account_id}")
+        header = [f"Snapshot Inventory Summary for {scope}",
+                  f"Generated on: {summary.generated_at.strftime('%Y-%m-%d %H:%M:%S')}",
+                  '',
+                  f"Total Snapshots: {summary.total_count}"]
+        if summary.skipped_regions:
+            header.append(f"Dormant Regions Skipped: {', '.join(summary.skipped_regions)}")
+
+        sections = []
+        delta = summary.delta
+        if delta:
+            since = datetime.fromisoformat(delta['since']).strftime('%Y-%m-%d %H:%M:%S')
+            sections.append(ReportSection(f"Changes Since Last Run ({since})", [
+                f"New Snapshots: {delta['added']}, {delta['added_size']:.2f} GB",
+                f"Removed Snapshots: {delta['removed']}, {delta['removed_size']:.2f} GB",
+                f"Net Growth: {delta['growth']:+.2f} GB"
+            ], [
+                [f"{data['region']} {data['type']}: +{data['added']} / -{data['removed']} snapshots, "
+                 f"{data['growth']:+.2f} GB"]
+                for data in delta['by_region_type']], 'region and type changes', 3))
+
+        # Growth of the totals over longer periods, from the daily rollup
+        if summary.growth:
+            sections.append(ReportSection('Growth', [
+                f"{name.capitalize()} over {name.capitalize()} (since {data['since']}): "
+                f"{data['count']:+d} snapshots, {data['size']:+.2f} GB"
+                + (f" ({data['size_percent']:+.1f}%)" if data['size_percent'] is not None else '')
+                for name, data in summary.growth.items()], []))
+
+        if multi_account:
+            sections.append(ReportSection('Account Breakdown', [], [
+                [f"{account_id}: {data['count']} snapshots, {data['size']:.2f} GB, "
+                 f"{data['volume_count']} unattached volumes"]
+                for account_id, data in summary.by_account.items()], 'accounts', 2))
+
+        sections.append(ReportSection('Regional Breakdown', [], [
+            [f"Region: {region}", f"Total: {data['count']} snapshots, {data['size']:.2f} GB", 'By Type:']
+            + [f"  - {stype}: {type_data['count']} snapshots, {type_data['size']:.2f} GB"
+               for stype, type_data in data['by_type'].items()]
+            for region, data in summary.by_region.items()], 'regions', 1))
+
+        sections.append(ReportSection('Global Breakdown by Type', [
+            f"{stype}: {data['count']} snapshots, {data['size']:.2f} GB"
+            for stype, data in summary.by_type.items()], []))
+
+        # Measured EBS snapshots, whose provisioned Size overstates their cost
+        if summary.billed:
+            billed = summary.billed
+            ebs_count = summary.by_type.get('EBS', {}).get('count', billed['count'])
+            sections.append(ReportSection('Billed EBS Snapshot Size', [
+                f"Measured: {billed['count']} of {ebs_count} EBS snapshots",
+                f"Billed: {billed['size']:.2f} GB of {billed['provisioned_size']:.2f} GB provisioned"
+            ], []))
+
+        # Orphaned snapshots are the largest cleanup candidates
+        if summary.lineage:
+            by_class = summary.lineage['by_class']
+            sections.append(ReportSection('Snapshot Lineage', [
+                f"Orphaned: {by_class['orphaned']['count']} snapshots, {by_class['orphaned']['size']:.2f} GB",
+                f"Attached: {by_class['attached']['count']} snapshots, {by_class['attached']['size']:.2f} GB",
+                f"AMI-Backed: {by_class['ami']['count']} snapshots, {by_class['ami']['size']:.2f} GB"
+            ], [
+                [f"{region}: {data['count']} orphaned snapshots, {data['size']:.2f} GB"]
+                for region, data in summary.lineage['orphaned_by_region'].items()],
+                'regions with orphaned snapshots', 2))
+
+        sections.append(ReportSection('Breakdown by Age', [
+            f"{age_group}: {data['count']} snapshots, {data['size']:.2f} GB"
+            for age_group, data in summary.by_age_group.items()], []))
+
+        volume_lines = [f"Total Unattached Volumes: {summary.volume_count}"]
+        volume_entries = []
+        if summary.volume_count:
+            for region, data in summary.volumes_by_region.items():
+                entry = [f"Region: {region}", f"Volumes: {data['count']}, Total Size: {data['size']} GB",
+                         'Top Idle Volumes (by days unattached):']
+                for vol in data['volumes']:
+                    entry.append(f"Volume ID: {vol.VolumeId}")
+                    if multi_account:
+                        entry.append(f"  - Account: {vol.AccountId}")
+                    entry += [f"  - Idle Days: {vol.IdleDays}", f"  - Size: {vol.Size} GB",
+                              f"  - Type: {vol.VolumeType}", f"  - State: {vol.State}"]
+                volume_entries.append(entry)
+        else:
+            volume_lines.append('No unattached volumes found.')
+        sections.append(ReportSection('Unattached EBS Volumes Summary', volume_lines, volume_entries,
+                                      'regions with unattached volumes', 0))
+
+        # API usage shows the effect of collector filters and throttling
+        api_stats = summary.api_stats
+        if api_stats:
+            sections.append(ReportSection('API Usage', [
+                f"Total: {api_stats['pages']} pages, {api_stats['items']} items fetched, "
+                f"{api_stats['throttles']} throttles, {api_stats['retries']} retries"
+            ] + [
+                f"{collector}: {counter['pages']} pages, {counter['items']} items fetched, "
+                f"{counter['throttles']} throttles, {counter['retries']} retries"
+                for collector, counter in api_stats['by_collector'].items()
+            ], []))
+        return header, sections
+
+    def fit(self, header: List[str], sections: List[ReportSection]) -> List[Tuple[ReportSection, int]]:
+        """Number of entries of each section kept within the budget.
+
+        Sizes are added up line by line as render_text lays the text out,
+        and the result is checked against the rendered text once more, as
+        a measure need not add up over lines.
+        """
+        kept = [len(section.entries) for section in sections]
+        if self.budget is None:
+            return list(zip(sections, kept))
+
+        # Every line but the first follows a line break
+        newline = self.measure('\n')
+
+        def block(lines: List[str]) -> int:
+            return sum(self.measure(line) + newline for line in lines)
+
+        # Blocks of lines are set apart by a blank line, single lines are not
+        entry_sizes = [[block([''] + entry if len(entry) > 1 else entry) for entry in section.entries]
+                       for section in sections]
+        size = block(header) - newline
+        for section, sizes in zip(sections, entry_sizes):
+            size += block(['', f"{section.title}:", self.RULE] + section.lines) + sum(sizes)
+
+        order = sorted(range(len(sections)), key=lambda i: sections[i].priority)
+        for index in order:
+            section, sizes = sections[index], entry_sizes[index]
+            while size > self.budget and kept[index]:
+                kept[index] -= 1
+                size -= sizes[kept[index]]
+                if kept[index] == len(sizes) - 1:
+                    # Sized for the largest count it may end up showing
+                    size += block([self.more_line(section, len(sizes))])
+            if size <= self.budget:
+                break
+
+        fitted = list(zip(sections, kept))
+        for index in order:
+            while kept[index] and self.measure(self.render_text(header, fitted)) > self.budget:
+                kept[index] -= 1
+                fitted = list(zip(sections, kept))
+        return fitted
+
+    def more_line(self, section: ReportSection, omitted: int) -> str:
+        return f"\u2026and {omitted} more {section.noun}"
+
+    def render(self, summary: InventorySummary, format: str = 'text') -> str:
+        """Render a summary in one of SUMMARY_FORMATS"""
+        header, sections = self.layout(summary)
+        fitted = self.fit(header, sections)
+        if format == 'html':
+            return self.render_html(header, fitted)
+        if format == 'json':
+            return self.render_json(header, fitted)
+        return self.render_text(header, fitted)
+
+    def render_text(self, header: List[str], fitted: List[Tuple[ReportSection, int]]) -> str:
+        lines = list(header)
+        for section, kept in fitted:
+            lines += ['', f"{section.title}:", self.RULE]
+            lines += section.lines
+            for entry in section.entries[:kept]:
+                # Blocks of lines are set apart by a blank line
+                if len(entry) > 1:
+                    lines.append('')
+                lines += entry
+            if kept < len(section.entries):
+                lines.append(self.more_line(section, len(section.entries) - kept))
+        return '\n'.join(lines)
+
+    def render_html(self, header: List[str], fitted: List[Tuple[ReportSection, int]]) -> str:
+        escape = html.escape
+        parts = [f"<h1>{escape(header[0])}</h1>"]
+        parts += [f"<p>{escape(line)}</p>" for line in header[1:] if line]
+        for section, kept in fitted:
+            parts.append(f"<h2>{escape(section.title)}</h2>")
+            parts += [f"<p>{escape(line)}</p>" for line in section.lines]
+            items = []
+            for entry in section.entries[:kept]:
+                if len(entry) > 1:
+                    items.append(f"<h3>{escape(entry[0])}</h3><ul>"
+                                 + ''.join(f"<li>{escape(line.lstrip(' -'))}</li>" for line in entry[1:])
+                                 + "</ul>")
+                else:
+                    items.append(f"<ul><li>{escape(entry[0])}</li></ul>")
+            parts += items
+            if kept < len(section.entries):
+                parts.append(f"<p><em>{escape(self.more_line(section, len(section.entries) - kept))}</em></p>")
+        return '\n'.join(parts)
+
+    def render_json(self, header: List[str], fitted: List[Tuple[ReportSection, int]]) -> str:
+        return json.dumps({
+            'title': header[0],
+            'header': [line for line in header[1:] if line],
+            'sections': [{
+                'title': section.title,
+                'lines': section.lines,
+                'entries': section.entries[:kept],
+                'omitted': len(section.entries) - kept
+            } for section, kept in fitted]
+        })
+
+
+def _import_pyarrow():
+    """Import pyarrow, which is not part of the Lambda runtime (add it as a layer)"""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        return None
+    return pyarrow
+
+
+class ParquetRowGroupWriter:
+    """Writes rows streamed in chunks as typed Parquet, one row group at a time.
+
+    column_types lists the record fields in order. Rows are buffered only
+    until a row group is full.
+    """
+
+    def __init__(self, stream, column_types: Dict[str, str],
+                 compression: str = DEFAULT_PARQUET_COMPRESSION):
+        pa = _import_pyarrow()
+        arrow_types = {
+            'string': pa.string(),
+            'category': pa.dictionary(pa.int32(), pa.string()),
+            'timestamp': pa.timestamp('us', tz='UTC'),
+            'float64': pa.float64(),
+            'int32': pa.int32()
+        }
+        self.pa = pa
+        self.column_types = column_types
+        self.schema = pa.schema([(name, arrow_types[ctype]) for name, ctype in column_types.items()])
+        self.writer = pa.parquet.ParquetWriter(stream, self.schema, compression=compression)
+        self.rows: List[tuple] = []
+        self.row_groups = 0
+
+    def add(self, rows: List[tuple]):
+        self.rows.extend(rows)
+        full = len(self.rows) - len(self.rows) % PARQUET_ROW_GROUP_SIZE
+        if not full:
+            return
+        for start in range(0, full, PARQUET_ROW_GROUP_SIZE):
+            self.write_row_group(self.rows[start:start + PARQUET_ROW_GROUP_SIZE])
+        self.rows = self.rows[full:]
+
+    def write_row_group(self, batch: List[tuple]):
+        columns = {name: [row[index] for row in batch]
+                   for index, name in enumerate(self.column_types)}
+        self.writer.write_table(self.pa.Table.from_pydict(columns, schema=self.schema))
+        self.row_groups += 1
+
+    def close(self):
+        """Write the last, partial row group; an empty file still gets one"""
+        if self.rows or not self.row_groups:
+            self.write_row_group(self.rows)
+        self.rows = []
+        self.writer.close()
+
+
+def write_parquet(stream, column_types: Dict[str, str], rows: List[tuple],
+                  compression: str = DEFAULT_PARQUET_COMPRESSION):
+    """Write records as typed Parquet to a binary stream, one row group at a time.
+
+    column_types lists the record fields in order.
+    """
+    writer = ParquetRowGroupWriter(stream, column_types, compression)
+    writer.add(rows)
+    writer.close()
+
+
+class ReportSink(ABC):
+    """Report uploaded to S3 while its records are still arriving.
+
+    add() takes the records chunk by chunk, e.g. one scan unit at a time;
+    close() completes the upload and records the report's stage, abort()
+    discards it. Subclasses implement write() for their format.
+    """
+    stage = ''
+
+    def __init__(self, stats: ScanStats, stream: S3MultipartWriter):
+        self.stats = stats
+        self.stream = stream
+        self.seconds = 0.0
+
+    def add(self, records):
+        start = time.perf_counter()
+        try:
+            self.write(records)
+        finally:
+            self.seconds += time.perf_counter() - start
+
+    @abstractmethod
+    def write(self, records):
+        """Write one chunk of records to the stream"""
+
+    def finish(self):
+        """Write whatever the format keeps buffered until the end"""
+
+    def close(self) -> int:
+        """Complete the upload, returning the bytes uploaded"""
+        start = time.perf_counter()
+        try:
+            self.finish()
+            self.stream.close()
+        except Exception:
+            self.abort(failed=True)
+            raise
+        self.seconds += time.perf_counter() - start
+        self.stats.record_stage(self.stage, self.seconds, bytes=self.stream.bytes_written)
+        self.stats.record_stage('s3_upload', self.stream.upload_seconds, bytes=self.stream.bytes_written)
+        return self.stream.bytes_written
+
+    def abort(self, failed: bool = False):
+        """Discard the upload; a failed report counts as an error of its stage"""
+        self.stream.abort()
+        if failed:
+            self.stats.record_stage(self.stage, self.seconds, errors=1)
+
+
+class CsvReportSink(ReportSink):
+    stage = 'csv'
+
+    def __init__(self, stats: ScanStats, stream: S3MultipartWriter, fieldnames: List[str]):
+        super().__init__(stats, stream)
+        self.writer = csv.writer(stream)
+        self.writer.writerow(fieldnames)
+
+    def write(self, records):
+        self.writer.writerows(record.to_row() for record in records)
+
+
+class ParquetReportSink(ReportSink):
+    stage = 'parquet'
+
+    def __init__(self, stats: ScanStats, stream: S3MultipartWriter, column_types: Dict[str, str],
+                 compression: str = DEFAULT_PARQUET_COMPRESSION):
+        super().__init__(stats, stream)
+        self.writer = ParquetRowGroupWriter(stream, column_types, compression)
+
+    def write(self, records):
+        self.writer.add(records)
+
+    def finish(self):
+        self.writer.close()
+
+
+class RateLimiter:
+    """Token bucket shared by every caller of one (service, region) endpoint.
+
+    The refill rate halves each time a call is throttled and recovers
+    additively with successful calls, up to the configured rate.
+    """
+
+    # The rate never drops below this fraction of the configured rate
+    MIN_RATE_FRACTION = 0.05
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.capacity = float(burst or max(1.0, rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a request may be sent"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            _sleep(wait)
+
+    def on_throttle(self):
+        with self._lock:
+            self.rate = max(self.max_rate * self.MIN_RATE_FRACTION, self.rate / 2)
+
+    def on_success(self):
+        with self._lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+class WorkBudget:
+    """Number of items a run may spend on costly work, drawn from by concurrent units"""
+
+    def __init__(self, limit: int):
+        self.remaining = max(0, limit)
+        self._lock = threading.Lock()
+
+    def take(self, wanted: int) -> int:
+        """Reserve up to wanted items, returning how many were granted"""
+        with self._lock:
+            granted = min(wanted, self.remaining)
+            self.remaining -= granted
+            return granted
+
+
+def _sleep(seconds: float):
+    time.sleep(seconds)
+
+
+def get_rate_limiter(service: str, region: Optional[str],
+                     account_id: Optional[str] = None) -> RateLimiter:
+    """Get the limiter of a (service, region) endpoint of an account, shared across threads"""
+    key = (service, region, account_id)
+    limiter = _RATE_LIMITERS.get(key)
+    if limiter is None:
+        with _RATE_LIMITERS_LOCK:
+            limiter = _RATE_LIMITERS.get(key)
+            if limiter is None:
+                rate = max(1, _env_int('API_RATE_LIMIT', DEFAULT_API_RATE_LIMIT))
+                limiter = _RATE_LIMITERS[key] = RateLimiter(rate)
+    return limiter
+
+
+def get_error_code(error: Exception) -> Optional[str]:
+    """AWS error code of a botocore ClientError, None for other exceptions"""
+    from botocore.exceptions import ClientError
+    if isinstance(error, ClientError):
+        return error.response.get('Error', {}).get('Code')
+    return None
+
+
+def get_retry_kind(error: Exception) -> Optional[str]:
+    """'throttle' or 'transient' for errors worth retrying, None for the rest.
+
+    Mirrors botocore's standard retry mode, whose own retries are disabled
+    for the rate limited services: its throttling and transient error
+    codes, any 5xx response and connection errors are retried.
+    """
+    from botocore.exceptions import ClientError, ConnectionError, HTTPClientError
+    from botocore.retries.standard import ThrottledRetryableChecker, TransientRetryableChecker
+    if isinstance(error, (ConnectionError, HTTPClientError)):
+        return 'transient'
+    if not isinstance(error, ClientError):
+        return None
+    code = get_error_code(error)
+    if code in THROTTLING_ERROR_CODES or \
+            code in getattr(ThrottledRetryableChecker, '_THROTTLED_ERROR_CODES', ()):
+        return 'throttle'
+    status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 0
+    if code in TRANSIENT_ERROR_CODES or status >= 500 or \
+            code in getattr(TransientRetryableChecker, '_TRANSIENT_ERROR_CODES', ()):
+        return 'transient'
+    return None
+
+
+def get_account_session(account_id: str):
+    """Session holding the credentials of ORG_ROLE_NAME in a member account.
+
+    Sessions are cached until shortly before their credentials expire;
+    renewing one drops the clients built from the previous credentials.
+    """
+    cached = _ACCOUNT_SESSIONS.get(account_id)
+    if cached is not None and cached[1] - datetime.now(timezone.utc) > ASSUMED_ROLE_REFRESH_MARGIN:
+        return cached[0]
+
+    # The role is assumed outside the pool lock so accounts are set up concurrently
+    import boto3
+    sts_client = get_client('sts')
+    role_name = os.environ.get('ORG_ROLE_NAME', DEFAULT_ORG_ROLE_NAME)
+    credentials = sts_client.assume_role(
+        RoleArn=f"arn:aws:iam::{account_id}:role/{role_name}",
+        RoleSessionName='snapshot-inventory'
+    )['Credentials']
+    session = boto3.session.Session(
+        aws_access_key_id=credentials['AccessKeyId'],
+        aws_secret_access_key=credentials['SecretAccessKey'],
+        aws_session_token=credentials['SessionToken'],
+        region_name=get_session().region_name
+    )
+
+    with _CLIENT_POOL_LOCK:
+        _ACCOUNT_SESSIONS[account_id] = (session, credentials['Expiration'])
+        for key in [key for key in _CLIENT_POOL if key[2] == account_id]:
+            del _CLIENT_POOL[key]
+    return session
+
+
+def get_session():
+    """The Lambda function's own boto3 session, created on first use"""
+    global _SESSION
+    if _SESSION is None:
+        import boto3
+        with _CLIENT_POOL_LOCK:
+            if _SESSION is None:
+                _SESSION = boto3.session.Session()
+    return _SESSION
+
+
+def get_client(service: str, region: Optional[str] = None, account_id: Optional[str] = None):
+    """Get a pooled client for a service and region (home region if None).
+
+    account_id selects a member account reached through an assumed role;
+    None uses the Lambda function's own credentials. Clients are thread-safe
+    once built, but building them from a shared session is not, so
+    construction happens under the pool lock.
+    """
+    session = get_account_session(account_id) if account_id else None
+    key = (service, region, account_id)
+    client = _CLIENT_POOL.get(key)
+    if client is not None:
+        return client
+
+    from botocore.config import Config
+    if session is None:
+        session = get_session()
+    with _CLIENT_POOL_LOCK:
+        client = _CLIENT_POOL.get(key)
+        if client is None:
+            config = Config(max_pool_connections=max(
+                1, _env_int('BOTO_MAX_POOL_CONNECTIONS', DEFAULT_MAX_POOL_CONNECTIONS)))
+            if service in RATE_LIMITED_SERVICES:
+                config = config.merge(Config(retries={'total_max_attempts': 1}))
+            client = session.client(service, region_name=region, config=config)
+            _CLIENT_POOL[key] = client
+        return client
+
+
+def get_account_id(context=None) -> str:
+    """Get the account ID of the Lambda credentials, cached across invocations.
+
+    The account is read from the function ARN of the Lambda context when
+    there is one, which saves the cold start an STS round trip.
+    """
+    global _ACCOUNT_ID
+    if _ACCOUNT_ID is None:
+        arn = getattr(context, 'invoked_function_arn', None)
+        if isinstance(arn, str) and arn.count(':') >= 5:
+            _ACCOUNT_ID = arn.split(':')[4]
+        else:
+            _ACCOUNT_ID = get_client('sts').get_caller_identity()['Account']
+    return _ACCOUNT_ID
+
+
+def _reset_client_pool():
+    """Drop pooled clients, the sessions and the cached account ID"""
+    global _SESSION, _ACCOUNT_ID
+    with _CLIENT_POOL_LOCK:
+        _CLIENT_POOL.clear()
+        _SESSION = None
+        _ACCOUNT_ID = None
+        _ACCOUNT_SESSIONS.clear()
+    with _RATE_LIMITERS_LOCK:
+        _RATE_LIMITERS.clear()
+
+
+def merge_unit_results(earlier: List[Any], later: List[Any]) -> List[Any]:
+    """Combine the results of a unit scanned over several invocations.
+
+    Records are keyed and sorted by their ID (the first field), as the
+    collectors sort them.
+    """
+    merged = {record[0]: record for record in earlier}
+    merged.update((record[0], record) for record in later)
+    return sorted(merged.values(), key=lambda record: record[0])
+
+
+class ReorderBuffer:
+    """Releases results that complete in any order in the order of their keys.
+
+    A result is held only until every result ordered before it has been
+    released, so consumers see a stable order without waiting for the
+    whole scan. Used from a single thread.
+    """
+
+    def __init__(self, keys, release: Callable[[Any, Any], None]):
+        self.keys = list(keys)
+        self.release = release
+        self.position = 0
+        self.held: Dict[Any, Any] = {}
+
+    def put(self, key, value):
+        self.held[key] = value
+        while self.position < len(self.keys) and self.keys[self.position] in self.held:
+            key = self.keys[self.position]
+            self.position += 1
+            self.release(key, self.held.pop(key))
+
+
+def bytes_to_gb(size_bytes: float) -> float:
+    return round(size_bytes / (1024 * 1024 * 1024), 2)
+
+
+# Collector of each snapshot type, filled by @register_collector
+COLLECTOR_REGISTRY: Dict[str, 'Collector'] = {}
+
+
+def register_collector(cls):
+    """Class decorator adding a collector to the registry under its name"""
+    COLLECTOR_REGISTRY[cls.name] = cls()
+    return cls
+
+
+class Collector:
+    """How one snapshot type is listed in a region and mapped to SnapshotRecords.
+
+    Subclasses name the API operation and the fields of its items, and
+    override the hooks that differ. SnapshotInventory.collect drives every
+    collector the same way: pagination, rate limiting and retries, the
+    local state and age filters, and error accounting.
+    """
+    name = ''
+    description = ''
+    service = ''
+    operation = ''
+    result_key = ''
+    id_field = ''
+    time_field = ''
+    size_field = ''
+    # Field checked against the 'states' filter locally; None where the
+    # request filters states server-side
+    state_field: Optional[str] = None
+    # Field naming the volume or DB instance a snapshot was taken of
+    source_field: Optional[str] = None
+    # Smallest page size the operation accepts, used by activity probes
+    probe_page_size = 1
+
+    def request(self, inventory: 'SnapshotInventory', region: str) -> Dict[str, Any]:
+        """Keyword arguments of the listing call, e.g. server-side filters"""
+        return {}
+
+    def items(self, inventory: 'SnapshotInventory', region: str, **kwargs) -> Iterator[Dict[str, Any]]:
+        """Raw items of the region, fetched page by page"""
+        return inventory.paginate(self.service, self.operation, self.result_key, region, self.name,
+                                  inventory.collector_filters[self.name].get('page_size'), **kwargs)
+
+    def keep(self, inventory: 'SnapshotInventory', item: Dict[str, Any]) -> bool:
+        """Local filter for what neither the request nor the generic filters cover"""
+        return True
+
+    def start_time(self, item: Dict[str, Any]) -> datetime:
+        return item[self.time_field]
+
+    def size(self, item: Dict[str, Any]) -> float:
+        """Size in GB"""
+        return item[self.size_field]
+
+    def finish(self, inventory: 'SnapshotInventory', region: str,
+               records: List[SnapshotRecord]) -> List[SnapshotRecord]:
+        """Post-process the records of a region once it is fully listed"""
+        return records
+
+    def probe(self, inventory: 'SnapshotInventory', region: str) -> bool:
+        """Whether a single smallest page finds anything in the region"""
+        kwargs = self.request(inventory, region)
+        kwargs[PAGINATION_TOKENS[self.operation][2]] = self.probe_page_size
+        return bool(inventory.probe_page(self.service, region, self.operation, self.result_key, **kwargs))
+
+
+@register_collector
+class EBSSnapshotCollector(Collector):
+    name = 'EBS'
+    description = 'EBS snapshots'
+    service = 'ec2'
+    operation = 'describe_snapshots'
+    result_key = 'Snapshots'
+    id_field = 'SnapshotId'
+    time_field = 'StartTime'
+    size_field = 'VolumeSize'
+    source_field = 'VolumeId'
+    probe_page_size = 5
+
+    def request(self, inventory, region):
+        # describe_snapshots has no time filter, so the cutoff is applied locally
+        kwargs: Dict[str, Any] = {'OwnerIds': [inventory.account_id]}
+        states = inventory.collector_filters[self.name].get('states')
+        if states:
+            kwargs['Filters'] = [{'Name': 'status', 'Values': states}]
+        return kwargs
+
+    def items(self, inventory, region, **kwargs):
+        if not inventory.billed_sizes:
+            yield from super().items(inventory, region, **kwargs)
+            return
+
+        # Measuring needs every completed snapshot of a volume, including
+        # those the age filters leave out of the report, to find parents;
+        # archived snapshots cannot be read with the EBS direct APIs
+        lineage = inventory.ebs_lineage[region] = {}
+        for item in super().items(inventory, region, **kwargs):
+            if item.get('State', 'completed') == 'completed' and item.get('StorageTier', 'standard') == 'standard':
+                lineage[item['SnapshotId']] = (item.get('VolumeId', EBS_NO_VOLUME_ID), item['StartTime'])
+            yield item
+
+    def finish(self, inventory, region, records):
+        lineage = inventory.ebs_lineage.pop(region, None)
+        if lineage is None:
+            return records
+        return inventory.enrich_billed_sizes(region, records, lineage)
+
+
+@register_collector
+class RDSSnapshotCollector(Collector):
+    # describe_db_snapshots filters neither status nor time server-side
+    name = 'RDS'
+    description = 'RDS snapshots'
+    service = 'rds'
+    operation = 'describe_db_snapshots'
+    result_key = 'DBSnapshots'
+    id_field = 'DBSnapshotIdentifier'
+    time_field = 'SnapshotCreateTime'
+    size_field = 'AllocatedStorage'
+    state_field = 'Status'
+    source_field = 'DBInstanceIdentifier'
+    probe_page_size = 20
+
+
+@register_collector
+class EFSBackupCollector(Collector):
+    name = 'EFS'
+    description = 'EFS backups'
+    service = 'backup'
+    operation = 'list_backup_jobs'
+    result_key = 'BackupJobs'
+    id_field = 'BackupJobId'
+    time_field = 'CreationDate'
+    state_field = 'State'
+
+    def request(self, inventory, region):
+        states = inventory.collector_filters[self.name].get('states')
+        created_after = inventory.get_created_after(self.name)
+
+        # An incremental scan only fetches jobs created since the last run
+        state = inventory.region_states.get(region)
+        if state:
+            since = state['watermark'] - INCREMENTAL_OVERLAP
+            created_after = max(created_after, since) if created_after else since
+
+        # ByState takes a single state; several states are filtered locally
+        kwargs: Dict[str, Any] = {'ByResourceType': 'EFS'}
+        if states and len(states) == 1:
+            kwargs['ByState'] = states[0]
+        if created_after:
+            kwargs['ByCreatedAfter'] = created_after
+        return kwargs
+
+    def size(self, item):
+        return bytes_to_gb(item.get('BackupSizeInBytes', 0))
+
+    def finish(self, inventory, region, records):
+        state = inventory.region_states.get(region)
+        if state:
+            return inventory.merge_stored_snapshots(state, self.name, records)
+        return records
+
+
+@register_collector
+class AuroraSnapshotCollector(Collector):
+    # Cluster snapshots are not returned by describe_db_snapshots
+    name = 'AURORA'
+    description = 'Aurora cluster snapshots'
+    service = 'rds'
+    operation = 'describe_db_cluster_snapshots'
+    result_key = 'DBClusterSnapshots'
+    id_field = 'DBClusterSnapshotIdentifier'
+    time_field = 'SnapshotCreateTime'
+    size_field = 'AllocatedStorage'
+    state_field = 'Status'
+    probe_page_size = 20
+
+
+@register_collector
+class DynamoDBBackupCollector(Collector):
+    name = 'DYNAMODB'
+    description = 'DynamoDB backups'
+    service = 'dynamodb'
+    operation = 'list_backups'
+    result_key = 'BackupSummaries'
+    id_field = 'BackupArn'
+    time_field = 'BackupCreationDateTime'
+    state_field = 'BackupStatus'
+
+    def request(self, inventory, region):
+        # Only on-demand backups made by the user are listed by default
+        kwargs: Dict[str, Any] = {'BackupType': 'ALL'}
+        created_after = inventory.get_created_after(self.name)
+        if created_after:
+            kwargs['TimeRangeLowerBound'] = created_after
+        return kwargs
+
+    def size(self, item):
+        return bytes_to_gb(item.get('BackupSizeBytes', 0))
+
+
+@register_collector
+class FSxBackupCollector(Collector):
+    name = 'FSX'
+    description = 'FSx backups'
+    service = 'fsx'
+    operation = 'describe_backups'
+    result_key = 'Backups'
+    id_field = 'BackupId'
+    time_field = 'CreationTime'
+    state_field = 'Lifecycle'
+
+    def size(self, item):
+        # FSx does not report backup sizes; the file system's storage
+        # capacity is the closest upper bound
+        return item.get('FileSystem', {}).get('StorageCapacity', 0)
+
+
+@register_collector
+class AMICollector(Collector):
+    name = 'AMI'
+    description = 'EBS-backed AMIs'
+    service = 'ec2'
+    operation = 'describe_images'
+    result_key = 'Images'
+    id_field = 'ImageId'
+    time_field = 'CreationDate'
+    probe_page_size = 5
+
+    def request(self, inventory, region):
+        filters = [{'Name': 'root-device-type', 'Values': ['ebs']}]
+        states = inventory.collector_filters[self.name].get('states')
+        if states:
+            filters.append({'Name': 'state', 'Values': states})
+        return {'Owners': ['self'], 'Filters': filters}
+
+    def start_time(self, item):
+        # CreationDate is an ISO 8601 string, unlike the other APIs' datetimes
+        return datetime.fromisoformat(item['CreationDate'].replace('Z', '+00:00'))
+
+    def size(self, item):
+        return sum(mapping['Ebs'].get('VolumeSize', 0)
+                   for mapping in item.get('BlockDeviceMappings', []) if 'Ebs' in mapping)
+
+
+@register_collector
+class BackupRecoveryPointCollector(Collector):
+    name = 'BACKUP'
+    description = 'AWS Backup recovery points'
+    service = 'backup'
+    operation = 'list_recovery_points_by_backup_vault'
+    result_key = 'RecoveryPoints'
+    id_field = 'RecoveryPointArn'
+    time_field = 'CreationDate'
+    state_field = 'Status'
+
+    # AWS Backup resource types whose recovery points a dedicated collector
+    # already reports when it is enabled
+    COVERED_RESOURCE_TYPES = {'EBS': 'EBS', 'RDS': 'RDS', 'Aurora': 'AURORA', 'EFS': 'EFS',
+                              'DynamoDB': 'DYNAMODB', 'FSx': 'FSX', 'EC2': 'AMI'}
+
+    def request(self, inventory, region):
+        created_after = inventory.get_created_after(self.name)
+        return {'ByCreatedAfter': created_after} if created_after else {}
+
+    def items(self, inventory, region, **kwargs):
+        # A page token is only valid within its vault, so this unit can be
+        # deferred whole but not cut short and resumed
+        page_size = inventory.collector_filters[self.name].get('page_size')
+        for vault in inventory.paginate('backup', 'list_backup_vaults', 'BackupVaultList', region,
+                                        self.name, page_size, resumable=False):
+            yield from inventory.paginate(self.service, self.operation, self.result_key, region,
+                                          self.name, page_size, resumable=False,
+                                          BackupVaultName=vault['BackupVaultName'], **kwargs)
+
+    def keep(self, inventory, item):
+        return self.COVERED_RESOURCE_TYPES.get(item.get('ResourceType')) not in inventory.collectors
+
+    def size(self, item):
+        return bytes_to_gb(item.get('BackupSizeInBytes', 0))
+
+    def probe(self, inventory, region):
+        vaults = inventory.probe_page('backup', region, 'list_backup_vaults', 'BackupVaultList')
+        return any(vault.get('NumberOfRecoveryPoints') for vault in vaults)
+
+
+def load_collectors() -> List[str]:
+    """Snapshot types enabled with COLLECTORS, in report order"""
+    names = {name.upper() for name in _env_list('COLLECTORS')} or set(DEFAULT_COLLECTORS)
+    unknown = names - set(COLLECTOR_REGISTRY)
+    if unknown:
+        print(f"Ignoring unknown COLLECTORS: {', '.join(sorted(unknown))}")
+    return [name for name in SNAPSHOT_COLLECTORS if name in names]
+
+
+class SnapshotInventory:
+    def __init__(self, account_id: Optional[str] = None, context=None):
+        # Clients are built on first use, so a run only pays for the
+        # services it calls
+        self.account_id = account_id or get_account_id(context)
+
+        # Collectors of a member account scanned by an organization scan use
+        # the assumed role; reports and state still go to this account's bucket
+        self.member_account = account_id
                
         # Get environment variables
         self.s3_bucket = os.environ['S3_BUCKET_NAME']
         self.sns_topic_arn = os.environ['SNS_TOPIC_ARN']
         self.email_subject = os.environ.get('EMAIL_SUBJECT', 'AWS Snapshot Inventory Report')  # Default title if not set
+        self.output_format = os.environ.get('OUTPUT_FORMAT', 'csv').lower()
+        if self.output_format not in OUTPUT_FORMATS:
+            print(f"Unknown OUTPUT_FORMAT {self.output_format!r}, using csv")
+            self.output_format = 'csv'
+        self.parquet_compression = os.environ.get('PARQUET_COMPRESSION', DEFAULT_PARQUET_COMPRESSION)
+        self.csv_gzip = _env_bool('CSV_GZIP')
+        self.upload_part_size = _env_int('UPLOAD_PART_SIZE_MB', DEFAULT_UPLOAD_PART_SIZE_MB) * 1024 * 1024
+        self.max_workers = max(1, _env_int('SCAN_MAX_WORKERS', DEFAULT_SCAN_MAX_WORKERS))
+        self.collector_filters = load_collector_filters()
+        self.collectors = load_collectors()
+        self.stats = ScanStats()
+        self.max_retries = max(0, _env_int('API_MAX_RETRIES', DEFAULT_API_MAX_RETRIES))
+        self.retry_base_delay = float(os.environ.get('API_RETRY_BASE_DELAY', DEFAULT_API_RETRY_BASE_DELAY))
+        self.org_mode = _env_bool('ORG_MODE')
+
+        # Incremental mode reuses per-region state persisted by earlier runs;
+        # full_scan ignores that state for one run but still refreshes it
+        self.incremental = _env_bool('INCREMENTAL_MODE')
+        self.full_scan = False
+        self.scan_started_at = datetime.now(timezone.utc)
+
+        # Every item of the run is aged against the same reference clock
+        self.age_bucketer = load_age_bucketer(self.scan_started_at)
+        self.region_states: Dict[str, Dict[str, Any]] = {}
+
+        # Region discovery is memoized for the whole invocation
+        self._regions: Optional[List[str]] = None
+
+        # With the activity map only active regions are scanned every run;
+        # dormant ones are probed every probe interval and rescanned once
+        # the probe finds something
+        self.adaptive_regions = _env_bool('REGION_ACTIVITY_MAP')
+        self.probe_interval = timedelta(days=_env_int('DORMANT_PROBE_INTERVAL_DAYS',
+                                                      DEFAULT_DORMANT_PROBE_INTERVAL_DAYS))
+        self.region_activity: Dict[str, Dict[str, Any]] = {}
+        self.skipped_regions: List[str] = []
+        self._scan_regions: Optional[List[str]] = None
+
+        # Each run diffs its snapshots against the index the previous run left
+        self.delta_report = _env_bool('DELTA_REPORT', True)
+
+        # Each run adds its summary cells to a daily rollup, the source of the
+        # email's growth figures and of trend queries
+        self.trend_rollup = _env_bool('TREND_ROLLUP', True)
+        self.rollup_retention = max(1, _env_int('ROLLUP_RETENTION_DAYS', DEFAULT_ROLLUP_RETENTION_DAYS))
+
+        # With BILLED_SIZE, EBS snapshots also get the size of the data they
+        # add to their volume's lineage, measured within a per-run budget.
+        # The lineage of each region's snapshots is kept until they are measured
+        self.billed_sizes = _env_bool('BILLED_SIZE')
+        self.billed_budget = WorkBudget(_env_int('BILLED_SIZE_MAX_SNAPSHOTS',
+                                                 DEFAULT_BILLED_SIZE_MAX_SNAPSHOTS))
+        self.ebs_lineage: Dict[str, Dict[str, Tuple[str, datetime]]] = {}
+
+        # describe_volumes has no detach time, so the idle time of unattached
+        # volumes comes from their last I/O in CloudWatch, optionally from
+        # their DetachVolume events in CloudTrail; volumes looked up once are
+        # cached until they are attached again
+        self.idle_detection = _env_bool('IDLE_DETECTION', True)
+        self.idle_cloudtrail = _env_bool('IDLE_CLOUDTRAIL_FALLBACK')
+        self.idle_lookback = timedelta(days=max(1, _env_int('IDLE_LOOKBACK_DAYS', DEFAULT_IDLE_LOOKBACK_DAYS)))
+
+        # With SNAPSHOT_LINEAGE, EBS and RDS snapshots are classified against
+        # one listing each of the region's volumes, AMIs and DB instances
+        self.lineage = _env_bool('SNAPSHOT_LINEAGE')
+
+        # Time budget of the invocation and the (region, collector) units of
+        # a scan that is split over several invocations: finished units with
+        # the S3 key their results were spilled to (None while they are held
+        # in memory or have none), partial results and page tokens of units
+        # still to finish
+        self.context = None
+        self.time_reserve_ms = 1000 * _env_int('TIME_BUDGET_RESERVE_SECONDS',
+                                               DEFAULT_TIME_BUDGET_RESERVE_SECONDS)
+        self.max_continuations = _env_int('MAX_CONTINUATIONS', DEFAULT_MAX_CONTINUATIONS)
+        # 0 holds every finished unit until the handoff
+        self.checkpoint_buffer_records = max(0, _env_int('CHECKPOINT_BUFFER_RECORDS',
+                                                         DEFAULT_CHECKPOINT_BUFFER_RECORDS))
+        self.completed_units: Dict[Tuple[str, str], Optional[str]] = {}
+        self.held_units: Dict[Tuple[str, str], List[Any]] = {}
+        self._held_records = 0
+        self._spills = 0
+        self._spilled: Dict[str, Dict[Tuple[str, str], List[Any]]] = {}
+        self._units_lock = threading.Lock()
+        self.partial_results: Dict[Tuple[str, str], List[Any]] = {}
+        self.pending_units: Dict[Tuple[str, str], Optional[str]] = {}
+        self.resume_tokens: Dict[Tuple[str, str], str] = {}
+
+        # An organization scan keeps the units of each member account in
+        # that account's inventory; a continuation restores them from the
+        # checkpoint's states
+        self.member_inventories: Dict[str, 'SnapshotInventory'] = {}
+        self.member_states: Optional[Dict[str, Dict[str, Any]]] = None
         
+    @property
+    def s3_client(self):
+        return get_client('s3')
+
+    @property
+    def sns_client(self):
+        return get_client('sns')
+
     def get_snapshot_age(self, start_time) -> int:
         """Calculate snapshot age in days"""
-        now = datetime.now(timezone.utc)
-        age = now - start_time
-        return age.days
+        return self.age_bucketer.age(start_time)
 
     def get_age_group(self, age: int) -> str:
         """Determine age group for snapshot"""
-        if age <= 7: return "7 days"
-        elif age <= 15: return "15 days"
-        elif age <= 30: return "30 days"
-        elif age <= 90: return "90 days"
-        elif age <= 180: return "180 days"
-        elif age <= 365: return "365 days"
-        elif age <= 730: return "730 days"
-        else: return "> 730 days"
-
-    def get_all_snapshots(self) -> List[Dict[str, Any]]:
-        snapshots = []
-        
-        # Get EBS snapshots
+        return self.age_bucketer.group(age)
+
+    def get_home_region(self) -> str:
+        """Region of the Lambda function's own clients"""
+        return get_session().region_name
+
+    def get_all_snapshots(self) -> List[SnapshotRecord]:
+        """Get snapshots from the home region"""
+        return self.get_snapshots_for_region(self.get_home_region())
+
+    def get_unattached_volumes(self) -> List[VolumeRecord]:
+        """Get all unattached EBS volumes and their idle time in the home region"""
+        unattached_volumes = self.get_unattached_volumes_for_region(self.get_home_region())
+
+        # Sort by idle days in descending order
+        unattached_volumes.sort(key=lambda x: x.IdleDays, reverse=True)
+        return unattached_volumes
+
+    def summarize(self, snapshots: List[SnapshotRecord],
+                  unattached_volumes: List[VolumeRecord],
+                  delta: Optional[Dict[str, Any]] = None) -> InventorySummary:
+        """Aggregate snapshots and volumes into a structured summary"""
+        aggregator = SummaryAggregator(self.age_bucketer.labels)
+        aggregator.add_snapshots(snapshots)
+        aggregator.add_volumes(unattached_volumes)
+        return self.finish_summary(aggregator, delta)
+
+    def finish_summary(self, aggregator: SummaryAggregator,
+                       delta: Optional[Dict[str, Any]] = None,
+                       growth: Optional[Dict[str, Any]] = None) -> InventorySummary:
+        """Summary of records already fed to an aggregator, e.g. while scanning"""
+        summary = aggregator.result(self.account_id, datetime.now(), self.stats.to_dict())
+        summary.skipped_regions = list(self.skipped_regions)
+        summary.delta = delta
+        summary.growth = growth
+        return summary
+
+    def generate_summary(self, snapshots: List[SnapshotRecord],
+                         unattached_volumes: Optional[List[VolumeRecord]] = None,
+                         delta: Optional[Dict[str, Any]] = None) -> str:
+        # Use the volumes collected by the region scan when they are provided
+        if unattached_volumes is None:
+            unattached_volumes = self.get_all_regions_unattached_volumes()
+
+        return self.format_summary(self.summarize(snapshots, unattached_volumes, delta))
+
+    def format_summary(self, summary: InventorySummary, format: str = 'text',
+                       budget: Optional[int] = None,
+                       measure: Optional[Callable[[str], int]] = None) -> str:
+        """Render a summary as the plain text email body, or as HTML or JSON"""
+        return SummaryRenderer(budget, measure).render(summary, format)
+
+    def open_report_writer(self, key: str) -> S3MultipartWriter:
+        """Open a streaming upload of a report to the S3 bucket"""
+        return S3MultipartWriter(self.s3_client, self.s3_bucket, key,
+                                 gzip=self.csv_gzip, part_size=self.upload_part_size)
+
+    def open_csv_sink(self, key: str, fieldnames: List[str]) -> CsvReportSink:
+        """Start a CSV report fed chunk by chunk"""
+        return CsvReportSink(self.stats, self.open_report_writer(key), fieldnames)
+
+    def open_parquet_sink(self, key: str, column_types: Dict[str, str]) -> ParquetReportSink:
+        """Start a compressed Parquet report fed chunk by chunk"""
+        # Parquet pages are compressed already, so the stream is never gzipped
+        stream = S3MultipartWriter(self.s3_client, self.s3_bucket, key, part_size=self.upload_part_size,
+                                   content_type='application/vnd.apache.parquet')
+        return ParquetReportSink(self.stats, stream, column_types, self.parquet_compression)
+
+    def write_report(self, sink: ReportSink, records) -> int:
+        """Write all records to a report sink at once, returning the bytes uploaded"""
         try:
-            paginator = self.ec2_client.get_paginator('describe_snapshots')
-            for page in paginator.paginate(OwnerIds=[self.account_id]):
-                for snapshot in page['Snapshots']:
-                    age = self.get_snapshot_age(snapshot['StartTime'])
-                    snapshots.append({
-                        'Id': snapshot['SnapshotId'],
-                        'Type': 'EBS',
-                        'StartTime': snapshot['StartTime'].isoformat(),
-                        'Size': snapshot['VolumeSize'],
-                        'Age': age,
-                        'AgeGroup': self.get_age_group(age)
-                    })
-        except Exception as e:
-            print(f"Error getting EBS snapshots: {str(e)}")
+            sink.add(records)
+        except Exception:
+            sink.abort(failed=True)
+            raise
+        return sink.close()
+
+    def write_csv_report(self, key: str, fieldnames: List[str], records) -> int:
+        """Stream records as CSV straight into S3, returning the bytes uploaded"""
+        return self.write_report(self.open_csv_sink(key, fieldnames), records)
+
+    def write_parquet_report(self, key: str, column_types: Dict[str, str],
+                             records: List[tuple]) -> int:
+        """Stream records as compressed Parquet straight into S3, returning the bytes uploaded"""
+        return self.write_report(self.open_parquet_sink(key, column_types), records)
+
+    def get_parquet_key(self, dataset: str, run_time: datetime, timestamp: str) -> str:
+        """Hive-style partitioned key of a Parquet report, e.g. for Athena"""
+        return (f"{dataset}/account={self.account_id}/date={run_time.strftime('%Y-%m-%d')}/"
+                f"{dataset}_{self.account_id}_{timestamp}.parquet")
+
+    def get_all_regions(self) -> List[str]:
+        """Get sorted list of the enabled AWS regions to scan, discovered once per invocation"""
+        if self._regions is not None:
+            return self._regions
 
-        # Get RDS snapshots
         try:
-            paginator = self.rds_client.get_paginator('describe_db_snapshots')
-            for page in paginator.paginate():
-                for snapshot in page['DBSnapshots']:
-                    age = self.get_snapshot_age(snapshot['SnapshotCreateTime'])
-                    snapshots.append({
-                        'Id': snapshot['DBSnapshotIdentifier'],
-                        'Type': 'RDS',
-                        'StartTime': snapshot['SnapshotCreateTime'].isoformat(),
-                        'Size': snapshot['AllocatedStorage'],
-                        'Age': age,
-                        'AgeGroup': self.get_age_group(age)
-                    })
+            # The home region's client is the one the scan reuses there
+            response = self.call_api('ec2', self.get_home_region(), 'describe_regions', 'REGIONS')
+            regions = {region['RegionName'] for region in response['Regions']}
         except Exception as e:
-            print(f"Error getting RDS snapshots: {str(e)}")
+            # Without its regions nothing of the account is scanned, so the
+            # delta and rollup carry all of it over rather than dropping it
+            print(f"Error getting regions: {str(e)}")
+            self.stats.record_error('global', 'REGIONS')
+            self.stats.record_failed_account(self.account_id)
+            return []
+
+        # REGION_ALLOWLIST narrows the scan to the listed enabled regions,
+        # REGION_DENYLIST excludes regions from it
+        allowlist = _env_list('REGION_ALLOWLIST')
+        if allowlist:
+            regions &= set(allowlist)
+        regions -= set(_env_list('REGION_DENYLIST'))
+        self._regions = sorted(regions)
+        return self._regions
+
+    def get_regional_client(self, service: str, region: str):
+        """Get the pooled client for a service in a specific region"""
+        return get_client(service, region)
+
+    def run_parallel(self, tasks: List[Tuple[str, Callable, tuple]],
+                     on_result: Optional[Callable[[int, Any], None]] = None) -> List[Any]:
+        """Run (label, func, args) tasks on a bounded thread pool.
+
+        Results are returned in task order regardless of completion order.
+        A failing task is logged and contributes an empty list, so one
+        region or service cannot abort the rest of the scan. With on_result
+        each (task index, result) is handed over in the calling thread as
+        soon as it completes instead, and not kept.
+        """
+        results: List[Any] = [[] for _ in tasks]
+        if not tasks:
+            return results
+
+        workers = min(self.max_workers, len(tasks))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(func, *args): index
+                       for index, (_, func, args) in enumerate(tasks)}
+            for future in as_completed(futures):
+                index = futures.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"Error in {tasks[index][0]}: {str(e)}")
+                    result = []
+                if on_result is None:
+                    results[index] = result
+                else:
+                    on_result(index, result)
+        return results
+
+    def call_api(self, service: str, region: Optional[str], operation: str,
+                 collector: str, **kwargs) -> Dict[str, Any]:
+        """Call an API through the endpoint's rate limiter, retrying throttles.
+
+        Throttling, transient and connection errors are retried with
+        full-jitter exponential backoff up to max_retries times; other
+        errors are raised.
+        """
+        client = get_client(service, region, self.member_account)
+        limiter = get_rate_limiter(service, region, self.member_account)
+        attempt = 0
+        while True:
+            limiter.acquire()
+            try:
+                response = getattr(client, operation)(**kwargs)
+            except Exception as e:
+                kind = get_retry_kind(e)
+                throttled = kind == 'throttle'
+                if kind is None or attempt >= self.max_retries:
+                    raise
+                if throttled:
+                    limiter.on_throttle()
+                self.stats.record_retry(region or 'global', collector, throttled)
+                delay = min(API_RETRY_MAX_DELAY, self.retry_base_delay * 2 ** attempt)
+                _sleep(random.uniform(0, delay))
+                attempt += 1
+                continue
+            limiter.on_success()
+            return response
+
+    def paginate(self, service: str, operation: str, result_key: str, region: Optional[str],
+                 collector: str, page_size: Optional[int] = None, resumable: bool = True, **kwargs):
+        """Yield items of a paginated API call, counting pages and items fetched.
 
-        # Get EFS backups using AWS Backup
+        Pages are requested one at a time with the previous page's token, so
+        a throttled page is retried on its own instead of restarting. A
+        resumable listing stops early when the time budget runs out and
+        leaves its token to the continuation.
+        """
+        input_token, output_token, limit_key = PAGINATION_TOKENS[operation]
+        if page_size:
+            kwargs[limit_key] = page_size
+
+        # A unit cut short by an earlier invocation resumes from its token
+        unit = (region, collector)
+        token = self.resume_tokens.pop(unit, None) if resumable else None
+        if token:
+            kwargs[input_token] = token
+        while True:
+            page = self.call_api(service, region, operation, collector, **kwargs)
+            items = page.get(result_key, [])
+            self.stats.record_page(region or 'global', collector, len(items))
+            yield from items
+            token = page.get(output_token)
+            if not token:
+                return
+            if resumable and self.out_of_time():
+                self.pending_units[unit] = token
+                return
+            kwargs[input_token] = token
+
+    def get_created_after(self, rtype: str) -> Optional[datetime]:
+        """Cutoff before which items of a resource type are not collected"""
+        days = self.collector_filters[rtype].get('created_after_days')
+        if days is None:
+            return None
+        return self.scan_started_at - timedelta(days=days)
+
+    def collect(self, stype: str, region: str) -> Iterator[SnapshotRecord]:
+        """Yield the records of one snapshot type in a region as its pages arrive"""
+        collector = COLLECTOR_REGISTRY[stype]
+        states = collector.state_field and self.collector_filters[stype].get('states')
+        created_after = self.get_created_after(stype)
+        source_field = collector.source_field
+        for item in collector.items(self, region, **collector.request(self, region)):
+            if states and item.get(collector.state_field) not in states:
+                continue
+            start_time = collector.start_time(item)
+            if created_after and start_time < created_after:
+                continue
+            if not collector.keep(self, item):
+                continue
+            age = self.get_snapshot_age(start_time)
+            yield SnapshotRecord(item[collector.id_field], stype, region, start_time,
+                                 collector.size(item), age, self.get_age_group(age), self.account_id,
+                                 SourceId=item.get(source_field, '') if source_field else '')
+
+    def collect_unit(self, stype: str, region: str) -> List[SnapshotRecord]:
+        """All records of one snapshot type in a region, sorted by ID.
+
+        A failing listing is logged and counted, keeping what it had
+        yielded so far.
+        """
+        collector = COLLECTOR_REGISTRY[stype]
+        snapshots: List[SnapshotRecord] = []
         try:
-            paginator = self.backup_client.get_paginator('list_backup_jobs')
-            for page in paginator.paginate(ByResourceType='EFS'):
-                for backup in page['BackupJobs']:
-                    if backup['State'] == 'COMPLETED':
-                        age = self.get_snapshot_age(backup['CreationDate'])
-                        # Convert bytes to GB, handle cases where BackupSizeInBytes might not exist
-                        size_gb = backup.get('BackupSizeInBytes', 0) / (1024 * 1024 * 1024)
-                        snapshots.append({
-                            'Id': backup['BackupJobId'],
-                            'Type': 'EFS',
-                            'StartTime': backup['CreationDate'].isoformat(),
-                            'Size': round(size_gb, 2),
-                            'Age': age,
-                            'AgeGroup': self.get_age_group(age)
-                        })
+            snapshots.extend(self.collect(stype, region))
         except Exception as e:
-            print(f"Error getting EFS backups: {str(e)}")
+            print(f"Error getting {collector.description} in {region}: {str(e)}")
+            self.stats.record_error(region, stype, self.account_id)
 
+        snapshots = collector.finish(self, region, snapshots)
+        if self.lineage and stype in LINEAGE_SOURCES:
+            snapshots = self.classify_lineage(stype, region, snapshots)
+        snapshots.sort(key=lambda x: x.Id)
         return snapshots
 
-    def get_unattached_volumes(self) -> List[Dict[str, Any]]:
-        """Get all unattached EBS volumes and their idle time"""
-        unattached_volumes = []
-        
+    def get_ebs_snapshots_for_region(self, region: str) -> List[SnapshotRecord]:
+        """Get EBS snapshots owned by the account in a specific region"""
+        return self.collect_unit('EBS', region)
+
+    def get_rds_snapshots_for_region(self, region: str) -> List[SnapshotRecord]:
+        """Get RDS snapshots in a specific region"""
+        return self.collect_unit('RDS', region)
+
+    def get_efs_backups_for_region(self, region: str) -> List[SnapshotRecord]:
+        """Get completed EFS backups from AWS Backup in a specific region"""
+        return self.collect_unit('EFS', region)
+
+    def merge_stored_snapshots(self, state: Dict[str, Any], stype: str,
+                               snapshots: List[SnapshotRecord]) -> List[SnapshotRecord]:
+        """Combine newly fetched snapshots with those known from the stored state"""
+        cutoff = self.scan_started_at - timedelta(days=BACKUP_JOB_HISTORY_DAYS)
+        created_after = self.get_created_after(stype)
+        if created_after:
+            cutoff = max(cutoff, created_after)
+
+        merged = {}
+        for snapshot in state['snapshots'].values():
+            if snapshot.Type == stype and snapshot.StartTime >= cutoff:
+                merged[snapshot.Id] = snapshot
+        for snapshot in snapshots:
+            merged[snapshot.Id] = snapshot
+        return list(merged.values())
+
+    def get_state_key(self, region: str) -> str:
+        """S3 key of the incremental scan state of a region"""
+        return f"{STATE_PREFIX}/{self.account_id}/{region}.json"
+
+    def load_region_state(self, region: str) -> Optional[Dict[str, Any]]:
+        """Load the stored state of a region, recomputing ages from StartTime"""
         try:
-            paginator = self.ec2_client.get_paginator('describe_volumes')
-            for page in paginator.paginate():
-                for volume in page['Volumes']:
-                    # Check if volume has no attachments
-                    if not volume['Attachments']:
-                        # Calculate days since last attachment using State.Transition time if available
-                        idle_days = 0
-                        if 'StateTransitionTime' in volume:
-                            idle_days = self.get_snapshot_age(volume['StateTransitionTime'])
-                        
-                        unattached_volumes.append({
-                            'VolumeId': volume['VolumeId'],
-                            'Size': volume['Size'],
-                            'State': volume['State'],
-                            'IdleDays': idle_days,
-                            'VolumeType': volume['VolumeType'],
-                            'CreateTime': volume['CreateTime'].isoformat()
-                        })
+            response = self.s3_client.get_object(Bucket=self.s3_bucket, Key=self.get_state_key(region))
+            stored = json.loads(response['Body'].read())
         except Exception as e:
-            print(f"Error getting unattached volumes: {str(e)}")
-        
-        # Sort by idle days in descending order
-        unattached_volumes.sort(key=lambda x: x['IdleDays'], reverse=True)
-        return unattached_volumes
+            # A missing state object simply means a full scan of the region
+            if getattr(e, 'response', {}).get('Error', {}).get('Code') != 'NoSuchKey':
+                print(f"Error loading scan state for {region}: {str(e)}")
+            return None
 
-    def generate_summary(self, snapshots: List[Dict[str, Any]]) -> str:
-        # Get unattached volumes
-        unattached_volumes = self.get_unattached_volumes()
-        
-        # Calculate summary statistics
-        summary = {
-            'total_count': len(snapshots),
-            'by_region': {},
-            'by_type': {},
-            'by_age_group': {}
+        if stored.get('version') != STATE_VERSION:
+            return None
+
+        snapshots = {}
+        for snapshot_id, stype, start_time, size in stored['snapshots']:
+            start_time = datetime.fromisoformat(start_time)
+            age = self.get_snapshot_age(start_time)
+            snapshots[snapshot_id] = SnapshotRecord(
+                snapshot_id, stype, region, start_time, size, age, self.get_age_group(age),
+                self.account_id)
+        return {'watermark': datetime.fromisoformat(stored['watermark']), 'snapshots': snapshots}
+
+    def save_region_state(self, region: str, snapshots: List[SnapshotRecord]):
+        """Persist the watermark and snapshot index of a region"""
+        state = {
+            'version': STATE_VERSION,
+            'watermark': self.scan_started_at.isoformat(),
+            'snapshots': [[s.Id, s.Type, s.StartTime.isoformat(), s.Size]
+                          for s in snapshots if s.Type in INCREMENTAL_COLLECTORS]
         }
-        
-        # Calculate breakdown by region and type
-        # Sort snapshots by age in descending order
-        snapshots.sort(key=lambda x: x['Age'], reverse=True)
+        self.s3_client.put_object(
+            Bucket=self.s3_bucket,
+            Key=self.get_state_key(region),
+            Body=json.dumps(state, separators=(',', ':'))
+        )
+
+    def load_region_states(self, regions: List[str]):
+        """Load stored state of every region before an incremental scan"""
+        tasks = [(f"scan state of {region}", self.load_region_state, (region,)) for region in regions]
+        for region, state in zip(regions, self.run_parallel(tasks)):
+            if state:
+                self.region_states[region] = state
+        print(f"Incremental scan: stored state found for {len(self.region_states)} of {len(regions)} regions")
+
+    def save_region_states(self, regions: List[str], snapshots: List[SnapshotRecord]):
+        """Persist state of regions whose incremental collectors all succeeded"""
+        by_region: Dict[str, List[SnapshotRecord]] = {region: [] for region in regions}
         for snapshot in snapshots:
-            region = snapshot.get('Region', 'unknown')
-            stype = snapshot['Type']
-            
-            # Initialize region if not exists
-            if region not in summary['by_region']:
-                summary['by_region'][region] = {
-                    'count': 0,
-                    'size': 0,
-                    'by_type': {}
-                }
-            
-            # Update region totals
-            summary['by_region'][region]['count'] += 1
-            summary['by_region'][region]['size'] += snapshot['Size']
-            
-            # Update region type breakdown
-            if stype not in summary['by_region'][region]['by_type']:
-                summary['by_region'][region]['by_type'][stype] = {
-                    'count': 0, 'size': 0
-                }
-            summary['by_region'][region]['by_type'][stype]['count'] += 1
-            summary['by_region'][region]['by_type'][stype]['size'] += snapshot['Size']
-            
-            # Update global type totals
-            if stype not in summary['by_type']:
-                summary['by_type'][stype] = {'count': 0, 'size': 0}
-            summary['by_type'][stype]['count'] += 1
-            summary['by_type'][stype]['size'] += snapshot['Size']
-            
-            # Update age group totals
-            age_group = snapshot['AgeGroup']
-            if age_group not in summary['by_age_group']:
-                summary['by_age_group'][age_group] = {'count': 0, 'size': 0}
-            summary['by_age_group'][age_group]['count'] += 1
-            summary['by_age_group'][age_group]['size'] += snapshot['Size']
-
-        # Generate email content
-        email_content = f"""Snapshot Inventory Summary for Account {self.account_id}
-    Generated on: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
-
-    Total Snapshots: {summary['total_count']}
-
-    Regional Breakdown:
-    {'-' * 40}"""
-
-        # Add regional breakdown
-        for region, data in summary['by_region'].items():
-            email_content += f"\n\nRegion: {region}"
-            email_content += f"\nTotal: {data['count']} snapshots, {data['size']:.2f} GB"
-            email_content += "\nBy Type:"
-            for stype, type_data in data['by_type'].items():
-                email_content += f"\n  - {stype}: {type_data['count']} snapshots, {type_data['size']:.2f} GB"
-
-        email_content += f"\n\nGlobal Breakdown by Type:\n{'-' * 40}"
-        for stype, data in summary['by_type'].items():
-            email_content += f"\n{stype}: {data['count']} snapshots, {data['size']:.2f} GB"
-
-        email_content += f"\n\nBreakdown by Age:\n{'-' * 40}"
-        for age_group, data in summary['by_age_group'].items():
-            email_content += f"\n{age_group}: {data['count']} snapshots, {data['size']:.2f} GB"
-
-        # Add unattached volumes section with regional breakdown
-        email_content += f"\n\nUnattached EBS Volumes Summary:\n{'-' * 40}"
-        email_content += f"\nTotal Unattached Volumes: {len(unattached_volumes)}"
-        
-        if unattached_volumes:
-            # Group volumes by region
-            volumes_by_region = {}
-            for vol in unattached_volumes:
-                region = vol.get('Region', 'unknown')
-                if region not in volumes_by_region:
-                    volumes_by_region[region] = []
-                volumes_by_region[region].append(vol)
-
-            # Display volumes by region
-            for region, volumes in volumes_by_region.items():
-                total_size = sum(vol['Size'] for vol in volumes)
-                email_content += f"\n\nRegion: {region}"
-                email_content += f"\nVolumes: {len(volumes)}, Total Size: {total_size} GB"
-                email_content += "\nTop Idle Volumes (by days unattached):"
-                
-                # List top 5 longest idle volumes per region
-                for vol in sorted(volumes, key=lambda x: x['IdleDays'], reverse=True)[:5]:
-                    email_content += (f"\nVolume ID: {vol['VolumeId']}\n"
-                                    f"  - Idle Days: {vol['IdleDays']}\n"
-                                    f"  - Size: {vol['Size']} GB\n"
-                                    f"  - Type: {vol['VolumeType']}\n"
-                                    f"  - State: {vol['State']}")
+            if snapshot.Region in by_region:
+                by_region[snapshot.Region].append(snapshot)
+
+        # A failed collector would otherwise wipe its stored snapshots
+        tasks = [(f"saving scan state of {region}", self.save_region_state, (region, by_region[region]))
+                 for region in regions
+                 if not any(self.stats.has_errors(region, stype) for stype in INCREMENTAL_COLLECTORS)]
+        self.run_parallel(tasks)
+
+    def get_billed_size_key(self, region: str) -> str:
+        """S3 key of the measured EBS snapshot sizes of a region"""
+        return f"{BILLED_SIZE_PREFIX}/{self.account_id}/{region}.json"
+
+    def load_billed_sizes(self, region: str) -> Dict[str, List[Any]]:
+        """Cached {snapshot ID: [parent snapshot ID, billed GB]} of a region"""
+        try:
+            response = self.s3_client.get_object(Bucket=self.s3_bucket, Key=self.get_billed_size_key(region))
+            stored = json.loads(response['Body'].read())
+        except Exception as e:
+            if getattr(e, 'response', {}).get('Error', {}).get('Code') != 'NoSuchKey':
+                print(f"Error loading billed sizes for {region}: {str(e)}")
+            return {}
+
+        if stored.get('version') != BILLED_SIZE_VERSION:
+            return {}
+        return stored['snapshots']
+
+    def save_billed_sizes(self, region: str, sizes: Dict[str, List[Any]]):
+        """Persist the measured EBS snapshot sizes of a region"""
+        self.s3_client.put_object(
+            Bucket=self.s3_bucket,
+            Key=self.get_billed_size_key(region),
+            Body=json.dumps({'version': BILLED_SIZE_VERSION, 'snapshots': sizes},
+                            separators=(',', ':'), sort_keys=True)
+        )
+
+    def measure_billed_size(self, region: str, snapshot_id: str, parent_id: str) -> float:
+        """GB of the blocks a snapshot changed since its parent, or of all its blocks without one"""
+        if parent_id:
+            blocks = self.paginate('ebs', 'list_changed_blocks', 'ChangedBlocks', region, 'BILLED',
+                                   EBS_BLOCKS_PAGE_SIZE, resumable=False,
+                                   FirstSnapshotId=parent_id, SecondSnapshotId=snapshot_id)
+            # A block without a second token was dropped, not written, by the snapshot
+            count = sum(1 for block in blocks if block.get('SecondBlockToken'))
         else:
-            email_content += "\nNo unattached volumes found."
+            blocks = self.paginate('ebs', 'list_snapshot_blocks', 'Blocks', region, 'BILLED',
+                                   EBS_BLOCKS_PAGE_SIZE, resumable=False, SnapshotId=snapshot_id)
+            count = sum(1 for _ in blocks)
+        return bytes_to_gb(count * EBS_BLOCK_SIZE)
 
-        return email_content
+    def enrich_billed_sizes(self, region: str, records: List[SnapshotRecord],
+                            lineage: Dict[str, Tuple[str, datetime]]) -> List[SnapshotRecord]:
+        """Set the BilledSize of a region's EBS snapshots, from the cache or by measuring them.
 
+        A snapshot's parent is the previous completed snapshot of its volume.
+        What a snapshot adds to a given parent never changes, so each
+        (snapshot, parent) pair is measured once, oldest first, while the
+        run's budget lasts. A listing that failed or was split over
+        invocations may lack parents, so it only reuses cached sizes.
+        """
+        with self.stats.stage('billed_size'):
+            cache = self.load_billed_sizes(region)
+            unit = (region, 'EBS')
+            complete = not (self.stats.has_errors(region, 'EBS') or unit in self.pending_units
+                            or unit in self.partial_results)
 
-    def get_all_regions(self) -> List[str]:
-        """Get list of all AWS regions"""
+            parents: Dict[str, str] = {}
+            if complete:
+                by_volume: Dict[str, List[Tuple[datetime, str]]] = {}
+                for snapshot_id, (volume_id, start_time) in lineage.items():
+                    by_volume.setdefault(volume_id, []).append((start_time, snapshot_id))
+                for volume_id, snapshots in by_volume.items():
+                    snapshots.sort()
+                    previous = ''
+                    for _, snapshot_id in snapshots:
+                        parents[snapshot_id] = '' if volume_id == EBS_NO_VOLUME_ID else previous
+                        previous = snapshot_id
+
+            billed: Dict[str, List[Any]] = {}
+            todo = []
+            for record in records:
+                if record.Id not in lineage:
+                    continue
+                entry = cache.get(record.Id)
+                if not complete:
+                    if entry:
+                        billed[record.Id] = entry
+                elif entry and entry[0] == parents[record.Id]:
+                    billed[record.Id] = entry
+                else:
+                    todo.append(record.Id)
+
+            todo.sort(key=lambda snapshot_id: lineage[snapshot_id][1])
+            todo = todo[:self.billed_budget.take(len(todo))]
+            tasks = [(f"billed size of {snapshot_id} in {region}", self.measure_billed_size,
+                      (region, snapshot_id, parents[snapshot_id])) for snapshot_id in todo]
+            for snapshot_id, size in zip(todo, self.run_parallel(tasks)):
+                # A failed measurement is logged and retried by a later run
+                if isinstance(size, float):
+                    billed[snapshot_id] = [parents[snapshot_id], size]
+
+            # Entries of snapshots that no longer exist are dropped. The
+            # cache is rewritten even when unchanged, so the bucket's
+            # expiration of old objects never drops it
+            if complete:
+                stored = {snapshot_id: billed.get(snapshot_id) or cache[snapshot_id]
+                          for snapshot_id in lineage if snapshot_id in billed or snapshot_id in cache}
+                if stored or cache:
+                    try:
+                        self.save_billed_sizes(region, stored)
+                    except Exception as e:
+                        print(f"Error saving billed sizes for {region}: {str(e)}")
+
+        return [record._replace(BilledSize=billed[record.Id][1]) if record.Id in billed else record
+                for record in records]
+
+    def list_lineage_ids(self, region: str, sweep: str) -> Set[str]:
+        """IDs listed by one lineage sweep of a region: a type's sources, or the snapshots of 'AMI'"""
+        if sweep == 'AMI':
+            images = self.paginate('ec2', 'describe_images', 'Images', region, 'LINEAGE',
+                                   LINEAGE_IMAGES_PAGE_SIZE, resumable=False, Owners=['self'])
+            return {mapping['Ebs']['SnapshotId'] for image in images
+                    for mapping in image.get('BlockDeviceMappings', [])
+                    if mapping.get('Ebs', {}).get('SnapshotId')}
+
+        service, operation, result_key, id_field, page_size = LINEAGE_SOURCES[sweep]
+        return {item[id_field] for item in self.paginate(service, operation, result_key, region, 'LINEAGE',
+                                                         page_size, resumable=False)}
+
+    def classify_lineage(self, stype: str, region: str,
+                         records: List[SnapshotRecord]) -> List[SnapshotRecord]:
+        """Set the Lineage of a region's EBS or RDS snapshots.
+
+        The region's sources, and for EBS the snapshots its AMIs reference,
+        are each listed in one sweep into a set, so classifying costs one
+        lookup per snapshot and no call. A failed sweep is logged and
+        counted, and leaves the snapshots unclassified.
+        """
+        if not records:
+            return records
+
+        with self.stats.stage('lineage'):
+            sweeps = [stype, 'AMI'] if stype == 'EBS' else [stype]
+            tasks = [(f"{sweep} lineage sweep in {region}", self.list_lineage_ids, (region, sweep))
+                     for sweep in sweeps]
+            results = self.run_parallel(tasks)
+            # run_parallel logs a failed sweep and returns it as an empty list
+            if not all(isinstance(ids, set) for ids in results):
+                self.stats.record_error(region, 'LINEAGE')
+                return records
+
+            sources = results[0]
+            images = results[1] if len(results) > 1 else set()
+            classified = []
+            for record in records:
+                if record.Id in images:
+                    lineage = 'ami'
+                elif record.SourceId in sources:
+                    lineage = 'attached'
+                else:
+                    lineage = 'orphaned'
+                classified.append(record._replace(Lineage=lineage))
+        return classified
+
+    def get_activity_key(self) -> str:
+        """S3 key of the region activity map of the account"""
+        return f"{ACTIVITY_PREFIX}/{self.account_id}.json"
+
+    def load_region_activity(self) -> Dict[str, Dict[str, Any]]:
+        """Load the stored region activity map; regions missing from it count as active"""
         try:
-            regions = [region['RegionName'] 
-                      for region in self.ec2_client.describe_regions()['Regions']]
+            response = self.s3_client.get_object(Bucket=self.s3_bucket, Key=self.get_activity_key())
+            stored = json.loads(response['Body'].read())
+        except Exception as e:
+            if getattr(e, 'response', {}).get('Error', {}).get('Code') != 'NoSuchKey':
+                print(f"Error loading region activity map: {str(e)}")
+            return {}
+
+        if stored.get('version') != ACTIVITY_VERSION:
+            return {}
+        return stored['regions']
+
+    def save_region_activity(self):
+        """Persist the region activity map"""
+        activity = {'version': ACTIVITY_VERSION, 'regions': self.region_activity}
+        self.s3_client.put_object(
+            Bucket=self.s3_bucket,
+            Key=self.get_activity_key(),
+            Body=json.dumps(activity, separators=(',', ':'), sort_keys=True)
+        )
+
+    def probe_page(self, service: str, region: str, operation: str, result_key: str,
+                   **kwargs) -> List[Dict[str, Any]]:
+        """Items of a single page fetched to probe a dormant region"""
+        page = self.call_api(service, region, operation, 'PROBE', **kwargs)
+        items = page.get(result_key, [])
+        self.stats.record_page(region, 'PROBE', len(items))
+        return items
+
+    def probe_region(self, region: str) -> bool:
+        """Whether a single page of any collector finds something in a dormant region.
+
+        A failing probe counts as activity, so the full scan surfaces the error.
+        """
+        # Only unattached volumes make a region active, as in the full scan
+        states = self.collector_filters['VOLUMES'].get('states') or ['available']
+        for collector in self.collectors + ['VOLUMES']:
+            try:
+                if collector == 'VOLUMES':
+                    volumes = self.probe_page('ec2', region, 'describe_volumes', 'Volumes', MaxResults=5,
+                                              Filters=[{'Name': 'status', 'Values': states}])
+                    found = any(not volume.get('Attachments') for volume in volumes)
+                else:
+                    found = COLLECTOR_REGISTRY[collector].probe(self, region)
+            except Exception as e:
+                print(f"Error probing {collector} in {region}: {str(e)}")
+                return True
+            if found:
+                return True
+        return False
+
+    def get_scan_regions(self) -> List[str]:
+        """Regions scanned in full this run: active, unknown and newly promoted regions"""
+        if self._scan_regions is not None:
+            return self._scan_regions
+
+        regions = self.get_all_regions()
+        if not self.adaptive_regions or self.full_scan:
+            self._scan_regions = regions
             return regions
+
+        self.region_activity = self.load_region_activity()
+        dormant = [region for region in regions
+                   if not self.region_activity.get(region, {'active': True})['active']]
+        due_before = self.scan_started_at - self.probe_interval
+        due = [region for region in dormant
+               if datetime.fromisoformat(self.region_activity[region]['checked']) <= due_before]
+
+        tasks = [(f"probe of {region}", self.probe_region, (region,)) for region in due]
+        promoted = set()
+        for region, found in zip(due, self.run_parallel(tasks)):
+            if found:
+                promoted.add(region)
+            else:
+                self.region_activity[region]['checked'] = self.scan_started_at.isoformat()
+
+        self.skipped_regions = [region for region in dormant if region not in promoted]
+        self._scan_regions = [region for region in regions if region not in self.skipped_regions]
+        print(f"Region activity map: scanning {len(self._scan_regions)} of {len(regions)} regions, "
+              f"{len(due)} dormant regions probed, {len(promoted)} promoted")
+        return self._scan_regions
+
+    def update_region_activity(self, regions: List[str], found: Set[str]):
+        """Record which fully scanned regions hold anything and persist the map.
+
+        A region whose scan failed keeps its previous entry, so an error
+        cannot demote an active region.
+        """
+        for region in regions:
+            if any(self.stats.has_errors(region, collector) for collector in SNAPSHOT_COLLECTORS + ('VOLUMES',)):
+                continue
+            self.region_activity[region] = {'active': region in found,
+                                            'checked': self.scan_started_at.isoformat()}
+        try:
+            self.save_region_activity()
         except Exception as e:
-            print(f"Error getting regions: {str(e)}")
-            return []
+            print(f"Error saving region activity map: {str(e)}")
+
+    def get_index_key(self) -> str:
+        """S3 key of the snapshot ID index of the latest run"""
+        return f"{INDEX_PREFIX}/{self.account_id}/{INDEX_NAME}"
+
+    def load_snapshot_index(self) -> Optional[SnapshotIndex]:
+        """Load the index the previous run left, if there is one"""
+        try:
+            response = self.s3_client.get_object(Bucket=self.s3_bucket, Key=self.get_index_key())
+            return SnapshotIndex.decode(response['Body'].read())
+        except Exception as e:
+            if getattr(e, 'response', {}).get('Error', {}).get('Code') != 'NoSuchKey':
+                print(f"Error loading snapshot index: {str(e)}")
+            return None
+
+    def compute_delta(self, current: SnapshotIndex) -> Optional[Tuple[datetime, List[DeltaRecord]]]:
+        """Diff this run's index against the previous run's and store it in its place.
+
+        Returns the previous run's time and the changes, or None on a first
+        run. Snapshots of (account, region, type) units that failed this
+        run, including every unit of an account that could not be scanned,
+        are carried over from the previous index rather than reported as
+        removed.
+        """
+        previous = self.load_snapshot_index()
+        delta = None
+        if previous is not None:
+            failed = {unit for unit in {key[:3] for key in previous.keys}
+                      if self.stats.has_failed(*unit)}
+            if failed:
+                current = current.carry_over(previous, failed)
+            delta = (previous.generated_at, current.diff(previous))
+
+        try:
+            self.s3_client.put_object(
+                Bucket=self.s3_bucket,
+                Key=self.get_index_key(),
+                Body=current.encode(),
+                ContentType='application/octet-stream'
+            )
+        except Exception as e:
+            print(f"Error saving snapshot index: {str(e)}")
+        return delta
+
+    def get_rollup_key(self) -> str:
+        """S3 key of the daily snapshot rollup"""
+        return f"{ROLLUP_PREFIX}/{self.account_id}/{ROLLUP_NAME}"
+
+    def load_rollup(self) -> Optional[SnapshotRollup]:
+        """Load the daily rollup earlier runs built, if there is one"""
+        try:
+            response = self.s3_client.get_object(Bucket=self.s3_bucket, Key=self.get_rollup_key())
+            return SnapshotRollup.decode(response['Body'].read())
+        except Exception as e:
+            if getattr(e, 'response', {}).get('Error', {}).get('Code') != 'NoSuchKey':
+                print(f"Error loading snapshot rollup: {str(e)}")
+            return None
+
+    def update_rollup(self, aggregator: SummaryAggregator) -> Optional[Dict[str, Any]]:
+        """Record this run's summary cells as today's rollup rows and store the rollup.
+
+        Returns the growth of today's totals per GROWTH_PERIODS name, or
+        None while the rollup is too short for any of them.
+        """
+        rollup = self.load_rollup() or SnapshotRollup.from_rows([])
+        today = SnapshotRollup.day_number(self.scan_started_at.date())
+        previous = rollup.latest_day(before=today)
+        # An account that could not be scanned has all its units failed
+        units = rollup.units(today) | (rollup.units(previous) if previous is not None else set())
+        failed = {unit for unit in units if self.stats.has_failed(*unit)}
+        rollup = rollup.record(today, aggregator.cells(), failed, today - self.rollup_retention + 1)
 
-    def get_snapshots_for_region(self, region: str) -> List[Dict[str, Any]]:
-        """Get snapshots from a specific region"""
-        snapshots = []
-        
-        # Create regional clients
-        ec2_regional = boto3.client('ec2', region_name=region)
-        rds_regional = boto3.client('rds', region_name=region)
-        backup_regional = boto3.client('backup', region_name=region)
-        
-        # Get EBS snapshots
         try:
-            paginator = ec2_regional.get_paginator('describe_snapshots')
-            for page in paginator.paginate(OwnerIds=[self.account_id]):
-                for snapshot in page['Snapshots']:
-                    age = self.get_snapshot_age(snapshot['StartTime'])
-                    snapshots.append({
-                        'Id': snapshot['SnapshotId'],
-                        'Type': 'EBS',
-                        'Region': region,
-                        'StartTime': snapshot['StartTime'].isoformat(),
-                        'Size': snapshot['VolumeSize'],
-                        'Age': age,
-                        'AgeGroup': self.get_age_group(age)
-                    })
+            self.s3_client.put_object(
+                Bucket=self.s3_bucket,
+                Key=self.get_rollup_key(),
+                Body=rollup.encode(),
+                ContentType='application/octet-stream'
+            )
         except Exception as e:
-            print(f"Error getting EBS snapshots in {region}: {str(e)}")
+            print(f"Error saving snapshot rollup: {str(e)}")
+
+        growth = {name: rollup.growth(today, days) for name, days in GROWTH_PERIODS}
+        return {name: data for name, data in growth.items() if data} or None
+
+    def get_trend(self, days: int, by: Tuple[str, ...] = ()) -> List[Dict[str, Any]]:
+        """Daily snapshot count and GB of the last days, grouped by TREND_DIMENSIONS names"""
+        unknown = [name for name in by if name not in TREND_DIMENSIONS]
+        if unknown:
+            raise ValueError(f"Unknown trend dimensions {unknown}, expected some of {list(TREND_DIMENSIONS)}")
+        rollup = self.load_rollup()
+        return rollup.trend(days, tuple(by)) if rollup else []
+
+    def set_time_budget(self, context):
+        """Watch the remaining time of the Lambda invocation while scanning"""
+        if hasattr(context, 'get_remaining_time_in_millis'):
+            self.context = context
+
+    def out_of_time(self) -> bool:
+        """Whether only the reserve is left of the invocation's time budget"""
+        return self.context is not None and \
+            self.context.get_remaining_time_in_millis() < self.time_reserve_ms
+
+    def get_checkpoint_key(self) -> str:
+        """S3 key of the checkpoint of the current run"""
+        return (f"{CHECKPOINT_PREFIX}/{self.account_id}/"
+                f"{self.scan_started_at.strftime('%Y%m%dT%H%M%S%f')}.json.gz")
+
+    def get_scan_inventories(self) -> List['SnapshotInventory']:
+        """This inventory and those of the member accounts an organization scan set up"""
+        return [self] + [self.member_inventories[account_id] for account_id in sorted(self.member_inventories)]
+
+    def get_pending_units(self) -> List[Tuple[str, str, str]]:
+        """(account, region, collector) of every unit left to a continuation"""
+        return [(inventory.account_id, region, collector) for inventory in self.get_scan_inventories()
+                for region, collector in inventory.pending_units]
+
+    def get_unit_state(self) -> Dict[str, Any]:
+        """Regions, finished units and partial units with their page tokens, for a checkpoint"""
+        return {
+            'regions': self._regions,
+            'completed': [[region, collector, key] for (region, collector), key in self.completed_units.items()],
+            'held': [[region, collector, [record.to_row() for record in records]]
+                     for (region, collector), records in self.held_units.items()],
+            'spills': self._spills,
+            'pending': [[region, collector, token,
+                         [record.to_row() for record in self.partial_results.get((region, collector), [])]]
+                        for (region, collector), token in self.pending_units.items()]
+        }
+
+    def restore_unit_state(self, state: Dict[str, Any]):
+        """Pick up the units of a checkpoint's get_unit_state"""
+        self._regions = state['regions']
+
+        def records(collector, rows):
+            record_type = VolumeRecord if collector == 'VOLUMES' else SnapshotRecord
+            return [record_type.from_row(row) for row in rows]
+
+        for region, collector, spill_key in state['completed']:
+            self.completed_units[(region, collector)] = spill_key
+        for region, collector, rows in state['held']:
+            self.held_units[(region, collector)] = records(collector, rows)
+            self._held_records += len(rows)
+        # Spills of the continuation are numbered after those of earlier invocations
+        self._spills = state['spills']
+        for region, collector, token, rows in state['pending']:
+            self.partial_results[(region, collector)] = records(collector, rows)
+            if token:
+                self.resume_tokens[(region, collector)] = token
+
+    def save_checkpoint(self, continuations: int) -> str:
+        """Persist finished units, partial units with their page tokens and the stats"""
+        checkpoint = {
+            'version': CHECKPOINT_VERSION,
+            'scan_started_at': self.scan_started_at.isoformat(),
+            'scan_regions': self._scan_regions,
+            'skipped_regions': self.skipped_regions,
+            'region_activity': self.region_activity,
+            'full_scan': self.full_scan,
+            'continuations': continuations,
+            **self.get_unit_state(),
+            # The units of an organization scan are kept per member account
+            'accounts': {account_id: inventory.get_unit_state()
+                         for account_id, inventory in sorted(self.member_inventories.items())}
+                        if self.org_mode else None,
+            'stats': self.stats.to_state()
+        }
+        key = self.get_checkpoint_key()
+        self.s3_client.put_object(
+            Bucket=self.s3_bucket,
+            Key=key,
+            Body=zlib.compress(json.dumps(checkpoint, separators=(',', ':')).encode('utf-8')),
+            ContentType='application/octet-stream'
+        )
+        return key
 
-        # Get RDS snapshots
+    def load_checkpoint(self, key: str) -> int:
+        """Resume a run from its checkpoint, returning how many continuations preceded this one"""
+        response = self.s3_client.get_object(Bucket=self.s3_bucket, Key=key)
+        checkpoint = json.loads(zlib.decompress(response['Body'].read()))
+        if checkpoint.get('version') != CHECKPOINT_VERSION:
+            raise ValueError(f"Unsupported checkpoint version in {key}")
+
+        # The run keeps its original clock so ages match a single invocation
+        self.scan_started_at = datetime.fromisoformat(checkpoint['scan_started_at'])
+        self.age_bucketer = load_age_bucketer(self.scan_started_at)
+        self.full_scan = checkpoint['full_scan']
+
+        # Probes are not repeated; the continuation scans the same regions
+        self._scan_regions = checkpoint.get('scan_regions')
+        self.skipped_regions = checkpoint.get('skipped_regions', [])
+        self.region_activity = checkpoint.get('region_activity', {})
+
+        self.restore_unit_state(checkpoint)
+        # Member accounts pick up their units as the organization scan sets them up
+        self.member_states = checkpoint['accounts']
+        self.stats.merge_state(checkpoint['stats'])
+        return checkpoint['continuations']
+
+    def delete_checkpoint(self, key: str):
         try:
-            paginator = rds_regional.get_paginator('describe_db_snapshots')
-            for page in paginator.paginate():
-                for snapshot in page['DBSnapshots']:
-                    age = self.get_snapshot_age(snapshot['SnapshotCreateTime'])
-                    snapshots.append({
-                        'Id': snapshot['DBSnapshotIdentifier'],
-                        'Type': 'RDS',
-                        'Region': region,
-                        'StartTime': snapshot['SnapshotCreateTime'].isoformat(),
-                        'Size': snapshot['AllocatedStorage'],
-                        'Age': age,
-                        'AgeGroup': self.get_age_group(age)
-                    })
+            self.s3_client.delete_object(Bucket=self.s3_bucket, Key=key)
         except Exception as e:
-            print(f"Error getting RDS snapshots in {region}: {str(e)}")
+            print(f"Error deleting checkpoint {key}: {str(e)}")
 
-        # Get EFS backups using AWS Backup
+    def get_spill_key(self, number: int) -> str:
+        """S3 key of a batch of finished units the current run spilled"""
+        return (f"{CHECKPOINT_PREFIX}/{self.account_id}/"
+                f"{self.scan_started_at.strftime('%Y%m%dT%H%M%S%f')}/{number:05d}.json.gz")
+
+    def keep_unit(self, region: str, collector: str, records: List[Any]):
+        """Keep the results of a finished unit for a checkpoint.
+
+        Units are held in memory and written with the checkpoint, so a run
+        that never hands over makes no extra requests. Once
+        checkpoint_buffer_records records are held, they are spilled to S3
+        together as one object and only its key is kept.
+        """
+        key = (region, collector)
+        with self._units_lock:
+            self.completed_units[key] = None
+            if not records:
+                return
+            self.held_units[key] = records
+            self._held_records += len(records)
+            if not self.checkpoint_buffer_records or self._held_records < self.checkpoint_buffer_records:
+                return
+            batch, self.held_units, self._held_records = self.held_units, {}, 0
+            self._spills += 1
+            number = self._spills
+        self.spill_units(batch, number)
+
+    def spill_units(self, batch: Dict[Tuple[str, str], List[Any]], number: int):
+        """Write held units to S3 as one object; should that fail they stay held"""
+        spill_key = self.get_spill_key(number)
+        # One JSON line per UNIT_SPILL_BATCH_SIZE rows of a unit, compressed
+        # line by line so only the compressed body is held in full; the
+        # object is short-lived, so speed matters more than its size
+        compressor = zlib.compressobj(1)
+        body = bytearray()
+        for (region, collector), records in batch.items():
+            for start in range(0, len(records), UNIT_SPILL_BATCH_SIZE):
+                rows = [record.to_row() for record in records[start:start + UNIT_SPILL_BATCH_SIZE]]
+                body += compressor.compress(
+                    (json.dumps([region, collector, rows], separators=(',', ':')) + '\n').encode('utf-8'))
+        body += compressor.flush()
         try:
-            paginator = backup_regional.get_paginator('list_backup_jobs')
-            for page in paginator.paginate(ByResourceType='EFS'):
-                for backup in page['BackupJobs']:
-                    if backup['State'] == 'COMPLETED':
-                        age = self.get_snapshot_age(backup['CreationDate'])
-                        size_gb = backup.get('BackupSizeInBytes', 0) / (1024 * 1024 * 1024)
-                        snapshots.append({
-                            'Id': backup['BackupJobId'],
-                            'Type': 'EFS',
-                            'Region': region,
-                            'StartTime': backup['CreationDate'].isoformat(),
-                            'Size': round(size_gb, 2),
-                            'Age': age,
-                            'AgeGroup': self.get_age_group(age)
-                        })
+            self.s3_client.put_object(
+                Bucket=self.s3_bucket,
+                Key=spill_key,
+                Body=bytes(body),
+                ContentType='application/octet-stream'
+            )
         except Exception as e:
-            print(f"Error getting EFS backups in {region}: {str(e)}")
+            print(f"Error spilling finished units to {spill_key}: {str(e)}")
+            with self._units_lock:
+                self.held_units.update(batch)
+                self._held_records += sum(len(records) for records in batch.values())
+            return
+        with self._units_lock:
+            for key in batch:
+                self.completed_units[key] = spill_key
+
+    def load_unit(self, region: str, collector: str) -> List[Any]:
+        """Results of a unit finished by an earlier invocation of the run"""
+        key = (region, collector)
+        if key in self.held_units:
+            return self.held_units[key]
+        spill_key = self.completed_units[key]
+        if spill_key is None:
+            return []
+        if spill_key not in self._spilled:
+            # Every unit of a spilled batch is read back with its first one
+            response = self.s3_client.get_object(Bucket=self.s3_bucket, Key=spill_key)
+            units: Dict[Tuple[str, str], List[Any]] = {}
+            for line in zlib.decompress(response['Body'].read()).decode('utf-8').splitlines():
+                unit_region, unit_collector, rows = json.loads(line)
+                record_type = VolumeRecord if unit_collector == 'VOLUMES' else SnapshotRecord
+                units.setdefault((unit_region, unit_collector), []).extend(
+                    record_type.from_row(row) for row in rows)
+            self._spilled[spill_key] = units
+        return self._spilled[spill_key].pop(key, [])
+
+    def delete_units(self):
+        """Delete the finished units the run spilled, once it is complete"""
+        keys = sorted({key for inventory in self.get_scan_inventories()
+                       for key in inventory.completed_units.values() if key})
+        for start in range(0, len(keys), S3_DELETE_BATCH_SIZE):
+            try:
+                self.s3_client.delete_objects(
+                    Bucket=self.s3_bucket,
+                    Delete={'Objects': [{'Key': key} for key in keys[start:start + S3_DELETE_BATCH_SIZE]],
+                            'Quiet': True}
+                )
+            except Exception as e:
+                print(f"Error deleting unit results: {str(e)}")
+
+    def continue_scan(self, context, continuations: int) -> Dict[str, Any]:
+        """Checkpoint the run and hand the rest of it to another invocation.
+
+        With CONTINUATION_MODE=invoke (the default) the function invokes
+        itself asynchronously; with 'return' the caller, e.g. a Step
+        Functions loop, passes the returned continuation on.
+        """
+        key = self.save_checkpoint(continuations)
+        payload = {'continuation': key}
+        pending = self.get_pending_units()
+        print(f"Out of time with {len(pending)} units left, checkpointed to {key}")
+
+        invoked = False
+        if os.environ.get('CONTINUATION_MODE', 'invoke') == 'invoke' and \
+                getattr(context, 'invoked_function_arn', None):
+            get_client('lambda').invoke(
+                FunctionName=context.invoked_function_arn,
+                InvocationType='Event',
+                Payload=json.dumps(payload)
+            )
+            invoked = True
+
+        return {
+            'statusCode': 202,
+            'body': json.dumps({
+                'message': 'Snapshot inventory continues in another invocation',
+                'continuation': payload,
+                'invoked': invoked,
+                'pending_units': len(pending),
+                'completed_units': sum(len(inventory.completed_units) for inventory in self.get_scan_inventories())
+            })
+        }
+
+    def run_collector(self, collector: str, func: Callable[[str], List[Any]], region: str) -> List[Any]:
+        """Run one collector in a region, recording how long it took"""
+        # Units not started before the time budget runs out are left whole
+        # to the continuation
+        if self.out_of_time():
+            self.pending_units[(region, collector)] = self.resume_tokens.pop((region, collector), None)
+            return []
+
+        start = time.perf_counter()
+        try:
+            return func(region)
+        finally:
+            self.stats.record_duration(region, collector, time.perf_counter() - start)
+
+    def get_snapshots_for_region(self, region: str) -> List[SnapshotRecord]:
+        """Get snapshots from a specific region"""
+        tasks = [(f"{COLLECTOR_REGISTRY[stype].description} in {region}", self.run_collector,
+                  (stype, partial(self.collect_unit, stype), region))
+                 for stype in self.collectors]
 
+        snapshots = []
+        for region_snapshots in self.run_parallel(tasks):
+            snapshots.extend(region_snapshots)
         return snapshots
 
-    def get_all_regions_snapshots(self) -> List[Dict[str, Any]]:
+    def get_all_regions_snapshots(self) -> List[SnapshotRecord]:
         """Get snapshots from all regions"""
-        all_snapshots = []
-        regions = self.get_all_regions()
-        
-        for region in regions:
-            print(f"Processing region: {region}")
-            region_snapshots = self.get_snapshots_for_region(region)
-            all_snapshots.extend(region_snapshots)
-            
-        return all_snapshots
+        snapshots, _ = self.scan_all_regions(include_volumes=False)
+        return snapshots
 
-    def get_unattached_volumes_for_region(self, region: str) -> List[Dict[str, Any]]:
+    def get_unattached_volumes_for_region(self, region: str) -> List[VolumeRecord]:
         """Get unattached volumes for a specific region"""
         unattached_volumes = []
-        
+        filters = self.collector_filters['VOLUMES']
+
+        # Excluding in-use volumes server-side skips most of the fleet
+        kwargs: Dict[str, Any] = {}
+        if filters.get('states'):
+            kwargs['Filters'] = [{'Name': 'status', 'Values': filters['states']}]
+
         try:
-            ec2_regional = boto3.client('ec2', region_name=region)
-            paginator = ec2_regional.get_paginator('describe_volumes')
-            for page in paginator.paginate():
-                for volume in page['Volumes']:
-                    if not volume['Attachments']:
-                        idle_days = 0
-                        if 'StateTransitionTime' in volume:
-                            idle_days = self.get_snapshot_age(volume['StateTransitionTime'])
-                        
-                        unattached_volumes.append({
-                            'VolumeId': volume['VolumeId'],
-                            'Region': region,
-                            'Size': volume['Size'],
-                            'State': volume['State'],
-                            'IdleDays': idle_days,
-                            'VolumeType': volume['VolumeType'],
-                            'CreateTime': volume['CreateTime'].isoformat()
-                        })
+            for volume in self.paginate('ec2', 'describe_volumes', 'Volumes',
+                                        region, 'VOLUMES', filters.get('page_size'), **kwargs):
+                if not volume['Attachments']:
+                    idle_days = 0
+                    if 'StateTransitionTime' in volume:
+                        idle_days = self.get_snapshot_age(volume['StateTransitionTime'])
+
+                    unattached_volumes.append(VolumeRecord(
+                        volume['VolumeId'], region, volume['Size'], volume['State'],
+                        idle_days, volume['VolumeType'], volume['CreateTime'], self.account_id))
         except Exception as e:
             print(f"Error getting unattached volumes in {region}: {str(e)}")
-            
+            self.stats.record_error(region, 'VOLUMES')
+
+        if self.idle_detection and unattached_volumes:
+            unattached_volumes = self.detect_idle_volumes(region, unattached_volumes)
+
+        unattached_volumes.sort(key=lambda x: x.VolumeId)
         return unattached_volumes
 
-    def get_all_regions_unattached_volumes(self) -> List[Dict[str, Any]]:
+    def get_idle_key(self, region: str) -> str:
+        """S3 key of the last activity of a region's unattached volumes"""
+        return f"{IDLE_PREFIX}/{self.account_id}/{region}.json"
+
+    def load_volume_activity(self, region: str) -> Dict[str, str]:
+        """Cached {volume ID: last activity} of a region's unattached volumes"""
+        try:
+            response = self.s3_client.get_object(Bucket=self.s3_bucket, Key=self.get_idle_key(region))
+            stored = json.loads(response['Body'].read())
+        except Exception as e:
+            if getattr(e, 'response', {}).get('Error', {}).get('Code') != 'NoSuchKey':
+                print(f"Error loading volume activity for {region}: {str(e)}")
+            return {}
+
+        if stored.get('version') != IDLE_VERSION:
+            return {}
+        return stored['volumes']
+
+    def save_volume_activity(self, region: str, activity: Dict[str, str]):
+        """Persist the last activity of a region's unattached volumes"""
+        self.s3_client.put_object(
+            Bucket=self.s3_bucket,
+            Key=self.get_idle_key(region),
+            Body=json.dumps({'version': IDLE_VERSION, 'volumes': activity},
+                            separators=(',', ':'), sort_keys=True)
+        )
+
+    def get_metric_activity(self, region: str, volume_ids: List[str]) -> Dict[str, datetime]:
+        """Last day with reads or writes of each volume, in one GetMetricData listing.
+
+        EBS only publishes metrics of attached volumes, so this is also
+        about when the volume was last in use.
+        """
+        queries = []
+        for index, volume_id in enumerate(volume_ids):
+            for prefix, metric in IDLE_METRICS.items():
+                queries.append({
+                    'Id': f"{prefix}{index}",
+                    'MetricStat': {
+                        'Metric': {'Namespace': 'AWS/EBS', 'MetricName': metric,
+                                   'Dimensions': [{'Name': 'VolumeId', 'Value': volume_id}]},
+                        'Period': 86400,
+                        'Stat': 'Sum'
+                    },
+                    'ReturnData': True
+                })
+
+        activity: Dict[str, datetime] = {}
+        results = self.paginate('cloudwatch', 'get_metric_data', 'MetricDataResults', region, 'IDLE',
+                                resumable=False, MetricDataQueries=queries,
+                                StartTime=self.scan_started_at - self.idle_lookback,
+                                EndTime=self.scan_started_at, ScanBy='TimestampDescending')
+        for result in results:
+            # A query's datapoints can be spread over several pages
+            volume_id = volume_ids[int(result['Id'][1:])]
+            for timestamp, value in zip(result.get('Timestamps', []), result.get('Values', [])):
+                if value > 0 and (volume_id not in activity or timestamp > activity[volume_id]):
+                    activity[volume_id] = timestamp
+        return activity
+
+    def get_detach_activity(self, region: str, volume_ids: Set[str]) -> Dict[str, datetime]:
+        """Time of the latest DetachVolume event of each volume, from one CloudTrail listing"""
+        activity: Dict[str, datetime] = {}
+        events = self.paginate('cloudtrail', 'lookup_events', 'Events', region, 'IDLE', resumable=False,
+                               LookupAttributes=[{'AttributeKey': 'EventName', 'AttributeValue': 'DetachVolume'}],
+                               StartTime=self.scan_started_at - self.idle_lookback,
+                               EndTime=self.scan_started_at)
+        for event in events:
+            for resource in event.get('Resources', []):
+                volume_id = resource.get('ResourceName')
+                if volume_id in volume_ids and (volume_id not in activity or event['EventTime'] > activity[volume_id]):
+                    activity[volume_id] = event['EventTime']
+        return activity
+
+    def detect_idle_volumes(self, region: str, volumes: List[VolumeRecord]) -> List[VolumeRecord]:
+        """Set the IdleDays of a region's unattached volumes from their last activity.
+
+        Volumes not in the cache are looked up in batches of GetMetricData
+        queries, then, with IDLE_CLOUDTRAIL_FALLBACK, in the region's
+        DetachVolume events. A volume with neither has been idle since it
+        was created or at least for the whole lookback window. An
+        unattached volume gains no activity, so every result is cached
+        until the volume is attached again and drops out of the list.
+        """
+        with self.stats.stage('idle'):
+            cache = self.load_volume_activity(region)
+            activity = {volume.VolumeId: datetime.fromisoformat(cache[volume.VolumeId])
+                        for volume in volumes if volume.VolumeId in cache}
+            new = [volume for volume in volumes if volume.VolumeId not in activity]
+
+            found: Dict[str, datetime] = {}
+            try:
+                batch_size = METRIC_QUERIES_PER_CALL // len(IDLE_METRICS)
+                batches = [[volume.VolumeId for volume in new[start:start + batch_size]]
+                           for start in range(0, len(new), batch_size)]
+                tasks = [(f"volume metrics in {region}", self.get_metric_activity, (region, batch))
+                         for batch in batches]
+                for batch_activity in self.run_parallel(tasks):
+                    if not isinstance(batch_activity, dict):
+                        raise RuntimeError('a GetMetricData batch failed')
+                    found.update(batch_activity)
+                missing = {volume.VolumeId for volume in new} - set(found)
+                if self.idle_cloudtrail and missing:
+                    found.update(self.get_detach_activity(region, missing))
+            except Exception as e:
+                # Volumes that were not looked up keep their idle time and are retried next run
+                print(f"Error detecting idle volumes in {region}: {str(e)}")
+                self.stats.record_error(region, 'IDLE')
+                return volumes
+
+            window_start = self.scan_started_at - self.idle_lookback
+            for volume in new:
+                activity[volume.VolumeId] = found.get(volume.VolumeId) or max(volume.CreateTime, window_start)
+
+            unit = (region, 'VOLUMES')
+            stored = {volume_id: last_active.isoformat() for volume_id, last_active in activity.items()}
+            if unit in self.pending_units or unit in self.partial_results:
+                # Part of the region's volumes are listed by another invocation
+                stored = dict(cache, **stored)
+            # Rewritten even when unchanged, so the bucket's expiration of
+            # old objects never drops the cache of a stable region
+            if stored or cache:
+                try:
+                    self.save_volume_activity(region, stored)
+                except Exception as e:
+                    print(f"Error saving volume activity for {region}: {str(e)}")
+
+        return [volume._replace(IdleDays=self.get_snapshot_age(activity[volume.VolumeId]))
+                for volume in volumes]
+
+    def get_all_regions_unattached_volumes(self) -> List[VolumeRecord]:
         """Get unattached volumes from all regions"""
-        all_unattached_volumes = []
-        regions = self.get_all_regions()
-        
+        _, unattached_volumes = self.scan_all_regions(include_snapshots=False)
+        return unattached_volumes
+
+    def scan_region(self, region: str) -> Tuple[List[SnapshotRecord], List[VolumeRecord]]:
+        """Run every collector of one region in turn, as one organization scan work unit.
+
+        Like a single-account scan, collectors finished by an earlier
+        invocation of the run are read back and those the time budget cuts
+        short are left to the continuation.
+        """
+        if self.incremental and not self.full_scan:
+            state = self.load_region_state(region)
+            if state:
+                self.region_states[region] = state
+
+        def run(collector, func):
+            if (region, collector) in self.completed_units:
+                return self.load_unit(region, collector)
+            return self.run_unit(collector, func, region)
+
+        snapshots = []
+        for stype in self.collectors:
+            snapshots.extend(run(stype, partial(self.collect_unit, stype)))
+        unattached_volumes = run('VOLUMES', self.get_unattached_volumes_for_region)
+
+        # The state of a collector left to the continuation is saved by it
+        if self.incremental and not any(self.stats.has_errors(region, stype) or
+                                        (region, stype) in self.pending_units
+                                        for stype in INCREMENTAL_COLLECTORS):
+            self.save_region_state(region, snapshots)
+        return snapshots, unattached_volumes
+
+    @property
+    def checkpointing(self) -> bool:
+        """Whether this invocation may hand the rest of the run to a continuation"""
+        return self.context is not None and self.max_continuations > 0
+
+    def run_unit(self, collector: str, func: Callable[[str], List[Any]], region: str) -> List[Any]:
+        """Run one (region, collector) unit of a run that may be split over invocations"""
+        key = (region, collector)
+        results = self.run_collector(collector, func, region)
+        if key in self.partial_results:
+            results = merge_unit_results(self.partial_results.pop(key), results)
+        if key in self.pending_units:
+            self.partial_results[key] = results
+        elif self.checkpointing:
+            # Kept should the time budget run out; a large batch is
+            # spilled by the worker that completes it
+            self.keep_unit(region, collector, results)
+        return results
+
+    def scan_all_regions(self, include_snapshots: bool = True, include_volumes: bool = True,
+                         on_snapshots: Optional[Callable[[List[SnapshotRecord]], None]] = None
+                         ) -> Tuple[List[SnapshotRecord], List[VolumeRecord]]:
+        """Collect snapshots and unattached volumes from every region in a single pass.
+
+        Each unit's snapshots are released in unit order as soon as every
+        unit before it has finished. Given on_snapshots they are streamed to
+        it chunk by chunk instead of being collected into the returned list.
+        """
+        regions = self.get_scan_regions()
+        print(f"Processing {len(regions)} regions with {self.max_workers} workers")
+
+        if self.incremental and not self.full_scan and include_snapshots:
+            self.load_region_states(regions)
+
+        # One unit per region x collector, ordered so the output is stable
+        units = []
         for region in regions:
-            print(f"Processing unattached volumes in region: {region}")
-            region_volumes = self.get_unattached_volumes_for_region(region)
-            all_unattached_volumes.extend(region_volumes)
-            
-        all_unattached_volumes.sort(key=lambda x: x['IdleDays'], reverse=True)
-        return all_unattached_volumes
+            if include_snapshots:
+                for stype in self.collectors:
+                    units.append((region, stype, f"{COLLECTOR_REGISTRY[stype].description} in {region}",
+                                  partial(self.collect_unit, stype)))
+            if include_volumes:
+                units.append((region, 'VOLUMES', f"unattached volumes in {region}",
+                              self.get_unattached_volumes_for_region))
+
+        all_snapshots: List[SnapshotRecord] = []
+        all_unattached_volumes: List[VolumeRecord] = []
+        emit_snapshots = on_snapshots or all_snapshots.extend
+        incremental_snapshots: List[SnapshotRecord] = []
+        found: Set[str] = set()
+
+        def release(key, results):
+            region, collector = key
+            if results:
+                found.add(region)
+            if collector == 'VOLUMES':
+                all_unattached_volumes.extend(results)
+                return
+            if collector in INCREMENTAL_COLLECTORS:
+                incremental_snapshots.extend(results)
+            emit_snapshots(results)
+
+        buffer = ReorderBuffer([unit[:2] for unit in units], release)
+
+        # Units finished by an earlier invocation of the run are read back
+        # rather than rescanned
+        todo = []
+        for region, collector, label, func in units:
+            if (region, collector) in self.completed_units:
+                buffer.put((region, collector), self.load_unit(region, collector))
+            else:
+                todo.append((region, collector, label, func))
+        tasks = [(label, self.run_unit, (collector, func, region))
+                 for region, collector, label, func in todo]
+        self.run_parallel(tasks, on_result=lambda index, results: buffer.put(todo[index][:2], results))
+
+        # Full scans persist state too, so the next run can be incremental;
+        # a scan split over invocations does so once it is complete
+        if self.incremental and include_snapshots and not self.pending_units:
+            self.save_region_states(regions, incremental_snapshots)
+        if self.adaptive_regions and include_snapshots and include_volumes and not self.pending_units:
+            self.update_region_activity(regions, found)
+
+        # Stable sort keeps region/volume order for volumes idle the same time
+        all_unattached_volumes.sort(key=lambda x: x.IdleDays, reverse=True)
+        return all_snapshots, all_unattached_volumes
+
+
+class WorkUnit(NamedTuple):
+    """One (account, region) shard of an organization scan"""
+    account_id: str
+    region: str
+
+
+class WorkResult(NamedTuple):
+    """What a worker reports back for one work unit"""
+    unit: WorkUnit
+    snapshots: List[SnapshotRecord]
+    volumes: List[VolumeRecord]
+    error: Optional[str] = None
+
+
+class OrganizationScan:
+    """Coordinator of an inventory across the accounts of an organization.
+
+    Every (account, region) work unit is put on a work queue drained by a
+    pool of workers. A worker scans its unit through the role assumed in
+    the account and puts a WorkResult on the result queue, which the
+    coordinator merges into one consolidated inventory. In-process worker
+    threads and queue.Queue stand in for worker Lambdas and a message
+    queue, so the protocol runs locally without any extra infrastructure.
+
+    Member accounts share the coordinator's time budget: their collectors
+    stop with the rest of the invocation and their units are checkpointed
+    per account with the coordinator's.
+    """
+
+    def __init__(self, inventory: SnapshotInventory, max_workers: Optional[int] = None):
+        self.inventory = inventory
+        self.max_workers = max_workers or max(1, _env_int('ORG_MAX_WORKERS', inventory.max_workers))
+        self._inventories = inventory.member_inventories
+        self._buffer_records = inventory.checkpoint_buffer_records
+        self._failed_accounts: Dict[str, str] = {}
+        self._account_locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def get_target_accounts(self) -> List[str]:
+        """Accounts listed in ORG_ACCOUNT_IDS, or every active account of the organization"""
+        configured = [account.strip() for account in os.environ.get('ORG_ACCOUNT_IDS', '').split(',')
+                      if account.strip()]
+        if configured:
+            return sorted(set(configured))
+
+        accounts = self.inventory.paginate('organizations', 'list_accounts', 'Accounts',
+                                           None, 'ACCOUNTS', resumable=False)
+        return sorted(account['Id'] for account in accounts if account.get('Status') == 'ACTIVE')
+
+    def get_account_regions(self, account_id: str) -> List[str]:
+        """Regions enabled in an account, discovered through the role assumed in it"""
+        try:
+            return self.get_account_inventory(account_id).get_all_regions()
+        except Exception as e:
+            # None of the account is scanned, so the delta and rollup carry it over
+            print(f"Error setting up account {account_id}: {str(e)}")
+            self.inventory.stats.record_error('global', 'ACCOUNT')
+            self.inventory.stats.record_failed_account(account_id)
+            return []
+
+    def get_work_units(self) -> List[WorkUnit]:
+        """Shard the scan into (account, region) units, ordered by account then region.
+
+        A continuation scans the accounts of its checkpoint in the regions
+        discovered by the first invocation, except those that already failed.
+        """
+        if self.inventory.member_states is not None:
+            accounts = [account_id for account_id in sorted(self.inventory.member_states)
+                        if account_id not in self.inventory.stats.failed_accounts]
+        else:
+            accounts = self.get_target_accounts()
+
+        # Every account holds its share of the finished units kept for a checkpoint
+        if self._buffer_records and accounts:
+            self._buffer_records = max(1, self._buffer_records // len(accounts))
+
+        tasks = [(f"regions of account {account_id}", self.get_account_regions, (account_id,))
+                 for account_id in accounts]
+        regions = self.inventory.run_parallel(tasks)
+        return [WorkUnit(account_id, region)
+                for account_id, account_regions in zip(accounts, regions) for region in account_regions]
+
+    def get_account_inventory(self, account_id: str) -> SnapshotInventory:
+        """Inventory of one account, shared by the workers scanning its regions.
+
+        The account's role is assumed once, when its first unit is picked
+        up; if that fails every unit of the account fails with the same error.
+        """
+        with self._lock:
+            account_lock = self._account_locks.setdefault(account_id, threading.Lock())
+
+        # Accounts are set up concurrently, each one only once
+        with account_lock:
+            if account_id in self._failed_accounts:
+                raise RuntimeError(self._failed_accounts[account_id])
+            inventory = self._inventories.get(account_id)
+            if inventory is None:
+                # The coordinator's own account needs no assumed role
+                member = None if account_id == self.inventory.account_id else account_id
+                try:
+                    if member:
+                        get_account_session(member)
+                except Exception as e:
+                    self._failed_accounts[account_id] = str(e)
+                    raise
+                inventory = SnapshotInventory(member)
+                inventory.account_id = account_id
+                inventory.full_scan = self.inventory.full_scan
+                inventory.scan_started_at = self.inventory.scan_started_at
+                inventory.age_bucketer = self.inventory.age_bucketer
+                inventory.billed_budget = self.inventory.billed_budget
+                inventory.context = self.inventory.context
+                inventory.max_continuations = self.inventory.max_continuations
+                inventory.checkpoint_buffer_records = self._buffer_records
+                state = (self.inventory.member_states or {}).get(account_id)
+                if state:
+                    inventory.restore_unit_state(state)
+                self._inventories[account_id] = inventory
+            return inventory
+
+    def scan_unit(self, unit: WorkUnit) -> WorkResult:
+        """Scan one work unit, reporting failures in the result instead of raising"""
+        try:
+            inventory = self.get_account_inventory(unit.account_id)
+            snapshots, volumes = inventory.scan_region(unit.region)
+        except Exception as e:
+            return WorkResult(unit, [], [], str(e))
+        return WorkResult(unit, snapshots, volumes)
+
+    def work(self, work_queue: queue.Queue, result_queue: queue.Queue):
+        """Worker loop: scan units from the work queue until a None sentinel arrives"""
+        while True:
+            unit = work_queue.get()
+            if unit is None:
+                return
+            result_queue.put(self.scan_unit(unit))
+
+    def run(self, on_snapshots: Optional[Callable[[List[SnapshotRecord]], None]] = None
+            ) -> Tuple[List[SnapshotRecord], List[VolumeRecord]]:
+        """Scan every work unit and merge the results in unit order.
+
+        Given on_snapshots, each unit's snapshots are streamed to it instead
+        of being collected into the returned list.
+        """
+        units = self.get_work_units()
+        workers = min(self.max_workers, len(units))
+        print(f"Processing {len(units)} account x region units with {workers} workers")
+
+        work_queue: queue.Queue = queue.Queue()
+        result_queue: queue.Queue = queue.Queue()
+        for unit in units:
+            work_queue.put(unit)
+        for _ in range(workers):
+            work_queue.put(None)
+
+        all_snapshots: List[SnapshotRecord] = []
+        all_unattached_volumes: List[VolumeRecord] = []
+        emit_snapshots = on_snapshots or all_snapshots.extend
+
+        def release(unit, result):
+            if result.error:
+                print(f"Error scanning {unit.region} of account {unit.account_id}: {result.error}")
+                self.inventory.stats.record_error(unit.region, 'ACCOUNT')
+                # None of the account's snapshots in the region were listed
+                for collector in self.inventory.collectors:
+                    self.inventory.stats.record_failed_unit(unit.account_id, unit.region, collector)
+            emit_snapshots(result.snapshots)
+            all_unattached_volumes.extend(result.volumes)
+
+        # Results arrive in completion order; releasing them in unit order
+        # keeps the consolidated reports stable from run to run
+        buffer = ReorderBuffer(units, release)
+        threads = [threading.Thread(target=self.work, args=(work_queue, result_queue), daemon=True)
+                   for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        for _ in units:
+            result = result_queue.get()
+            buffer.put(result.unit, result)
+        for thread in threads:
+            thread.join()
+
+        for inventory in self._inventories.values():
+            self.inventory.stats.merge(inventory.stats)
+
+        all_unattached_volumes.sort(key=lambda x: x.IdleDays, reverse=True)
+        return all_snapshots, all_unattached_volumes
+
+
+def profile_call(func: Callable, *args, limit: int = PROFILE_TOP_FUNCTIONS):
+    """Run func under cProfile and log its hottest functions by cumulative time.
+
+    Only the calling thread is profiled; collector threads show up as the
+    time spent waiting on them.
+    """
+    import cProfile
+    import pstats
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args)
+    finally:
+        output = io.StringIO()
+        pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(limit)
+        print(output.getvalue())
+
+
+def json_escaped_length(text: str) -> int:
+    """Size of a string inside a JSON document, as SNS counts it"""
+    return len(json.dumps(text)) - 2
+
+
+def get_sns_summary_budget(links: str) -> int:
+    """Size the summary may take in the SNS message, which carries it twice"""
+    overhead = len(json.dumps({'default': '', 'email': links}))
+    return (SNS_MAX_MESSAGE_BYTES - overhead) // 2
+
+
+def emit_metrics(inventory: 'SnapshotInventory'):
+    """Log the run's stats as EMF lines, which CloudWatch turns into metrics"""
+    if not _env_bool('EMF_METRICS', True):
+        return
+    namespace = os.environ.get('METRICS_NAMESPACE', DEFAULT_METRICS_NAMESPACE)
+    for document in inventory.stats.to_emf(namespace, inventory.account_id):
+        print(json.dumps(document, separators=(',', ':')))
+
 
 def lambda_handler(event, context):
-    inventory = SnapshotInventory()
+    # {"profile": true} in the event logs a cProfile report of the run
+    if isinstance(event, dict) and event.get('profile'):
+        return profile_call(generate_inventory, event, context)
+    return generate_inventory(event, context)
+
+
+def generate_inventory(event, context=None):
+    inventory = SnapshotInventory(context=context)
+
+    # {"trend": {"days": 90, "by": ["region"]}} answers from the rollup
+    # without scanning
+    if isinstance(event, dict) and isinstance(event.get('trend'), dict):
+        query = event['trend']
+        days = int(query.get('days', 90))
+        by = tuple(query.get('by', ()))
+        return {
+            'statusCode': 200,
+            'body': json.dumps({'days': days, 'by': list(by), 'trend': inventory.get_trend(days, by)})
+        }
+
+    # {"full_scan": true} in the event forces a rescan of the whole history
+    if isinstance(event, dict) and event.get('full_scan'):
+        inventory.full_scan = True
+
+    # {"continuation": key} resumes a run that ran out of time
+    checkpoint_key = event.get('continuation') if isinstance(event, dict) else None
+    continuations = inventory.load_checkpoint(checkpoint_key) if checkpoint_key else 0
+    inventory.set_time_budget(context)
+
     timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     
     # Create email subject with account ID and timestamp
-    email_subject = f"{inventory.email_subject} - Account {inventory.account_id} - {timestamp}"
-    
-    # Get snapshots from all regions
-    snapshots = inventory.get_all_regions_snapshots()
+    scope = 'Organization' if inventory.org_mode else 'Account'
+    email_subject = f"{inventory.email_subject} - {scope} {inventory.account_id} - {timestamp}"
     
-    # Get unattached volumes from all regions
-    unattached_volumes = inventory.get_all_regions_unattached_volumes()
+    run_time = datetime.now()
+    timestamp = run_time.strftime('%Y%m%d_%H%M%S')
+    output_format = inventory.output_format
+    if output_format != 'csv' and _import_pyarrow() is None:
+        print("pyarrow is not available, writing CSV reports instead of Parquet")
+        output_format = 'csv'
+    csv_suffix = '.csv.gz' if inventory.csv_gzip else '.csv'
+    csv_filename = f'snapshot_inventory_{inventory.account_id}_{timestamp}{csv_suffix}'
+    parquet_key = inventory.get_parquet_key('snapshot_inventory', run_time, timestamp)
 
-    # Generate CSV file
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    csv_filename = f'snapshot_inventory_{inventory.account_id}_{timestamp}.csv'
-    
-    # Create CSV in memory
-    csv_buffer = io.StringIO()
-    writer = csv.DictWriter(csv_buffer, 
-                          fieldnames=['Id', 'Type', 'Region', 'StartTime', 
-                                    'Size', 'Age', 'AgeGroup'])
-    writer.writeheader()
-    writer.writerows(snapshots)
-    
-    # Upload CSV to S3
-    inventory.s3_client.put_object(
-        Bucket=inventory.s3_bucket,
-        Key=csv_filename,
-        Body=csv_buffer.getvalue()
-    )
-    
-    # Unattached volumes CSV
-    volumes_csv_filename = f'unattached_volumes_{inventory.account_id}_{timestamp}.csv'
-    volumes_csv_buffer = io.StringIO()
-    volumes_writer = csv.DictWriter(volumes_csv_buffer,
-                                  fieldnames=['VolumeId', 'Region', 'Size', 'State', 
-                                            'IdleDays', 'VolumeType', 'CreateTime'])
-    volumes_writer.writeheader()
-    volumes_writer.writerows(unattached_volumes)
-    
-    # Upload volumes CSV to S3
-    inventory.s3_client.put_object(
-        Bucket=inventory.s3_bucket,
-        Key=volumes_csv_filename,
-        Body=volumes_csv_buffer.getvalue()
-    )
+    # The snapshot reports, summary and index consume the scan's snapshots
+    # unit by unit as they are released, so the run never holds them all
+    sinks: Dict[str, ReportSink] = {}
+    if output_format in ('csv', 'both'):
+        sinks['csv'] = inventory.open_csv_sink(csv_filename, SNAPSHOT_CSV_FIELDS)
+    if output_format in ('parquet', 'both'):
+        sinks['parquet'] = inventory.open_parquet_sink(parquet_key, SNAPSHOT_PARQUET_TYPES)
+    aggregator = SummaryAggregator(inventory.age_bucketer.labels)
+    index = SnapshotIndexBuilder() if inventory.delta_report else None
+
+    def consume(snapshots: List[SnapshotRecord]):
+        for sink in sinks.values():
+            sink.add(snapshots)
+        aggregator.add_snapshots(snapshots)
+        if index:
+            index.add(snapshots)
+
+    # Get snapshots and unattached volumes from all regions in one pass,
+    # across every target account in organization mode
+    try:
+        with inventory.stats.stage('scan'):
+            if inventory.org_mode:
+                _, unattached_volumes = OrganizationScan(inventory).run(consume)
+            else:
+                _, unattached_volumes = inventory.scan_all_regions(on_snapshots=consume)
+    except Exception:
+        for sink in sinks.values():
+            sink.abort(failed=True)
+        raise
+
+    pending_units = inventory.get_pending_units()
+    if pending_units:
+        if continuations < inventory.max_continuations:
+            # The continuation writes the reports once the scan is complete
+            for sink in sinks.values():
+                sink.abort()
+            return inventory.continue_scan(context, continuations + 1)
+        # Report what was collected rather than chaining invocations forever
+        print(f"Giving up on {len(pending_units)} units after {continuations} continuations")
+        for account_id, region, collector in pending_units:
+            inventory.stats.record_error(region, collector, account_id)
+    inventory.delete_units()
+    if checkpoint_key:
+        inventory.delete_checkpoint(checkpoint_key)
+
+    # Changes since the previous run, from the index it left behind
+    delta = None
+    if index:
+        with inventory.stats.stage('delta'):
+            delta = inventory.compute_delta(index.build(inventory.scan_started_at))
+
+    # (label, S3 key) of every report written
+    reports = []
+
+    # CSV files are streamed to S3 in multipart chunks
+    if output_format in ('csv', 'both'):
+        sinks['csv'].close()
+
+        # Unattached volumes CSV
+        volumes_csv_filename = f'unattached_volumes_{inventory.account_id}_{timestamp}{csv_suffix}'
+        inventory.write_csv_report(volumes_csv_filename, VOLUME_CSV_FIELDS, unattached_volumes)
+        reports += [('Snapshots', csv_filename), ('Unattached Volumes', volumes_csv_filename)]
+
+    # Columnar reports partitioned by account and date
+    if output_format in ('parquet', 'both'):
+        sinks['parquet'].close()
+
+        volumes_parquet_key = inventory.get_parquet_key('unattached_volumes', run_time, timestamp)
+        inventory.write_parquet_report(volumes_parquet_key, VOLUME_PARQUET_TYPES, unattached_volumes)
+        reports += [('Snapshots (Parquet)', parquet_key),
+                    ('Unattached Volumes (Parquet)', volumes_parquet_key)]
+
+    # The diff itself is a small CSV artifact next to the reports
+    if delta:
+        delta_filename = f'snapshot_delta_{inventory.account_id}_{timestamp}{csv_suffix}'
+        inventory.write_csv_report(delta_filename, DELTA_CSV_FIELDS, delta[1])
+        reports.append(('Changes Since Last Run', delta_filename))
+
+    # Today's aggregates join the daily rollup, which the growth is computed from
+    growth = None
+    if inventory.trend_rollup:
+        with inventory.stats.stage('rollup'):
+            growth = inventory.update_rollup(aggregator)
 
     # Generate summary and send email
-    summary = inventory.generate_summary(snapshots)
-    
+    with inventory.stats.stage('summary'):
+        aggregator.add_volumes(unattached_volumes)
+        inventory_summary = inventory.finish_summary(aggregator, summarize_delta(*delta) if delta else None,
+                                                     growth)
+
+        # The same summary feeds the optional HTML and JSON summary reports
+        summary_formats = [fmt.strip().lower() for fmt in os.environ.get('SUMMARY_FORMATS', '').split(',')]
+        for fmt in ('html', 'json'):
+            if fmt in summary_formats:
+                key = f'snapshot_summary_{inventory.account_id}_{timestamp}.{fmt}'
+                inventory.s3_client.put_object(
+                    Bucket=inventory.s3_bucket, Key=key,
+                    Body=inventory.format_summary(inventory_summary, fmt).encode('utf-8'),
+                    ContentType='text/html' if fmt == 'html' else 'application/json')
+                reports.append((f'Summary ({fmt.upper()})', key))
+
+        links = f"\n\nDetailed reports available in S3:\n" + \
+            "\n".join(f"{label}: s3://{inventory.s3_bucket}/{key}" for label, key in reports)
+        summary = inventory.format_summary(inventory_summary, budget=get_sns_summary_budget(links),
+                                           measure=json_escaped_length)
+
     # Create SNS message with S3 links
     message = {
         'default': summary,
-        'email': summary + f"\n\nDetailed reports available in S3:\n" +
-                f"Snapshots: s3://{inventory.s3_bucket}/{csv_filename}\n" +
-                f"Unattached Volumes: s3://{inventory.s3_bucket}/{volumes_csv_filename}"
+        'email': summary + links
     }
 
     # Publish to SNS
-    inventory.sns_client.publish(
-        TopicArn=inventory.sns_topic_arn,
-        Message=json.dumps(message),
-        MessageStructure='json',
-        Subject=email_subject
-    )
+    with inventory.stats.stage('publish') as stage:
+        body = json.dumps(message)
+        stage['bytes'] = len(body.encode('utf-8'))
+        inventory.sns_client.publish(
+            TopicArn=inventory.sns_topic_arn,
+            Message=body,
+            MessageStructure='json',
+            Subject=email_subject
+        )
+    emit_metrics(inventory)
     
     return {
         'statusCode': 200,
         'body': json.dumps({
             'message': 'Snapshot inventory processed successfully',
-            'csv_file': csv_filename
+            'csv_file': csv_filename if output_format != 'parquet' else None,
+            'reports': [key for _, key in reports],
+            'api_stats': inventory.stats.to_dict(),
+            'summary': {key: value for key, value in inventory_summary.to_dict().items()
+                        if key not in ('volumes_by_region', 'api_stats')}
         })
     }
@@ -32,6 +32,7 @@ resource "aws_iam_role_policy" "lambda_policy" {
           "ec2:DescribeRegions",
           "ec2:DescribeSnapshots",
           "ec2:DescribeVolumes",
+          "ec2:DescribeImages",
           
           # RDS Permissions
           "rds:DescribeDBSnapshots",
@@ -45,8 +46,31 @@ resource "aws_iam_role_policy" "lambda_policy" {
           "backup:ListBackupVaults",
           "backup:ListRecoveryPointsByBackupVault",
           
+          # Opt-in collectors (COLLECTORS): DynamoDB and FSx backups
+          "dynamodb:ListBackups",
+          "fsx:DescribeBackups",
+          
+          # Billed EBS snapshot sizes (BILLED_SIZE) through the EBS direct APIs
+          "ebs:ListChangedBlocks",
+          "ebs:ListSnapshotBlocks",
+          
+          # Idle detection of unattached volumes: last I/O, optionally DetachVolume events
+          "cloudwatch:GetMetricData",
+          "cloudtrail:LookupEvents",
+          
+          # Continuations: the function re-invokes itself when out of time
+          "lambda:InvokeFunction",
+          
+          # Organization mode: list member accounts and assume the scan role in them
+          "organizations:ListAccounts",
+          "sts:AssumeRole",
+          
           # S3 and SNS Permissions
           "s3:PutObject",
+          "s3:GetObject",
+          "s3:ListBucket",
+          "s3:AbortMultipartUpload",
+          "s3:DeleteObject",
           "sns:Publish",
           
           # CloudWatch Logs Permissions
@@ -0,0 +1,1795 @@
+import contextlib
+import csv
+import gzip
+import io
+import json
+import os
+import queue
+import random
+import sys
+import unittest
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+
+from botocore.exceptions import ClientError, EndpointConnectionError
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src'))
+
+import lambda_function  # noqa: E402
+
+NOW = datetime.now(timezone.utc)
+
+# Response key holding the items of each paginated operation
+RESULT_KEYS = {
+    'describe_snapshots': 'Snapshots',
+    'describe_db_snapshots': 'DBSnapshots',
+    'list_backup_jobs': 'BackupJobs',
+    'describe_volumes': 'Volumes',
+    'list_accounts': 'Accounts',
+    'describe_db_cluster_snapshots': 'DBClusterSnapshots',
+    'list_backups': 'BackupSummaries',
+    'describe_backups': 'Backups',
+    'describe_images': 'Images',
+    'list_backup_vaults': 'BackupVaultList',
+    'list_recovery_points_by_backup_vault': 'RecoveryPoints',
+    'list_changed_blocks': 'ChangedBlocks',
+    'list_snapshot_blocks': 'Blocks',
+    'get_metric_data': 'MetricDataResults',
+    'lookup_events': 'Events',
+    'describe_db_instances': 'DBInstances'
+}
+
+
+class FakeClient:
+    """Minimal stand-in for a boto3 client serving canned pages"""
+
+    def __init__(self, service, region=None, pages=None, errors=None, objects=None):
+        self.service = service
+        self.region = region
+        self.pages = pages or {}
+        self.errors = errors or {}
+        self.objects = objects if objects is not None else {}
+        self.calls = []
+
+    def __getattr__(self, operation):
+        if operation not in RESULT_KEYS:
+            raise AttributeError(operation)
+        return lambda **kwargs: self.page(operation, **kwargs)
+
+    def page(self, operation, **kwargs):
+        """Serve one page, raising the operation's queued errors first"""
+        self.calls.append((operation, kwargs))
+        error = self.errors.get(operation)
+        if isinstance(error, list):
+            # Queued outcomes: None lets the call through, an exception fails it
+            error = error.pop(0) if error else None
+        if error:
+            raise error
+        input_token, output_token, _ = lambda_function.PAGINATION_TOKENS[operation]
+        pages = self.pages.get(operation, [])
+        index = int(kwargs.get(input_token, 0))
+        response = {RESULT_KEYS[operation]: pages[index] if pages else []}
+        if index + 1 < len(pages):
+            response[output_token] = str(index + 1)
+        return response
+
+    def describe_regions(self):
+        self.calls.append(('describe_regions', {}))
+        if self.errors.get('describe_regions'):
+            raise self.errors['describe_regions']
+        return {'Regions': [{'RegionName': name} for name in self.pages.get('regions', [])]}
+
+    def assume_role(self, **kwargs):
+        self.calls.append(('assume_role', kwargs))
+        account_id = kwargs['RoleArn'].split(':')[4]
+        error = self.errors.get('assume_role', {}).get(account_id)
+        if error:
+            raise error
+        # The access key tells the patched Session which account it is for
+        return {'Credentials': {'AccessKeyId': account_id, 'SecretAccessKey': 'secret',
+                                'SessionToken': 'token', 'Expiration': NOW + timedelta(hours=1)}}
+
+    def get_caller_identity(self):
+        self.calls.append(('get_caller_identity', {}))
+        return {'Account': '123456789012'}
+
+    def put_object(self, **kwargs):
+        self.calls.append(('put_object', kwargs))
+        body = kwargs['Body']
+        self.objects[kwargs['Key']] = body.encode() if isinstance(body, str) else body
+        return {}
+
+    def create_multipart_upload(self, **kwargs):
+        self.calls.append(('create_multipart_upload', kwargs))
+        self.objects.setdefault('_uploads', {})[kwargs['Key']] = []
+        return {'UploadId': f"upload-{kwargs['Key']}"}
+
+    def upload_part(self, **kwargs):
+        self.calls.append(('upload_part', kwargs))
+        self.objects['_uploads'][kwargs['Key']].append(kwargs['Body'])
+        return {'ETag': f"etag-{kwargs['PartNumber']}"}
+
+    def complete_multipart_upload(self, **kwargs):
+        self.calls.append(('complete_multipart_upload', kwargs))
+        self.objects[kwargs['Key']] = b''.join(self.objects['_uploads'].pop(kwargs['Key']))
+        return {}
+
+    def abort_multipart_upload(self, **kwargs):
+        self.calls.append(('abort_multipart_upload', kwargs))
+        self.objects['_uploads'].pop(kwargs['Key'])
+        return {}
+
+    def get_object(self, **kwargs):
+        self.calls.append(('get_object', kwargs))
+        if kwargs['Key'] not in self.objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey', 'Message': 'Not found'}}, 'GetObject')
+        return {'Body': io.BytesIO(self.objects[kwargs['Key']])}
+
+    def delete_object(self, **kwargs):
+        self.calls.append(('delete_object', kwargs))
+        self.objects.pop(kwargs['Key'], None)
+        return {}
+
+    def delete_objects(self, **kwargs):
+        self.calls.append(('delete_objects', kwargs))
+        for item in kwargs['Delete']['Objects']:
+            self.objects.pop(item['Key'], None)
+        return {}
+
+    def publish(self, **kwargs):
+        self.calls.append(('publish', kwargs))
+        return {'MessageId': 'msg-1'}
+
+    def invoke(self, **kwargs):
+        self.calls.append(('invoke', kwargs))
+        return {'StatusCode': 202}
+
+
+class FakeAWS:
+    """Stands in for a boto3 Session, routing client() calls to FakeClient instances"""
+
+    region_name = None
+
+    def __init__(self, regions, pages=None, errors=None):
+        self.regions = regions
+        self.pages = pages or {}
+        self.errors = errors or {}
+        self.objects = {}
+        self.clients = []
+
+    def calls(self, operation, service=None):
+        """All recorded calls of an operation, optionally for one service"""
+        return [(client.region, kwargs) for client in self.clients
+                if service in (None, client.service)
+                for name, kwargs in client.calls if name == operation]
+
+    def client(self, service, region_name=None, **kwargs):
+        pages = dict(self.pages.get((service, region_name), {}))
+        if service == 'ec2' and region_name is None:
+            pages['regions'] = self.regions
+        client = FakeClient(service, region_name, pages,
+                            self.errors.get((service, region_name)), self.objects)
+        self.clients.append(client)
+        return client
+
+
+def ebs_snapshot(snapshot_id, days_old, size=8):
+    return {'SnapshotId': snapshot_id, 'StartTime': NOW - timedelta(days=days_old),
+            'VolumeSize': size}
+
+
+def rds_snapshot(snapshot_id, days_old, size=20):
+    return {'DBSnapshotIdentifier': snapshot_id,
+            'SnapshotCreateTime': NOW - timedelta(days=days_old),
+            'AllocatedStorage': size}
+
+
+def backup_job(job_id, days_old, state='COMPLETED', size_bytes=1024 ** 3):
+    return {'BackupJobId': job_id, 'State': state,
+            'CreationDate': NOW - timedelta(days=days_old),
+            'BackupSizeInBytes': size_bytes}
+
+
+def volume(volume_id, size=10, attached=False):
+    return {'VolumeId': volume_id, 'Size': size, 'State': 'in-use' if attached else 'available',
+            'Attachments': [{'InstanceId': 'i-1'}] if attached else [],
+            'VolumeType': 'gp3', 'CreateTime': NOW - timedelta(days=3)}
+
+
+class InventoryTestCase(unittest.TestCase):
+    regions = ['us-east-1', 'eu-west-1']
+    pages = {}
+    errors = {}
+
+    def setUp(self):
+        env = patch.dict(os.environ, {
+            'S3_BUCKET_NAME': 'test-bucket',
+            'SNS_TOPIC_ARN': 'arn:aws:sns:us-east-1:123456789012:test',
+            'SCAN_MAX_WORKERS': '4'
+        })
+        env.start()
+        self.addCleanup(env.stop)
+
+        self.aws = FakeAWS(self.regions, self.pages, self.errors)
+        session_patch = patch('boto3.session.Session', return_value=self.aws)
+        session_patch.start()
+        self.addCleanup(session_patch.stop)
+        lambda_function._reset_client_pool()
+        self.addCleanup(lambda_function._reset_client_pool)
+
+        self.inventory = lambda_function.SnapshotInventory()
+
+
+class TestParallelScan(InventoryTestCase):
+    pages = {
+        ('ec2', 'us-east-1'): {
+            'describe_snapshots': [[ebs_snapshot('snap-b', 3)], [ebs_snapshot('snap-a', 40)]],
+            'describe_volumes': [[volume('vol-1', attached=True), volume('vol-2')]]
+        },
+        ('ec2', 'eu-west-1'): {
+            'describe_snapshots': [[ebs_snapshot('snap-c', 400)]],
+            'describe_volumes': [[volume('vol-3')]]
+        },
+        ('rds', 'eu-west-1'): {
+            'describe_db_snapshots': [[rds_snapshot('db-snap', 10)]]
+        },
+        ('backup', 'us-east-1'): {
+            'list_backup_jobs': [[backup_job('job-1', 1), backup_job('job-2', 1, state='FAILED')]]
+        }
+    }
+    errors = {
+        ('rds', 'us-east-1'): {'describe_db_snapshots': RuntimeError('AccessDenied')}
+    }
+
+    def test_results_are_ordered_by_region_then_type(self):
+        snapshots = self.inventory.get_all_regions_snapshots()
+
+        self.assertEqual(
+            [(s.Region, s.Type, s.Id) for s in snapshots],
+            [('eu-west-1', 'EBS', 'snap-c'),
+             ('eu-west-1', 'RDS', 'db-snap'),
+             ('us-east-1', 'EBS', 'snap-a'),
+             ('us-east-1', 'EBS', 'snap-b'),
+             ('us-east-1', 'EFS', 'job-1')])
+
+    def test_failing_collector_does_not_drop_other_services(self):
+        snapshots = self.inventory.get_snapshots_for_region('us-east-1')
+
+        self.assertEqual({s.Type for s in snapshots}, {'EBS', 'EFS'})
+
+    def test_unattached_volumes_from_all_regions(self):
+        volumes = self.inventory.get_all_regions_unattached_volumes()
+
+        self.assertEqual([v.VolumeId for v in volumes], ['vol-3', 'vol-2'])
+
+    def test_run_parallel_isolates_task_errors(self):
+        def fail():
+            raise ValueError('boom')
+
+        results = self.inventory.run_parallel([
+            ('ok', lambda: [1], ()),
+            ('fail', fail, ()),
+            ('ok again', lambda: [2], ())
+        ])
+
+        self.assertEqual(results, [[1], [], [2]])
+
+    def test_snapshots_are_streamed_in_unit_order(self):
+        chunks = []
+        snapshots, _ = self.inventory.scan_all_regions(on_snapshots=chunks.append)
+
+        self.assertEqual(snapshots, [])
+        self.assertEqual([[s.Id for s in chunk] for chunk in chunks],
+                         [['snap-c'], ['db-snap'], [], ['snap-a', 'snap-b'], [], ['job-1']])
+        # Without a time budget there is no checkpoint to keep results for
+        self.assertEqual(self.inventory.completed_units, {})
+
+    def test_reorder_buffer_releases_in_key_order(self):
+        released = []
+        buffer = lambda_function.ReorderBuffer('abc', lambda key, value: released.append((key, value)))
+
+        buffer.put('c', 3)
+        self.assertEqual(released, [])
+        buffer.put('a', 1)
+        self.assertEqual(released, [('a', 1)])
+        buffer.put('b', 2)
+        self.assertEqual(released, [('a', 1), ('b', 2), ('c', 3)])
+
+
+class TestUnifiedScan(InventoryTestCase):
+    pages = TestParallelScan.pages
+
+    def test_handler_visits_each_region_once(self):
+        lambda_function.lambda_handler({}, None)
+
+        self.assertEqual(len(self.aws.calls('describe_regions')), 1)
+        self.assertEqual(sorted(region for region, _ in self.aws.calls('describe_volumes')),
+                         ['eu-west-1', 'us-east-1'])
+        ec2_clients = [c.region for c in self.aws.clients if c.service == 'ec2' and c.region]
+        self.assertEqual(sorted(ec2_clients), ['eu-west-1', 'us-east-1'])
+
+    def test_summary_uses_given_volumes(self):
+        summary = self.inventory.generate_summary([], [
+            lambda_function.VolumeRecord('vol-9', 'eu-west-1', 5, 'available', 0, 'gp3', NOW)])
+
+        self.assertIn('Total Unattached Volumes: 1', summary)
+        self.assertEqual(self.aws.calls('describe_volumes'), [])
+
+
+class TestClientPool(InventoryTestCase):
+    def test_warm_invocation_makes_no_setup_calls(self):
+        clients_after_cold_start = len(self.aws.clients)
+
+        inventory = lambda_function.SnapshotInventory()
+
+        self.assertEqual(len(self.aws.clients), clients_after_cold_start)
+        self.assertEqual(len(self.aws.calls('get_caller_identity')), 1)
+        self.assertIs(inventory.s3_client, self.inventory.s3_client)
+
+    def test_cold_start_builds_clients_on_first_use(self):
+        lambda_function._reset_client_pool()
+        self.aws.clients.clear()
+
+        inventory = lambda_function.SnapshotInventory(context=FakeContext(1))
+
+        self.assertEqual(inventory.account_id, '123456789012')
+        self.assertEqual(self.aws.clients, [])
+        inventory.get_all_regions()
+        self.assertEqual([c.service for c in self.aws.clients], ['ec2'])
+
+    def test_clients_are_pooled_per_service_and_region(self):
+        ec2 = lambda_function.get_client('ec2', 'eu-west-1')
+
+        self.assertIs(lambda_function.get_client('ec2', 'eu-west-1'), ec2)
+        self.assertIsNot(lambda_function.get_client('rds', 'eu-west-1'), ec2)
+        self.assertIsNot(lambda_function.get_client('ec2', 'us-east-1'), ec2)
+
+    def test_connection_pool_size_is_configurable(self):
+        with patch.dict(os.environ, {'BOTO_MAX_POOL_CONNECTIONS': '32'}), \
+                patch.object(self.aws, 'client', wraps=self.aws.client) as client:
+            lambda_function.get_client('backup', 'ap-south-1')
+
+        config = client.call_args.kwargs['config']
+        self.assertEqual(config.max_pool_connections, 32)
+
+
+class TestCollectorFilters(InventoryTestCase):
+    pages = TestParallelScan.pages
+
+    def test_backup_jobs_are_filtered_server_side(self):
+        self.inventory.get_efs_backups_for_region('us-east-1')
+
+        [(_, kwargs)] = self.aws.calls('list_backup_jobs')
+        self.assertEqual(kwargs['ByState'], 'COMPLETED')
+        self.assertEqual(kwargs['MaxResults'], 1000)
+        self.assertNotIn('ByCreatedAfter', kwargs)
+
+    def test_filters_are_configurable_per_type(self):
+        overrides = {'efs': {'created_after_days': 30, 'page_size': 50},
+                     'EBS': {'states': ['completed']}}
+        with patch.dict(os.environ, {'COLLECTOR_FILTERS': json.dumps(overrides)}):
+            inventory = lambda_function.SnapshotInventory()
+        inventory.get_efs_backups_for_region('us-east-1')
+        snapshots = inventory.get_ebs_snapshots_for_region('us-east-1')
+
+        [(_, backup_kwargs)] = self.aws.calls('list_backup_jobs')
+        self.assertEqual(backup_kwargs['MaxResults'], 50)
+        self.assertLess(NOW - backup_kwargs['ByCreatedAfter'], timedelta(days=30, minutes=1))
+        (_, ebs_kwargs), _ = self.aws.calls('describe_snapshots')
+        self.assertEqual(ebs_kwargs['Filters'], [{'Name': 'status', 'Values': ['completed']}])
+        self.assertEqual(len(snapshots), 2)
+
+    def test_invalid_filter_override_falls_back_to_defaults(self):
+        with patch.dict(os.environ, {'COLLECTOR_FILTERS': 'not json'}):
+            filters = lambda_function.load_collector_filters()
+
+        self.assertEqual(filters, lambda_function.DEFAULT_COLLECTOR_FILTERS)
+
+    def test_pages_and_items_are_counted(self):
+        self.inventory.scan_all_regions()
+
+        stats = self.inventory.stats.to_dict()
+        self.assertEqual(stats['by_collector']['EBS'],
+                         {'pages': 3, 'items': 3, 'throttles': 0, 'retries': 0})
+        # A region without backup jobs still answers with one empty page
+        self.assertEqual(stats['by_collector']['EFS'],
+                         {'pages': 2, 'items': 2, 'throttles': 0, 'retries': 0})
+        self.assertEqual(stats['by_collector']['VOLUMES'],
+                         {'pages': 2, 'items': 3, 'throttles': 0, 'retries': 0})
+        self.assertIn('API Usage:', self.inventory.generate_summary([], []))
+
+
+class TestCollectorRegistry(InventoryTestCase):
+    regions = ['us-east-1']
+    pages = {
+        ('rds', 'us-east-1'): {
+            'describe_db_cluster_snapshots': [[{
+                'DBClusterSnapshotIdentifier': 'cluster-snap', 'SnapshotCreateTime': NOW - timedelta(days=2),
+                'AllocatedStorage': 50, 'Status': 'available'}]]
+        },
+        ('dynamodb', 'us-east-1'): {
+            'list_backups': [[{'BackupArn': 'arn:aws:dynamodb:us-east-1:123456789012:table/t/backup/1',
+                               'BackupCreationDateTime': NOW - timedelta(days=1),
+                               'BackupSizeBytes': 2 * 1024 ** 3, 'BackupStatus': 'AVAILABLE'}],
+                             [{'BackupArn': 'arn:aws:dynamodb:us-east-1:123456789012:table/t/backup/2',
+                               'BackupCreationDateTime': NOW, 'BackupStatus': 'CREATING'}]]
+        },
+        ('fsx', 'us-east-1'): {
+            'describe_backups': [[{'BackupId': 'backup-1', 'CreationTime': NOW - timedelta(days=5),
+                                   'Lifecycle': 'AVAILABLE', 'FileSystem': {'StorageCapacity': 1200}}]]
+        },
+        ('ec2', 'us-east-1'): {
+            'describe_images': [[{'ImageId': 'ami-1',
+                                  'CreationDate': (NOW - timedelta(days=30)).strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                                  'BlockDeviceMappings': [{'DeviceName': '/dev/xvda', 'Ebs': {'VolumeSize': 8}},
+                                                          {'DeviceName': '/dev/sdb', 'VirtualName': 'ephemeral0'},
+                                                          {'DeviceName': '/dev/sdc', 'Ebs': {'VolumeSize': 100}}]}]]
+        },
+        ('backup', 'us-east-1'): {
+            'list_backup_vaults': [[{'BackupVaultName': 'Default', 'NumberOfRecoveryPoints': 2}]],
+            'list_recovery_points_by_backup_vault': [[
+                {'RecoveryPointArn': 'arn:aws:backup:us-east-1:123456789012:recovery-point:s3-1',
+                 'ResourceType': 'S3', 'CreationDate': NOW - timedelta(days=3),
+                 'BackupSizeInBytes': 1024 ** 3, 'Status': 'COMPLETED'},
+                # Also listed by the EBS collector
+                {'RecoveryPointArn': 'arn:aws:ec2:us-east-1::snapshot/snap-1', 'ResourceType': 'EBS',
+                 'CreationDate': NOW - timedelta(days=3), 'BackupSizeInBytes': 1024 ** 3,
+                 'Status': 'COMPLETED'}]]
+        }
+    }
+
+    def test_only_default_collectors_run_unless_configured(self):
+        self.assertEqual(self.inventory.collectors, ['EBS', 'RDS', 'EFS'])
+        self.inventory.get_all_regions_snapshots()
+
+        self.assertEqual(self.aws.calls('list_backups'), [])
+        self.assertEqual(self.aws.calls('describe_images'), [])
+
+    def test_opt_in_collectors_normalize_their_items(self):
+        with patch.dict(os.environ, {'COLLECTORS': 'backup,ami,fsx,dynamodb,aurora,ebs,unknown'}):
+            inventory = lambda_function.SnapshotInventory()
+        self.assertEqual(inventory.collectors, ['EBS', 'AURORA', 'DYNAMODB', 'FSX', 'AMI', 'BACKUP'])
+
+        snapshots = inventory.get_all_regions_snapshots()
+
+        self.assertEqual([(s.Type, s.Id, s.Size, s.Age) for s in snapshots], [
+            ('AURORA', 'cluster-snap', 50, 2),
+            ('DYNAMODB', 'arn:aws:dynamodb:us-east-1:123456789012:table/t/backup/1', 2.0, 1),
+            ('FSX', 'backup-1', 1200, 5),
+            ('AMI', 'ami-1', 108, 30),
+            ('BACKUP', 'arn:aws:backup:us-east-1:123456789012:recovery-point:s3-1', 1.0, 3)])
+        first_page, second_page = self.aws.calls('list_backups')
+        self.assertEqual(first_page[1], {'BackupType': 'ALL', 'Limit': 100})
+        self.assertEqual(second_page[1]['ExclusiveStartBackupArn'], '1')
+        [(_, images)] = self.aws.calls('describe_images')
+        self.assertEqual(images['Owners'], ['self'])
+        [(_, points)] = self.aws.calls('list_recovery_points_by_backup_vault')
+        self.assertEqual(points['BackupVaultName'], 'Default')
+        self.assertEqual(inventory.stats.by_collector()['BACKUP']['pages'], 2)
+
+    def test_recovery_points_of_disabled_collectors_are_kept(self):
+        with patch.dict(os.environ, {'COLLECTORS': 'BACKUP'}):
+            inventory = lambda_function.SnapshotInventory()
+
+        snapshots = inventory.get_all_regions_snapshots()
+
+        self.assertEqual(sorted(s.Id.rsplit(':', 1)[1] for s in snapshots), ['s3-1', 'snapshot/snap-1'])
+
+
+def throttle(code='Throttling'):
+    return ClientError({'Error': {'Code': code, 'Message': 'Rate exceeded'}}, 'Operation')
+
+
+class TestRateLimiting(InventoryTestCase):
+    regions = ['us-east-1']
+    pages = {
+        ('ec2', 'us-east-1'): {
+            'describe_snapshots': [[ebs_snapshot('snap-1', 1)], [ebs_snapshot('snap-2', 2)],
+                                   [ebs_snapshot('snap-3', 3)]]
+        }
+    }
+
+    def setUp(self):
+        super().setUp()
+        sleep = patch.object(lambda_function, '_sleep')
+        self.sleep = sleep.start()
+        self.addCleanup(sleep.stop)
+
+    def test_throttled_page_resumes_from_its_token(self):
+        self.aws.errors[('ec2', 'us-east-1')] = {
+            'describe_snapshots': [None, throttle(), throttle('RequestLimitExceeded')]
+        }
+        snapshots = self.inventory.get_ebs_snapshots_for_region('us-east-1')
+
+        self.assertEqual([s.Id for s in snapshots], ['snap-1', 'snap-2', 'snap-3'])
+        tokens = [kwargs.get('NextToken') for _, kwargs in self.aws.calls('describe_snapshots')]
+        self.assertEqual(tokens, [None, '1', '1', '1', '2'])
+        counter = self.inventory.stats.by_collector()['EBS']
+        self.assertEqual((counter['pages'], counter['throttles'], counter['retries']), (3, 2, 2))
+        self.assertFalse(self.inventory.stats.has_errors('us-east-1', 'EBS'))
+
+    def test_connection_errors_are_retried(self):
+        self.aws.errors[('ec2', 'us-east-1')] = {
+            'describe_snapshots': [None, EndpointConnectionError(endpoint_url='https://ec2.us-east-1.amazonaws.com')]
+        }
+        snapshots = self.inventory.get_ebs_snapshots_for_region('us-east-1')
+
+        self.assertEqual([s.Id for s in snapshots], ['snap-1', 'snap-2', 'snap-3'])
+        tokens = [kwargs.get('NextToken') for _, kwargs in self.aws.calls('describe_snapshots')]
+        self.assertEqual(tokens, [None, '1', '1', '2'])
+        counter = self.inventory.stats.by_collector()['EBS']
+        self.assertEqual((counter['throttles'], counter['retries']), (0, 1))
+        self.assertFalse(self.inventory.stats.has_errors('us-east-1', 'EBS'))
+
+    def test_botocore_throttle_codes_and_server_errors_are_retried(self):
+        server_error = ClientError({'Error': {'Code': 'Unavailable', 'Message': 'Oops'},
+                                    'ResponseMetadata': {'HTTPStatusCode': 502}}, 'Operation')
+        self.aws.errors[('ec2', 'us-east-1')] = {
+            'describe_snapshots': [throttle('EC2ThrottledException'), server_error]
+        }
+        snapshots = self.inventory.get_ebs_snapshots_for_region('us-east-1')
+
+        self.assertEqual(len(snapshots), 3)
+        counter = self.inventory.stats.by_collector()['EBS']
+        self.assertEqual((counter['throttles'], counter['retries']), (1, 2))
+
+    def test_other_errors_are_not_retried(self):
+        self.aws.errors[('ec2', 'us-east-1')] = {
+            'describe_snapshots': [throttle('UnauthorizedOperation')]
+        }
+        snapshots = self.inventory.get_ebs_snapshots_for_region('us-east-1')
+
+        self.assertEqual(snapshots, [])
+        self.assertEqual(len(self.aws.calls('describe_snapshots')), 1)
+        self.assertTrue(self.inventory.stats.has_errors('us-east-1', 'EBS'))
+
+    def test_retries_are_bounded(self):
+        with patch.dict(os.environ, {'API_MAX_RETRIES': '2'}):
+            inventory = lambda_function.SnapshotInventory()
+        self.aws.errors[('ec2', 'us-east-1')] = {'describe_snapshots': [throttle()] * 5}
+        snapshots = inventory.get_ebs_snapshots_for_region('us-east-1')
+
+        self.assertEqual(snapshots, [])
+        self.assertEqual(len(self.aws.calls('describe_snapshots')), 3)
+        self.assertTrue(inventory.stats.has_errors('us-east-1', 'EBS'))
+        # Full jitter: each wait is drawn below the doubling backoff ceiling
+        for (delay,), ceiling in zip((c.args for c in self.sleep.call_args_list), (0.5, 1.0)):
+            self.assertLessEqual(delay, ceiling)
+
+    def test_limiter_backs_off_and_recovers(self):
+        limiter = lambda_function.RateLimiter(10)
+        limiter.on_throttle()
+        limiter.on_throttle()
+        self.assertEqual(limiter.rate, 2.5)
+        for _ in range(100):
+            limiter.on_throttle()
+        self.assertEqual(limiter.rate, 0.5)
+        for _ in range(100):
+            limiter.on_success()
+        self.assertEqual(limiter.rate, 10)
+
+    def test_limiter_is_shared_per_endpoint(self):
+        limiter = lambda_function.get_rate_limiter('ec2', 'us-east-1')
+
+        self.assertIs(lambda_function.get_rate_limiter('ec2', 'us-east-1'), limiter)
+        self.assertIsNot(lambda_function.get_rate_limiter('ec2', 'eu-west-1'), limiter)
+
+    def test_botocore_retries_are_disabled_for_limited_services(self):
+        with patch.object(self.aws, 'client', wraps=self.aws.client) as client:
+            lambda_function.get_client('rds', 'us-east-1')
+            lambda_function.get_client('s3', 'us-east-1')
+
+        rds_config, s3_config = (c.kwargs['config'] for c in client.call_args_list)
+        self.assertEqual(rds_config.retries, {'total_max_attempts': 1})
+        self.assertIsNone(s3_config.retries)
+
+
+class TestOrganizationScan(InventoryTestCase):
+    regions = ['us-east-1', 'eu-west-1']
+    pages = {
+        ('organizations', None): {
+            'list_accounts': [[{'Id': '222222222222', 'Status': 'ACTIVE'},
+                               {'Id': '123456789012', 'Status': 'ACTIVE'}],
+                              [{'Id': '444444444444', 'Status': 'SUSPENDED'}]]
+        },
+        ('ec2', 'us-east-1'): {'describe_snapshots': [[ebs_snapshot('snap-own', 5)]]}
+    }
+    member_pages = {
+        ('ec2', 'eu-west-1'): {
+            'describe_snapshots': [[ebs_snapshot('snap-member', 50)]],
+            'describe_volumes': [[volume('vol-member')]]
+        }
+    }
+
+    def setUp(self):
+        super().setUp()
+        self.members = {'222222222222': FakeAWS(self.regions, self.member_pages),
+                        '333333333333': FakeAWS(self.regions)}
+        # Sessions built from assumed-role credentials get the member account's fakes
+        session_patch = patch(
+            'boto3.session.Session',
+            side_effect=lambda **kwargs: self.members.get(kwargs.get('aws_access_key_id'), self.aws))
+        session_patch.start()
+        self.addCleanup(session_patch.stop)
+
+    def test_accounts_are_listed_from_organizations(self):
+        scan = lambda_function.OrganizationScan(self.inventory)
+
+        self.assertEqual(scan.get_target_accounts(), ['123456789012', '222222222222'])
+        self.assertEqual(scan.get_work_units()[:2], [('123456789012', 'eu-west-1'),
+                                                     ('123456789012', 'us-east-1')])
+
+    def test_scan_merges_accounts_in_unit_order(self):
+        with patch.dict(os.environ, {'ORG_ROLE_NAME': 'InventoryReader'}):
+            snapshots, volumes = lambda_function.OrganizationScan(self.inventory, max_workers=3).run()
+
+        self.assertEqual([(s.AccountId, s.Id) for s in snapshots],
+                         [('123456789012', 'snap-own'), ('222222222222', 'snap-member')])
+        self.assertEqual([(v.AccountId, v.VolumeId) for v in volumes], [('222222222222', 'vol-member')])
+        [(_, kwargs)] = self.aws.calls('assume_role')
+        self.assertEqual(kwargs['RoleArn'], 'arn:aws:iam::222222222222:role/InventoryReader')
+        member_calls = self.members['222222222222'].calls('describe_snapshots')
+        self.assertEqual([kwargs['OwnerIds'] for _, kwargs in member_calls], [['222222222222']] * 2)
+        self.assertEqual(self.inventory.stats.by_collector()['EBS']['items'], 2)
+
+    def test_unreachable_account_does_not_stop_the_scan(self):
+        lambda_function.get_client('sts').errors['assume_role'] = {'333333333333': throttle('AccessDenied')}
+        with patch.dict(os.environ, {'ORG_ACCOUNT_IDS': '333333333333, 123456789012'}):
+            snapshots, _ = lambda_function.OrganizationScan(self.inventory).run()
+
+        self.assertEqual([s.Id for s in snapshots], ['snap-own'])
+        self.assertEqual(len(self.aws.calls('assume_role')), 1)
+        # Its regions are unknown, so the whole account is failed
+        self.assertTrue(self.inventory.stats.has_errors('global', 'ACCOUNT'))
+        self.assertTrue(self.inventory.stats.has_failed('333333333333', 'eu-west-1', 'EBS'))
+        self.assertFalse(self.inventory.stats.has_errors('us-east-1', 'EBS'))
+
+    def test_regions_are_discovered_per_account(self):
+        self.members['222222222222'].regions = ['eu-west-1', 'ap-south-1']
+        with patch.dict(os.environ, {'ORG_ACCOUNT_IDS': '222222222222,123456789012'}):
+            units = lambda_function.OrganizationScan(self.inventory).get_work_units()
+
+        self.assertEqual(units, [('123456789012', 'eu-west-1'), ('123456789012', 'us-east-1'),
+                                 ('222222222222', 'ap-south-1'), ('222222222222', 'eu-west-1')])
+        self.assertEqual(len(self.members['222222222222'].calls('describe_regions')), 1)
+
+    def test_failed_region_discovery_fails_only_its_account(self):
+        self.members['222222222222'].errors[('ec2', None)] = {'describe_regions': throttle('UnauthorizedOperation')}
+        with patch.dict(os.environ, {'ORG_ACCOUNT_IDS': '222222222222,123456789012'}):
+            snapshots, _ = lambda_function.OrganizationScan(self.inventory).run()
+
+        self.assertEqual([s.Id for s in snapshots], ['snap-own'])
+        self.assertTrue(self.inventory.stats.has_failed('222222222222', 'eu-west-1', 'EBS'))
+        self.assertFalse(self.inventory.stats.has_failed('123456789012', 'eu-west-1', 'EBS'))
+
+    def run_org_handler(self):
+        with patch.dict(os.environ, {'ORG_MODE': 'true', 'ORG_ACCOUNT_IDS': '222222222222,123456789012'}):
+            return json.loads(lambda_function.lambda_handler({}, None)['body'])
+
+    def test_unreachable_account_is_carried_over_in_the_delta(self):
+        self.run_org_handler()
+        lambda_function._reset_client_pool()
+        lambda_function.get_client('sts').errors['assume_role'] = {'222222222222': throttle('AccessDenied')}
+
+        body = self.run_org_handler()
+
+        delta = body['summary']['delta']
+        self.assertEqual((delta['added'], delta['removed'], delta['growth']), (0, 0, 0))
+        index = lambda_function.SnapshotIndex.decode(self.aws.objects['index/123456789012/snapshot_index.bin'])
+        self.assertIn(('222222222222', 'eu-west-1', 'EBS', 'snap-member'), index.keys)
+
+    def test_failed_unit_does_not_hide_deletions_of_other_accounts(self):
+        self.aws.objects['index/123456789012/snapshot_index.bin'] = snapshot_index(
+            ('snap-own', 'EBS', 'us-east-1', 8), ('snap-gone', 'EBS', 'eu-west-1', 8),
+            ('snap-member', 'EBS', 'eu-west-1', 8, '222222222222')).encode()
+        self.members['222222222222'].errors[('ec2', 'eu-west-1')] = {
+            'describe_snapshots': RuntimeError('AccessDenied')}
+
+        body = self.run_org_handler()
+
+        delta = body['summary']['delta']
+        self.assertEqual((delta['added'], delta['removed'], delta['removed_size']), (0, 1, 8))
+        index = lambda_function.SnapshotIndex.decode(self.aws.objects['index/123456789012/snapshot_index.bin'])
+        self.assertEqual([key[3] for key in index.keys], ['snap-own', 'snap-member'])
+
+    def test_unreachable_account_is_carried_over_in_the_rollup(self):
+        yesterday = lambda_function.SnapshotRollup.day_number(NOW.date()) - 1
+        self.aws.objects['rollup/123456789012/snapshot_rollup.bin'] = lambda_function.SnapshotRollup.from_rows([
+            (yesterday, ('123456789012', 'us-east-1', 'EBS', '7 days'), 1, 8),
+            (yesterday, ('222222222222', 'eu-west-1', 'EBS', '90 days'), 1, 8)]).encode()
+        lambda_function.get_client('sts').errors['assume_role'] = {'222222222222': throttle('AccessDenied')}
+
+        self.run_org_handler()
+
+        rollup = lambda_function.SnapshotRollup.decode(self.aws.objects['rollup/123456789012/snapshot_rollup.bin'])
+        today = rollup.day_rows(yesterday + 1)
+        self.assertEqual([rollup.key(i)[:3] for i in today],
+                         [('123456789012', 'us-east-1', 'EBS'), ('222222222222', 'eu-west-1', 'EBS')])
+        self.assertEqual(rollup.totals(yesterday + 1), (2, 16))
+
+    def test_continuations_checkpoint_member_accounts(self):
+        with patch.dict(os.environ, {'ORG_MODE': 'true', 'ORG_ACCOUNT_IDS': '222222222222,123456789012'}):
+            single = json.loads(lambda_function.lambda_handler({}, None)['body'])
+            expected = self.aws.objects[single['reports'][0]]
+            member_calls = len(self.members['222222222222'].calls('describe_snapshots'))
+
+            invocations, event = 0, {}
+            with patch.dict(os.environ, {'SCAN_MAX_WORKERS': '1', 'TIME_BUDGET_RESERVE_SECONDS': '60',
+                                         'CHECKPOINT_BUFFER_RECORDS': '2'}):
+                while True:
+                    invocations += 1
+                    response = lambda_function.lambda_handler(event, FakeContext(checks=3))
+                    body = json.loads(response['body'])
+                    if response['statusCode'] == 200:
+                        break
+                    event = body['continuation']
+
+        self.assertGreater(invocations, 2)
+        self.assertEqual(self.aws.objects[body['reports'][0]], expected)
+        self.assertEqual(body['summary']['total_count'], single['summary']['total_count'])
+        # Finished member units were read back rather than rescanned
+        self.assertEqual(len(self.members['222222222222'].calls('describe_snapshots')), 2 * member_calls)
+        self.assertFalse([key for key in self.aws.objects if key.startswith('checkpoints/')])
+
+    def test_worker_drains_queue_until_sentinel(self):
+        scan = lambda_function.OrganizationScan(self.inventory)
+        work_queue, result_queue = queue.Queue(), queue.Queue()
+        for unit in [lambda_function.WorkUnit('123456789012', 'us-east-1'), None,
+                     lambda_function.WorkUnit('123456789012', 'eu-west-1')]:
+            work_queue.put(unit)
+
+        scan.work(work_queue, result_queue)
+
+        result = result_queue.get_nowait()
+        self.assertEqual([s.Id for s in result.snapshots], ['snap-own'])
+        self.assertIsNone(result.error)
+        self.assertTrue(result_queue.empty())
+        self.assertEqual(work_queue.qsize(), 1)
+
+    def test_handler_reports_consolidated_summary(self):
+        with patch.dict(os.environ, {'ORG_MODE': 'true'}):
+            response = lambda_function.lambda_handler({}, None)
+
+        summary = json.loads(response['body'])['summary']
+        self.assertEqual(summary['total_count'], 2)
+        self.assertEqual(list(summary['by_account']), ['123456789012', '222222222222'])
+        self.assertEqual(summary['by_account']['222222222222']['volume_count'], 1)
+        [(_, publish)] = self.aws.calls('publish')
+        self.assertIn('Organization 123456789012', publish['Subject'])
+        self.assertIn('Account Breakdown:', json.loads(publish['Message'])['email'])
+
+
+class TestInstrumentation(InventoryTestCase):
+    pages = TestParallelScan.pages
+    errors = TestParallelScan.errors
+
+    def run_handler(self, event=None, **env):
+        output = io.StringIO()
+        with patch.dict(os.environ, env), contextlib.redirect_stdout(output):
+            response = lambda_function.lambda_handler(event or {}, None)
+        return json.loads(response['body']), output.getvalue()
+
+    def emf_documents(self, output):
+        return [json.loads(line) for line in output.splitlines() if line.startswith('{"') and '_aws' in line]
+
+    def test_stages_and_collectors_are_timed(self):
+        body, _ = self.run_handler()
+
+        stages = body['api_stats']['stages']
+        # Idle detection runs inside the scan, once per region with unattached volumes
+        self.assertEqual(list(stages), ['idle', 'scan', 'delta', 'csv', 's3_upload', 'rollup', 'summary',
+                                        'publish'])
+        self.assertEqual(stages['idle']['calls'], 2)
+        self.assertEqual(stages['csv']['calls'], 2)
+        self.assertGreater(stages['csv']['bytes'], 0)
+        self.assertEqual(stages['s3_upload']['bytes'], stages['csv']['bytes'])
+        self.assertGreater(stages['publish']['bytes'], 0)
+
+        rows = {(row['region'], row['collector']): row for row in body['api_stats']['by_region']}
+        self.assertEqual(len(rows), 10)
+        self.assertEqual(rows[('eu-west-1', 'IDLE')]['pages'], 1)
+        self.assertEqual(rows[('us-east-1', 'RDS')]['errors'], 1)
+        self.assertEqual(rows[('us-east-1', 'EBS')]['items'], 2)
+        self.assertGreaterEqual(rows[('us-east-1', 'EBS')]['seconds'], 0)
+
+    def test_metrics_are_logged_as_emf(self):
+        _, output = self.run_handler(METRICS_NAMESPACE='Inventory/Test')
+
+        documents = self.emf_documents(output)
+        collectors = [d for d in documents if 'Collector' in d]
+        self.assertEqual(len(collectors), 10)
+        [directive] = collectors[0]['_aws']['CloudWatchMetrics']
+        self.assertEqual(directive['Namespace'], 'Inventory/Test')
+        self.assertEqual(directive['Dimensions'], [['Region', 'Collector']])
+        for metric in directive['Metrics']:
+            self.assertIn(metric['Name'], collectors[0])
+        self.assertEqual({d['Stage'] for d in documents if 'Stage' in d},
+                         {'idle', 'scan', 'delta', 'csv', 's3_upload', 'rollup', 'summary', 'publish'})
+
+    def test_metrics_can_be_disabled(self):
+        _, output = self.run_handler(EMF_METRICS='false')
+
+        self.assertEqual(self.emf_documents(output), [])
+
+    def test_failed_stage_counts_an_error(self):
+        stats = lambda_function.ScanStats()
+        with self.assertRaises(ValueError), stats.stage('csv'):
+            raise ValueError('boom')
+
+        self.assertEqual(stats.stage_totals()['csv']['errors'], 1)
+
+    def test_summary_reports_in_html_and_json(self):
+        body, _ = self.run_handler(SUMMARY_FORMATS='html,json')
+
+        html_key, json_key = body['reports'][2:]
+        self.assertTrue(self.aws.objects[html_key].startswith(b'<h1>'))
+        self.assertEqual(json.loads(self.aws.objects[json_key])['sections'][0]['title'], 'Regional Breakdown')
+
+    def test_profile_is_switched_on_by_the_event(self):
+        body, output = self.run_handler({'profile': True})
+
+        self.assertEqual(body['message'], 'Snapshot inventory processed successfully')
+        self.assertIn('function calls', output)
+        self.assertIn('generate_inventory', output)
+        self.assertNotIn('function calls', self.run_handler()[1])
+
+
+class FakeContext:
+    """Lambda context whose time runs out after a number of budget checks"""
+
+    invoked_function_arn = 'arn:aws:lambda:us-east-1:123456789012:function:snapshot-inventory'
+
+    def __init__(self, checks):
+        self.checks = checks
+
+    def get_remaining_time_in_millis(self):
+        self.checks -= 1
+        return 300000 if self.checks >= 0 else 1000
+
+
+class TestContinuation(InventoryTestCase):
+    pages = {
+        ('ec2', 'us-east-1'): {
+            'describe_snapshots': [[ebs_snapshot('snap-c', 3)], [ebs_snapshot('snap-a', 40)],
+                                   [ebs_snapshot('snap-b', 400)]],
+            'describe_volumes': [[volume('vol-1')], [volume('vol-2')]]
+        },
+        ('ec2', 'eu-west-1'): {
+            'describe_snapshots': [[ebs_snapshot('snap-d', 9)], [ebs_snapshot('snap-e', 90)]],
+            'describe_volumes': [[volume('vol-3')]]
+        },
+        ('rds', 'eu-west-1'): {
+            'describe_db_snapshots': [[rds_snapshot('db-1', 10)], [rds_snapshot('db-2', 100)]]
+        },
+        ('backup', 'us-east-1'): {
+            'list_backup_jobs': [[backup_job('job-1', 1)], [backup_job('job-2', 2)]]
+        }
+    }
+
+    def setUp(self):
+        super().setUp()
+        env = patch.dict(os.environ, {'SCAN_MAX_WORKERS': '1', 'TIME_BUDGET_RESERVE_SECONDS': '60'})
+        env.start()
+        self.addCleanup(env.stop)
+
+    def run_handler(self, event, context):
+        response = lambda_function.lambda_handler(event, context)
+        return response['statusCode'], json.loads(response['body'])
+
+    def report(self, body, index=0):
+        return self.aws.objects[body['reports'][index]]
+
+    def run_until_complete(self):
+        """Run the handler and its continuations, returning the final body and the invocation count"""
+        invocations = 0
+        event = {}
+        while True:
+            invocations += 1
+            status, body = self.run_handler(event, FakeContext(checks=4))
+            if status == 200:
+                return body, invocations
+            self.assertEqual(status, 202)
+            self.assertTrue(body['invoked'])
+            event = body['continuation']
+            self.assertIn(event['continuation'], self.aws.objects)
+
+    def test_continuations_assemble_the_single_run_output(self):
+        _, single = self.run_handler({}, None)
+        expected = [self.report(single, 0), self.report(single, 1)]
+        ebs_calls = len(self.aws.calls('describe_snapshots'))
+
+        body, invocations = self.run_until_complete()
+
+        self.assertGreater(invocations, 2)
+        self.assertEqual([self.report(body, 0), self.report(body, 1)], expected)
+        self.assertEqual(body['summary']['total_count'], single['summary']['total_count'])
+        # Every page was fetched once: units resumed from their page token
+        self.assertEqual(len(self.aws.calls('describe_snapshots')), 2 * ebs_calls)
+        invokes = self.aws.calls('invoke')
+        self.assertEqual(len(invokes), invocations - 1)
+        self.assertEqual(invokes[0][1]['InvocationType'], 'Event')
+        self.assertFalse([key for key in self.aws.objects if key.startswith('checkpoints/')])
+
+    def test_continuations_read_back_spilled_units(self):
+        _, single = self.run_handler({}, None)
+        expected = [self.report(single, 0), self.report(single, 1)]
+
+        with patch.dict(os.environ, {'CHECKPOINT_BUFFER_RECORDS': '2'}):
+            body, _ = self.run_until_complete()
+
+        # Spilled batches are numbered under the run's checkpoint
+        self.assertTrue([kwargs for _, kwargs in self.aws.calls('put_object')
+                         if kwargs['Key'].endswith('/00001.json.gz')])
+        self.assertEqual([self.report(body, 0), self.report(body, 1)], expected)
+        self.assertFalse([key for key in self.aws.objects if key.startswith('checkpoints/')])
+
+    def test_run_without_handover_writes_no_finished_units(self):
+        status, body = self.run_handler({}, FakeContext(checks=1000))
+
+        self.assertEqual(status, 200)
+        self.assertEqual(body['summary']['total_count'], 9)
+        self.assertFalse([kwargs for _, kwargs in self.aws.calls('put_object')
+                          if kwargs['Key'].startswith('checkpoints/')])
+        self.assertEqual(self.aws.calls('delete_objects'), [])
+
+    def test_held_units_are_spilled_together_once_the_buffer_is_full(self):
+        with patch.dict(os.environ, {'CHECKPOINT_BUFFER_RECORDS': '3'}):
+            inventory = lambda_function.SnapshotInventory()
+        inventory.set_time_budget(FakeContext(checks=1000))
+        inventory.scan_all_regions(on_snapshots=lambda snapshots: None)
+
+        spills = sorted({key for key in inventory.completed_units.values() if key})
+        self.assertEqual(spills, [inventory.get_spill_key(number) for number in range(1, len(spills) + 1)])
+        self.assertLess(sum(len(records) for records in inventory.held_units.values()), 3)
+        self.assertIsNone(inventory.completed_units[('us-east-1', 'RDS')])
+        self.assertEqual([s.Id for s in inventory.load_unit('us-east-1', 'EBS')], ['snap-a', 'snap-b', 'snap-c'])
+
+        inventory.delete_units()
+        [(_, kwargs)] = self.aws.calls('delete_objects')
+        self.assertEqual([item['Key'] for item in kwargs['Delete']['Objects']], spills)
+
+    def test_continuation_can_be_returned_to_the_caller(self):
+        with patch.dict(os.environ, {'CONTINUATION_MODE': 'return'}):
+            status, body = self.run_handler({}, FakeContext(checks=2))
+
+        self.assertEqual(status, 202)
+        self.assertFalse(body['invoked'])
+        self.assertEqual(self.aws.calls('invoke'), [])
+        self.assertGreater(body['pending_units'], 0)
+
+    def test_run_reports_partial_results_after_max_continuations(self):
+        with patch.dict(os.environ, {'MAX_CONTINUATIONS': '0'}):
+            status, body = self.run_handler({}, FakeContext(checks=3))
+
+        self.assertEqual(status, 200)
+        self.assertGreater(body['api_stats']['errors'], 0)
+        self.assertEqual(self.aws.calls('invoke'), [])
+
+
+class TestIncrementalScan(InventoryTestCase):
+    regions = ['us-east-1']
+    pages = {
+        ('backup', 'us-east-1'): {
+            'list_backup_jobs': [[backup_job('job-new', 0)]]
+        }
+    }
+
+    def setUp(self):
+        super().setUp()
+        self.inventory.incremental = True
+        watermark = NOW - timedelta(days=2)
+        self.aws.objects['state/123456789012/us-east-1.json'] = json.dumps({
+            'version': 1,
+            'watermark': watermark.isoformat(),
+            'snapshots': [
+                ['job-old', 'EFS', (NOW - timedelta(days=20)).isoformat(), 1.0],
+                ['job-expired', 'EFS', (NOW - timedelta(days=45)).isoformat(), 1.0]
+            ]
+        }).encode()
+
+    def test_only_new_backup_jobs_are_fetched(self):
+        snapshots = self.inventory.get_all_regions_snapshots()
+
+        [(_, kwargs)] = self.aws.calls('list_backup_jobs')
+        self.assertEqual(kwargs['ByCreatedAfter'], NOW - timedelta(days=3))
+        efs = {s.Id: s for s in snapshots if s.Type == 'EFS'}
+        self.assertEqual(sorted(efs), ['job-new', 'job-old'])
+        self.assertEqual(efs['job-old'].Age, 20)
+        self.assertEqual(efs['job-old'].AgeGroup, '30 days')
+
+    def test_state_is_saved_with_new_watermark(self):
+        self.inventory.get_all_regions_snapshots()
+
+        state = json.loads(self.aws.objects['state/123456789012/us-east-1.json'])
+        self.assertEqual(state['watermark'], self.inventory.scan_started_at.isoformat())
+        self.assertEqual(sorted(row[0] for row in state['snapshots']), ['job-new', 'job-old'])
+
+    def test_full_scan_ignores_stored_state(self):
+        self.inventory.full_scan = True
+        snapshots = self.inventory.get_all_regions_snapshots()
+
+        [(_, kwargs)] = self.aws.calls('list_backup_jobs')
+        self.assertNotIn('ByCreatedAfter', kwargs)
+        self.assertEqual([s.Id for s in snapshots], ['job-new'])
+
+    def test_failed_collector_keeps_previous_state(self):
+        self.aws.errors[('backup', 'us-east-1')] = {'list_backup_jobs': RuntimeError('Throttling')}
+        lambda_function._reset_client_pool()
+        inventory = lambda_function.SnapshotInventory()
+        inventory.incremental = True
+        inventory.get_all_regions_snapshots()
+
+        state = json.loads(self.aws.objects['state/123456789012/us-east-1.json'])
+        self.assertEqual(len(state['snapshots']), 2)
+
+
+class TestRegionActivity(InventoryTestCase):
+    regions = ['eu-west-1', 'us-east-1', 'us-west-2']
+    pages = {
+        ('ec2', 'us-east-1'): {
+            'describe_snapshots': [[ebs_snapshot('snap-a', 3)]],
+            'describe_volumes': [[volume('vol-1')]]
+        },
+        ('rds', 'us-west-2'): {
+            'describe_db_snapshots': [[rds_snapshot('db-1', 10)]]
+        }
+    }
+    activity_key = 'activity/123456789012.json'
+
+    def setUp(self):
+        super().setUp()
+        env = patch.dict(os.environ, {'REGION_ACTIVITY_MAP': 'true'})
+        env.start()
+        self.addCleanup(env.stop)
+        self.inventory = lambda_function.SnapshotInventory()
+
+    def store_activity(self, **regions):
+        """Store a map marking the given regions dormant, checked that many days ago"""
+        self.aws.objects[self.activity_key] = json.dumps({'version': 1, 'regions': {
+            region.replace('_', '-'): {'active': False,
+                                       'checked': (NOW - timedelta(days=days)).isoformat()}
+            for region, days in regions.items()}}).encode()
+
+    def scanned_regions(self):
+        """Regions whose volumes were listed in full rather than probed"""
+        return sorted(region for region, kwargs in self.aws.calls('describe_volumes')
+                      if kwargs.get('MaxResults') != 5)
+
+    def test_empty_regions_become_dormant_and_are_skipped(self):
+        lambda_function.SnapshotInventory().scan_all_regions()
+        activity = json.loads(self.aws.objects[self.activity_key])['regions']
+        self.assertEqual({region: entry['active'] for region, entry in activity.items()},
+                         {'eu-west-1': False, 'us-east-1': True, 'us-west-2': True})
+
+        self.aws.clients.clear()
+        lambda_function._reset_client_pool()
+        response = lambda_function.lambda_handler({}, None)
+
+        self.assertEqual(self.scanned_regions(), ['us-east-1', 'us-west-2'])
+        self.assertNotIn('eu-west-1', [region for region, _ in self.aws.calls('describe_snapshots')])
+        summary = json.loads(response['body'])['summary']
+        self.assertEqual(summary['skipped_regions'], ['eu-west-1'])
+        self.assertEqual(summary['total_count'], 2)
+
+    def test_probe_promotes_dormant_region_with_items(self):
+        self.store_activity(us_west_2=8)
+        snapshots, _ = self.inventory.scan_all_regions()
+
+        # The probe stops at the first collector that finds something
+        probes = [(region, kwargs) for region, kwargs in self.aws.calls('describe_db_snapshots')
+                  if kwargs.get('MaxRecords') == 20]
+        self.assertEqual(probes, [('us-west-2', {'MaxRecords': 20})])
+        self.assertEqual(self.scanned_regions(), ['eu-west-1', 'us-east-1', 'us-west-2'])
+        self.assertIn('db-1', [s.Id for s in snapshots])
+        activity = json.loads(self.aws.objects[self.activity_key])['regions']
+        self.assertTrue(activity['us-west-2']['active'])
+
+    def test_empty_probe_keeps_region_dormant(self):
+        self.store_activity(eu_west_1=8)
+        self.inventory.scan_all_regions()
+
+        self.assertEqual(self.scanned_regions(), ['us-east-1', 'us-west-2'])
+        probes = [kwargs for region, kwargs in self.aws.calls('describe_volumes') if region == 'eu-west-1']
+        self.assertEqual(probes, [{'MaxResults': 5, 'Filters': [
+            {'Name': 'status', 'Values': ['available', 'creating', 'deleting', 'error']}]}])
+        self.assertEqual(self.inventory.skipped_regions, ['eu-west-1'])
+        activity = json.loads(self.aws.objects[self.activity_key])['regions']
+        self.assertFalse(activity['eu-west-1']['active'])
+        self.assertEqual(activity['eu-west-1']['checked'], self.inventory.scan_started_at.isoformat())
+
+    def test_region_with_only_attached_volumes_stays_dormant(self):
+        self.aws.pages = {**self.pages, ('ec2', 'eu-west-1'): {
+            'describe_volumes': [[volume('vol-used', attached=True)]]}}
+        self.store_activity(eu_west_1=8)
+        self.inventory.scan_all_regions()
+
+        # The probe sees what the full scan would: no unattached volume
+        self.assertEqual(self.inventory.skipped_regions, ['eu-west-1'])
+        activity = json.loads(self.aws.objects[self.activity_key])['regions']
+        self.assertFalse(activity['eu-west-1']['active'])
+
+    def test_recently_checked_region_is_not_probed(self):
+        self.store_activity(eu_west_1=1)
+        self.inventory.scan_all_regions()
+
+        self.assertEqual([region for region, _ in self.aws.calls('describe_volumes')],
+                         ['us-east-1', 'us-west-2'])
+
+    def test_full_scan_covers_dormant_regions(self):
+        self.store_activity(eu_west_1=1)
+        self.inventory.full_scan = True
+        self.inventory.scan_all_regions()
+
+        self.assertEqual(self.scanned_regions(), ['eu-west-1', 'us-east-1', 'us-west-2'])
+        self.assertEqual(self.inventory.skipped_regions, [])
+
+    def test_allow_and_deny_lists(self):
+        with patch.dict(os.environ, {'REGION_ALLOWLIST': 'us-east-1, us-west-2, ap-south-1',
+                                     'REGION_DENYLIST': 'us-west-2'}):
+            self.assertEqual(lambda_function.SnapshotInventory().get_all_regions(), ['us-east-1'])
+        with patch.dict(os.environ, {'REGION_DENYLIST': 'eu-west-1'}):
+            self.assertEqual(lambda_function.SnapshotInventory().get_all_regions(),
+                             ['us-east-1', 'us-west-2'])
+
+
+def snapshot_index(*entries, generated_at=NOW):
+    """Index of (ID, type, region, size) or (ID, type, region, size, account) entries"""
+    start_time = (NOW - timedelta(days=1) - lambda_function.EPOCH) // lambda_function.MICROSECOND
+    return lambda_function.SnapshotIndex.from_columns(
+        generated_at, [(entry[4] if len(entry) > 4 else '123456789012', entry[2], entry[1], entry[0])
+                       for entry in entries],
+        [entry[3] for entry in entries], [start_time] * len(entries))
+
+
+class TestDeltaReport(InventoryTestCase):
+    pages = TestParallelScan.pages
+    errors = TestParallelScan.errors
+    index_key = 'index/123456789012/snapshot_index.bin'
+
+    def test_index_round_trip(self):
+        index = snapshot_index(('snap-\u00fc', 'EBS', 'eu-west-1', 8), ('job-1', 'EFS', 'us-east-1', 0.25),
+                               ('db-1', 'RDS', 'us-east-1', 20, '210987654321'))
+        decoded = lambda_function.SnapshotIndex.decode(index.encode())
+
+        self.assertEqual((decoded.generated_at, decoded.keys, decoded.sizes, decoded.start_times),
+                         (index.generated_at, index.keys, index.sizes, index.start_times))
+        self.assertEqual(len(lambda_function.SnapshotIndex.decode(snapshot_index().encode())), 0)
+        with self.assertRaises(ValueError):
+            lambda_function.SnapshotIndex.decode(b'NOTINDEX' + index.encode()[8:])
+
+    def test_merge_join_classifies_changes(self):
+        previous = snapshot_index(('snap-a', 'EBS', 'us-east-1', 8), ('snap-b', 'EBS', 'us-east-1', 8),
+                                  ('snap-z', 'EBS', 'us-east-1', 5))
+        current = snapshot_index(('snap-0', 'EBS', 'us-east-1', 1), ('snap-b', 'EBS', 'us-east-1', 10),
+                                 ('snap-y', 'EBS', 'us-east-1', 2))
+
+        changes = current.diff(previous)
+
+        self.assertEqual([(c.Change, c.Id, c.SizeChange) for c in changes],
+                         [('added', 'snap-0', 1), ('removed', 'snap-a', -8), ('resized', 'snap-b', 2),
+                          ('added', 'snap-y', 2), ('removed', 'snap-z', -5)])
+        self.assertEqual(changes[1].StartTime, NOW - timedelta(days=1))
+
+    def test_first_run_only_stores_the_index(self):
+        body = json.loads(lambda_function.lambda_handler({}, None)['body'])
+
+        self.assertIsNone(body['summary']['delta'])
+        self.assertFalse([key for key in body['reports'] if 'snapshot_delta' in key])
+        index = lambda_function.SnapshotIndex.decode(self.aws.objects[self.index_key])
+        self.assertEqual([key[3] for key in index.keys], ['snap-c', 'db-snap', 'snap-a', 'snap-b', 'job-1'])
+
+    def test_changes_since_last_run(self):
+        since = NOW - timedelta(days=1)
+        previous = snapshot_index(('snap-a', 'EBS', 'us-east-1', 8), ('snap-b', 'EBS', 'us-east-1', 4),
+                                  ('snap-old', 'EBS', 'us-east-1', 10),
+                                  # RDS in us-east-1 fails this run, so its snapshots are kept
+                                  ('db-kept', 'RDS', 'us-east-1', 20), generated_at=since)
+        self.aws.objects[self.index_key] = previous.encode()
+
+        body = json.loads(lambda_function.lambda_handler({}, None)['body'])
+
+        delta = body['summary']['delta']
+        self.assertEqual((delta['since'], delta['added'], delta['added_size'], delta['removed'],
+                          delta['removed_size'], delta['growth']),
+                         (since.isoformat(), 3, 29, 1, 10, 23))
+        self.assertEqual([(d['region'], d['type'], d['added'], d['removed'], d['growth'])
+                          for d in delta['by_region_type']],
+                         [('eu-west-1', 'EBS', 1, 0, 8), ('eu-west-1', 'RDS', 1, 0, 20),
+                          ('us-east-1', 'EBS', 0, 1, -6), ('us-east-1', 'EFS', 1, 0, 1)])
+
+        [delta_key] = [key for key in body['reports'] if 'snapshot_delta' in key]
+        rows = list(csv.DictReader(io.StringIO(self.aws.objects[delta_key].decode())))
+        self.assertEqual([(row['Change'], row['Id']) for row in rows],
+                         [('added', 'snap-c'), ('added', 'db-snap'), ('resized', 'snap-b'),
+                          ('removed', 'snap-old'), ('added', 'job-1')])
+
+        index = lambda_function.SnapshotIndex.decode(self.aws.objects[self.index_key])
+        self.assertIn('db-kept', [key[3] for key in index.keys])
+        message = json.loads(self.aws.calls('publish')[0][1]['Message'])
+        self.assertIn('Net Growth: +23.00 GB', message['email'])
+        self.assertIn('us-east-1 EBS: +0 / -1 snapshots, -6.00 GB', message['email'])
+
+    def test_failed_region_discovery_keeps_the_index_and_rollup(self):
+        lambda_function.lambda_handler({}, None)
+        index = lambda_function.SnapshotIndex.decode(self.aws.objects[self.index_key])
+        rollup_key = 'rollup/123456789012/snapshot_rollup.bin'
+        totals = lambda_function.SnapshotRollup.decode(self.aws.objects[rollup_key]).totals(
+            lambda_function.SnapshotRollup.day_number(NOW.date()))
+        lambda_function._reset_client_pool()
+        lambda_function.get_client('ec2').errors['describe_regions'] = throttle('UnauthorizedOperation')
+
+        body = json.loads(lambda_function.lambda_handler({}, None)['body'])
+
+        delta = body['summary']['delta']
+        self.assertEqual((body['summary']['total_count'], delta['added'], delta['removed'], delta['growth']),
+                         (0, 0, 0, 0))
+        self.assertGreater(body['api_stats']['errors'], 0)
+        self.assertEqual(lambda_function.SnapshotIndex.decode(self.aws.objects[self.index_key]).keys, index.keys)
+        rollup = lambda_function.SnapshotRollup.decode(self.aws.objects[rollup_key])
+        self.assertEqual(rollup.totals(rollup.latest_day()), totals)
+
+    def test_delta_report_can_be_disabled(self):
+        with patch.dict(os.environ, {'DELTA_REPORT': 'false'}):
+            lambda_function.lambda_handler({}, None)
+
+        self.assertNotIn(self.index_key, self.aws.objects)
+
+
+def rollup(*rows):
+    """Rollup of (days ago, region, type, count, size) rows of the test account"""
+    today = lambda_function.SnapshotRollup.day_number(NOW.date())
+    return lambda_function.SnapshotRollup.from_rows(
+        [(today - row[0], ('123456789012', row[1], row[2], '7 days'), row[3], row[4]) for row in rows])
+
+
+class TestTrendRollup(InventoryTestCase):
+    pages = TestParallelScan.pages
+    errors = TestParallelScan.errors
+    rollup_key = 'rollup/123456789012/snapshot_rollup.bin'
+
+    def test_record_replaces_the_day_and_carries_failed_units(self):
+        previous = rollup((500, 'us-east-1', 'EBS', 9, 90), (1, 'us-east-1', 'EBS', 2, 16),
+                          (1, 'us-east-1', 'RDS', 1, 20), (0, 'us-east-1', 'EBS', 7, 70))
+        today = previous.latest_day()
+        cells = [(('123456789012', 'us-east-1', 'EBS', '7 days'), 3, 24),
+                 (('123456789012', 'us-east-1', 'RDS', '7 days'), 0, 0)]
+
+        updated = lambda_function.SnapshotRollup.decode(
+            previous.record(today, cells, {('123456789012', 'us-east-1', 'RDS')}, today - 399).encode())
+
+        self.assertEqual([(today - day, key[2], count, size)
+                          for day, key, count, size in updated.rows(range(len(updated)))],
+            [(1, 'EBS', 2, 16), (1, 'RDS', 1, 20), (0, 'EBS', 3, 24), (0, 'RDS', 1, 20)])
+        with self.assertRaises(ValueError):
+            lambda_function.SnapshotRollup.decode(b'NOTROLLP' + updated.encode()[8:])
+
+    def test_growth_from_the_rollup(self):
+        # RDS in us-east-1 fails this run, so last week's cell is carried over
+        self.aws.objects[self.rollup_key] = rollup(
+            (45, 'us-east-1', 'EBS', 1, 5), (30, 'us-east-1', 'EBS', 1, 10),
+            (7, 'us-east-1', 'EBS', 2, 16), (7, 'us-east-1', 'RDS', 1, 20)).encode()
+
+        body = json.loads(lambda_function.lambda_handler({}, None)['body'])
+
+        week_since = (NOW - timedelta(days=7)).date().isoformat()
+        self.assertEqual(body['summary']['growth'], {
+            'week': {'since': week_since, 'count': 3, 'size': 29, 'size_percent': 80.6},
+            'month': {'since': (NOW - timedelta(days=30)).date().isoformat(), 'count': 5, 'size': 55,
+                      'size_percent': 550.0}
+        })
+        message = json.loads(self.aws.calls('publish')[0][1]['Message'])
+        self.assertIn(f'Week over Week (since {week_since}): +3 snapshots, +29.00 GB (+80.6%)', message['email'])
+        stored = lambda_function.SnapshotRollup.decode(self.aws.objects[self.rollup_key])
+        self.assertEqual(stored.totals(stored.latest_day()), (6, 65))
+
+    def test_first_run_has_no_growth(self):
+        body = json.loads(lambda_function.lambda_handler({}, None)['body'])
+
+        self.assertIsNone(body['summary']['growth'])
+        self.assertIn(self.rollup_key, self.aws.objects)
+
+    def test_trend_query_reads_only_the_rollup(self):
+        self.aws.objects[self.rollup_key] = rollup(
+            (2, 'us-east-1', 'EBS', 1, 8), (1, 'us-east-1', 'EBS', 2, 16), (1, 'eu-west-1', 'EBS', 1, 8),
+            (1, 'us-east-1', 'RDS', 1, 20)).encode()
+
+        response = lambda_function.lambda_handler({'trend': {'days': 1, 'by': ['region']}}, None)
+
+        yesterday = (NOW - timedelta(days=1)).date().isoformat()
+        self.assertEqual(json.loads(response['body'])['trend'], [
+            {'date': yesterday, 'region': 'eu-west-1', 'count': 1, 'size': 8},
+            {'date': yesterday, 'region': 'us-east-1', 'count': 3, 'size': 36}])
+        # Besides the account lookup, the rollup is the only object read
+        self.assertEqual([name for client in self.aws.clients for name, _ in client.calls],
+                         ['get_caller_identity', 'get_object'])
+        with self.assertRaises(ValueError):
+            self.inventory.get_trend(30, ('volume',))
+
+
+def blocks(count, changed=True):
+    """EBS direct API blocks; unchanged ones only exist in the first snapshot"""
+    return [{'BlockIndex': index, 'FirstBlockToken': 'first', **({'SecondBlockToken': 'second'} if changed else {})}
+            for index in range(count)]
+
+
+class TestBilledSize(InventoryTestCase):
+    regions = ['us-east-1']
+    pages = {
+        ('ec2', 'us-east-1'): {
+            'describe_snapshots': [[dict(ebs_snapshot('snap-b', 3), VolumeId='vol-1'),
+                                    dict(ebs_snapshot('snap-a', 40), VolumeId='vol-1'),
+                                    dict(ebs_snapshot('snap-p', 0), VolumeId='vol-1', State='pending')]]
+        },
+        # 512 KiB blocks: 4096 make 2 GB, 2048 make 1 GB
+        ('ebs', 'us-east-1'): {
+            'list_snapshot_blocks': [blocks(4096)],
+            'list_changed_blocks': [blocks(2048), blocks(10, changed=False)]
+        }
+    }
+    cache_key = 'billed-size/123456789012/us-east-1.json'
+
+    def setUp(self):
+        env = patch.dict(os.environ, {'BILLED_SIZE': 'true'})
+        env.start()
+        self.addCleanup(env.stop)
+        super().setUp()
+
+    def test_snapshots_are_measured_against_their_parent(self):
+        snapshots = self.inventory.get_ebs_snapshots_for_region('us-east-1')
+
+        self.assertEqual([(s.Id, s.Size, s.BilledSize) for s in snapshots],
+                         [('snap-a', 8, 2.0), ('snap-b', 8, 1.0), ('snap-p', 8, None)])
+        kwargs = self.aws.calls('list_changed_blocks')[0][1]
+        self.assertEqual((kwargs['FirstSnapshotId'], kwargs['SecondSnapshotId']), ('snap-a', 'snap-b'))
+        self.assertEqual(json.loads(self.aws.objects[self.cache_key])['snapshots'],
+                         {'snap-a': ['', 2.0], 'snap-b': ['snap-a', 1.0]})
+
+    def test_cached_sizes_are_not_measured_again(self):
+        self.inventory.get_ebs_snapshots_for_region('us-east-1')
+        calls = len(self.aws.calls('list_snapshot_blocks')) + len(self.aws.calls('list_changed_blocks'))
+
+        snapshots = lambda_function.SnapshotInventory().get_ebs_snapshots_for_region('us-east-1')
+
+        self.assertEqual([s.BilledSize for s in snapshots], [2.0, 1.0, None])
+        self.assertEqual(len(self.aws.calls('list_snapshot_blocks')) + len(self.aws.calls('list_changed_blocks')),
+                         calls)
+        # The unchanged cache is still rewritten, clear of the bucket's expiration rule
+        self.assertEqual(len([kwargs for _, kwargs in self.aws.calls('put_object')
+                              if kwargs['Key'] == self.cache_key]), 2)
+
+    def test_budget_limits_measurements_per_run(self):
+        with patch.dict(os.environ, {'BILLED_SIZE_MAX_SNAPSHOTS': '1'}):
+            body = json.loads(lambda_function.lambda_handler({}, None)['body'])
+
+        self.assertEqual(body['summary']['billed'], {'count': 1, 'size': 2.0, 'provisioned_size': 8})
+        self.assertEqual(self.aws.calls('list_changed_blocks'), [])
+        message = json.loads(self.aws.calls('publish')[0][1]['Message'])
+        self.assertIn('Measured: 1 of 3 EBS snapshots', message['email'])
+        self.assertIn('Billed: 2.00 GB of 8.00 GB provisioned', message['email'])
+
+
+class TestIdleDetection(InventoryTestCase):
+    regions = ['us-east-1']
+    pages = {
+        ('ec2', 'us-east-1'): {
+            'describe_volumes': [[volume('vol-1'), volume('vol-2'),
+                                  dict(volume('vol-3'), CreateTime=NOW - timedelta(days=400))]]
+        },
+        # Query IDs are the metric prefix and the volume's position in the batch
+        ('cloudwatch', 'us-east-1'): {
+            'get_metric_data': [[
+                {'Id': 'r0', 'Timestamps': [NOW - timedelta(days=10), NOW - timedelta(days=12)], 'Values': [5, 3]},
+                {'Id': 'r1', 'Timestamps': [NOW - timedelta(days=1)], 'Values': [0]}
+            ], [
+                {'Id': 'w0', 'Timestamps': [NOW - timedelta(days=20)], 'Values': [1]}
+            ]]
+        },
+        ('cloudtrail', 'us-east-1'): {
+            'lookup_events': [[{'EventName': 'DetachVolume', 'EventTime': NOW - timedelta(days=30),
+                                'Resources': [{'ResourceType': 'AWS::EC2::Volume', 'ResourceName': 'vol-2'}]}]]
+        }
+    }
+    cache_key = 'idle/123456789012/us-east-1.json'
+
+    def idle_days(self):
+        return {v.VolumeId: v.IdleDays for v in self.inventory.get_unattached_volumes_for_region('us-east-1')}
+
+    def test_idle_days_from_last_io_or_lookback_window(self):
+        # Idle since its last reads, never used, and older than the lookback window
+        self.assertEqual(self.idle_days(), {'vol-1': 10, 'vol-2': 3, 'vol-3': 90})
+
+        [first_page, _] = [kwargs for _, kwargs in self.aws.calls('get_metric_data')]
+        self.assertEqual(len(first_page['MetricDataQueries']), 6)
+        self.assertEqual(first_page['MetricDataQueries'][1]['MetricStat']['Metric'],
+                         {'Namespace': 'AWS/EBS', 'MetricName': 'VolumeWriteOps',
+                          'Dimensions': [{'Name': 'VolumeId', 'Value': 'vol-1'}]})
+        self.assertEqual(self.aws.calls('lookup_events'), [])
+
+    def test_volumes_are_looked_up_in_batches(self):
+        self.aws.pages[('cloudwatch', 'us-east-1')] = {
+            'get_metric_data': [[{'Id': 'r0', 'Timestamps': [NOW - timedelta(days=5)], 'Values': [1]}]]}
+        with patch.object(lambda_function, 'METRIC_QUERIES_PER_CALL', 4):
+            # Two volumes per call: r0 is vol-1 in the first batch and vol-3 in the second
+            self.assertEqual(self.idle_days(), {'vol-1': 5, 'vol-2': 3, 'vol-3': 5})
+
+        self.assertEqual([len(kwargs['MetricDataQueries']) for _, kwargs in self.aws.calls('get_metric_data')],
+                         [4, 2])
+
+    def test_cloudtrail_detach_events_as_fallback(self):
+        with patch.dict(os.environ, {'IDLE_CLOUDTRAIL_FALLBACK': 'true'}):
+            self.inventory = lambda_function.SnapshotInventory()
+            self.assertEqual(self.idle_days(), {'vol-1': 10, 'vol-2': 30, 'vol-3': 90})
+
+        [(_, kwargs)] = self.aws.calls('lookup_events')
+        self.assertEqual(kwargs['LookupAttributes'], [{'AttributeKey': 'EventName', 'AttributeValue': 'DetachVolume'}])
+
+    def test_cached_volumes_are_not_looked_up_again(self):
+        self.idle_days()
+        self.aws.objects[self.cache_key] = json.dumps({'version': 1, 'volumes': dict(
+            json.loads(self.aws.objects[self.cache_key])['volumes'], **{'vol-gone': NOW.isoformat()})}).encode()
+        calls = len(self.aws.calls('get_metric_data'))
+
+        self.inventory = lambda_function.SnapshotInventory()
+        self.assertEqual(self.idle_days(), {'vol-1': 10, 'vol-2': 3, 'vol-3': 90})
+
+        self.assertEqual(len(self.aws.calls('get_metric_data')), calls)
+        self.assertEqual(sorted(json.loads(self.aws.objects[self.cache_key])['volumes']), ['vol-1', 'vol-2', 'vol-3'])
+
+    def test_unchanged_cache_is_rewritten_every_run(self):
+        # A rewrite keeps the cache clear of the bucket's expiration rule
+        self.idle_days()
+        self.inventory = lambda_function.SnapshotInventory()
+        self.idle_days()
+
+        self.assertEqual(len([kwargs for _, kwargs in self.aws.calls('put_object')
+                              if kwargs['Key'] == self.cache_key]), 2)
+
+    def test_failed_lookup_is_not_cached(self):
+        self.aws.errors[('cloudwatch', 'us-east-1')] = {'get_metric_data': throttle('AccessDenied')}
+
+        self.assertEqual(self.idle_days(), {'vol-1': 0, 'vol-2': 0, 'vol-3': 0})
+        self.assertNotIn(self.cache_key, self.aws.objects)
+        self.assertTrue(self.inventory.stats.has_errors('us-east-1', 'IDLE'))
+
+
+class TestLineage(InventoryTestCase):
+    regions = ['us-east-1']
+    pages = {
+        ('ec2', 'us-east-1'): {
+            'describe_snapshots': [[dict(ebs_snapshot('snap-a', 1), VolumeId='vol-1'),
+                                    dict(ebs_snapshot('snap-b', 2, size=30), VolumeId='vol-gone')],
+                                   [dict(ebs_snapshot('snap-c', 3, size=50), VolumeId='vol-gone')]],
+            'describe_volumes': [[volume('vol-1', attached=True)], [volume('vol-2')]],
+            'describe_images': [[{'ImageId': 'ami-1', 'BlockDeviceMappings': [
+                {'DeviceName': '/dev/xvda', 'Ebs': {'SnapshotId': 'snap-b'}},
+                {'DeviceName': '/dev/sdb', 'VirtualName': 'ephemeral0'}]}]]
+        },
+        ('rds', 'us-east-1'): {
+            'describe_db_snapshots': [[dict(rds_snapshot('db-1', 1), DBInstanceIdentifier='db-live'),
+                                       dict(rds_snapshot('db-2', 1), DBInstanceIdentifier='db-gone')]],
+            'describe_db_instances': [[{'DBInstanceIdentifier': 'db-live'}]]
+        }
+    }
+
+    def setUp(self):
+        env = patch.dict(os.environ, {'SNAPSHOT_LINEAGE': 'true'})
+        env.start()
+        self.addCleanup(env.stop)
+        super().setUp()
+
+    def test_snapshots_are_classified_from_one_sweep_each(self):
+        snapshots = self.inventory.get_snapshots_for_region('us-east-1')
+
+        self.assertEqual([(s.Id, s.SourceId, s.Lineage) for s in snapshots if s.Type in ('EBS', 'RDS')],
+                         [('snap-a', 'vol-1', 'attached'), ('snap-b', 'vol-gone', 'ami'),
+                          ('snap-c', 'vol-gone', 'orphaned'), ('db-1', 'db-live', 'attached'),
+                          ('db-2', 'db-gone', 'orphaned')])
+        # Every page of each sweep is read once, whatever the number of snapshots
+        self.assertEqual(len(self.aws.calls('describe_volumes')), 2)
+        self.assertEqual(len(self.aws.calls('describe_images')), 1)
+        self.assertEqual(self.aws.calls('describe_images')[0][1]['Owners'], ['self'])
+        self.assertEqual(len(self.aws.calls('describe_db_instances')), 1)
+
+    def test_summary_reports_orphaned_snapshots(self):
+        body = json.loads(lambda_function.lambda_handler({}, None)['body'])
+
+        self.assertEqual(body['summary']['lineage'], {
+            'by_class': {'ami': {'count': 1, 'size': 30}, 'attached': {'count': 2, 'size': 28},
+                         'orphaned': {'count': 2, 'size': 70}},
+            'orphaned_by_region': {'us-east-1': {'count': 2, 'size': 70}}
+        })
+        message = json.loads(self.aws.calls('publish')[0][1]['Message'])
+        self.assertIn('Orphaned: 2 snapshots, 70.00 GB', message['email'])
+        self.assertIn('us-east-1: 2 orphaned snapshots, 70.00 GB', message['email'])
+
+    def test_failed_sweep_leaves_snapshots_unclassified(self):
+        self.aws.errors[('rds', 'us-east-1')] = {'describe_db_instances': RuntimeError('AccessDenied')}
+
+        snapshots = self.inventory.get_rds_snapshots_for_region('us-east-1')
+
+        self.assertEqual([(s.Id, s.Lineage) for s in snapshots], [('db-1', ''), ('db-2', '')])
+        self.assertTrue(self.inventory.stats.has_errors('us-east-1', 'LINEAGE'))
+
+
+class TestStreamingUpload(InventoryTestCase):
+    part_size = lambda_function.MIN_UPLOAD_PART_SIZE
+
+    def setUp(self):
+        super().setUp()
+        self.inventory.upload_part_size = self.part_size
+
+    def rows(self, count):
+        return (lambda_function.SnapshotRecord(f'snap-{i:08d}', 'EBS', 'us-east-1', NOW,
+                                               i % 100, 1, '7 days')
+                for i in range(count))
+
+    def test_large_report_is_uploaded_in_parts(self):
+        uploaded = self.inventory.write_csv_report(
+            'report.csv', lambda_function.SNAPSHOT_CSV_FIELDS, self.rows(120000))
+
+        parts = self.aws.calls('upload_part')
+        self.assertGreater(len(parts), 1)
+        self.assertTrue(all(len(kwargs['Body']) == self.part_size for _, kwargs in parts[:-1]))
+        body = self.aws.objects['report.csv']
+        self.assertEqual(uploaded, len(body))
+        rows = list(csv.DictReader(io.StringIO(body.decode())))
+        self.assertEqual(len(rows), 120000)
+        self.assertEqual(rows[-1]['Id'], 'snap-00119999')
+
+    def test_large_write_is_split_into_parts(self):
+        data = bytes(range(256)) * (self.part_size * 3 // 256 + 100)
+        with self.inventory.open_report_writer('blob.bin') as writer:
+            writer.write(data)
+            # Only the remainder of the last full part stays buffered
+            self.assertEqual(len(self.aws.calls('upload_part')), 3)
+            self.assertLess(len(writer._buffer), self.part_size)
+
+        parts = self.aws.calls('upload_part')
+        self.assertEqual([len(kwargs['Body']) for _, kwargs in parts],
+                         [self.part_size] * 3 + [len(data) - 3 * self.part_size])
+        self.assertEqual(self.aws.objects['blob.bin'], data)
+
+    def test_small_report_uses_single_put(self):
+        self.inventory.write_csv_report('small.csv', lambda_function.SNAPSHOT_CSV_FIELDS, self.rows(3))
+
+        self.assertEqual(self.aws.calls('create_multipart_upload'), [])
+        self.assertEqual(self.aws.objects['small.csv'].decode().count('\n'), 4)
+
+    def test_gzip_report(self):
+        self.inventory.csv_gzip = True
+        self.inventory.write_csv_report('report.csv.gz', lambda_function.SNAPSHOT_CSV_FIELDS, self.rows(10))
+
+        text = gzip.decompress(self.aws.objects['report.csv.gz']).decode()
+        self.assertTrue(text.startswith('Id,Type,Region'))
+
+    def test_failed_upload_is_aborted(self):
+        def failing_rows():
+            yield from self.rows(120000)
+            raise RuntimeError('collector failed')
+
+        with self.assertRaises(RuntimeError):
+            self.inventory.write_csv_report('broken.csv', lambda_function.SNAPSHOT_CSV_FIELDS,
+                                            failing_rows())
+
+        self.assertEqual(len(self.aws.calls('abort_multipart_upload')), 1)
+        self.assertNotIn('broken.csv', self.aws.objects)
+
+
+@unittest.skipIf(lambda_function._import_pyarrow() is None, 'pyarrow is not installed')
+class TestParquetOutput(InventoryTestCase):
+    pages = TestParallelScan.pages
+
+    def test_handler_writes_partitioned_parquet(self):
+        with patch.dict(os.environ, {'OUTPUT_FORMAT': 'parquet'}):
+            response = lambda_function.lambda_handler({}, None)
+
+        body = json.loads(response['body'])
+        self.assertIsNone(body['csv_file'])
+        snapshots_key, volumes_key = body['reports']
+        self.assertRegex(snapshots_key,
+                         r'^snapshot_inventory/account=123456789012/date=\d{4}-\d{2}-\d{2}/'
+                         r'snapshot_inventory_123456789012_\d{8}_\d{6}\.parquet$')
+        self.assertTrue(volumes_key.startswith('unattached_volumes/account=123456789012/'))
+
+        import pyarrow.parquet as pq
+        table = pq.read_table(io.BytesIO(self.aws.objects[snapshots_key]))
+        self.assertEqual(table.num_rows, 5)
+        self.assertEqual(str(table.schema.field('StartTime').type), 'timestamp[us, tz=UTC]')
+        self.assertEqual(str(table.schema.field('Age').type), 'int32')
+        self.assertTrue(str(table.schema.field('Region').type).startswith('dictionary'))
+        self.assertEqual(table.column('Id').to_pylist()[0], 'snap-c')
+
+    def test_both_formats(self):
+        with patch.dict(os.environ, {'OUTPUT_FORMAT': 'both'}):
+            response = lambda_function.lambda_handler({}, None)
+
+        reports = json.loads(response['body'])['reports']
+        self.assertEqual([key.rsplit('.', 1)[1] for key in reports], ['csv', 'csv', 'parquet', 'parquet'])
+
+
+class TestRecords(unittest.TestCase):
+    def test_timestamps_are_formatted_at_serialization(self):
+        record = lambda_function.SnapshotRecord('snap-1', 'EBS', 'us-east-1', NOW, 8, 0, '7 days')
+
+        self.assertIs(record.StartTime, NOW)
+        self.assertEqual(record.to_row()[3], NOW.isoformat())
+        self.assertEqual(lambda_function.SNAPSHOT_CSV_FIELDS,
+                         ['Id', 'Type', 'Region', 'StartTime', 'Size', 'Age', 'AgeGroup', 'AccountId',
+                          'BilledSize', 'SourceId', 'Lineage'])
+
+    def test_records_have_no_instance_dict(self):
+        record = lambda_function.VolumeRecord('vol-1', 'us-east-1', 10, 'available', 0, 'gp3', NOW)
+
+        self.assertFalse(hasattr(record, '__dict__'))
+        self.assertEqual(record.to_row()[6], NOW.isoformat())
+
+
+class TestSummaryAggregator(unittest.TestCase):
+    def snapshot(self, region, stype, size, age_group):
+        return lambda_function.SnapshotRecord('id', stype, region, NOW, size, 0, age_group)
+
+    def volume(self, volume_id, region, idle_days, size=10):
+        return lambda_function.VolumeRecord(volume_id, region, size, 'available', idle_days, 'gp3', NOW)
+
+    def test_group_bys_in_one_pass(self):
+        aggregator = lambda_function.SummaryAggregator()
+        aggregator.add_snapshots([
+            self.snapshot('us-east-1', 'RDS', 20, '90 days'),
+            self.snapshot('eu-west-1', 'EBS', 8, '> 730 days'),
+            self.snapshot('us-east-1', 'EBS', 8, '7 days'),
+            self.snapshot('us-east-1', 'EBS', 2, '90 days')
+        ])
+        summary = aggregator.result('123456789012', NOW)
+
+        self.assertEqual((summary.total_count, summary.total_size), (4, 38))
+        self.assertEqual(list(summary.by_region), ['eu-west-1', 'us-east-1'])
+        self.assertEqual(summary.by_region['us-east-1']['by_type'],
+                         {'EBS': {'count': 2, 'size': 10}, 'RDS': {'count': 1, 'size': 20}})
+        self.assertEqual(list(summary.by_type), ['EBS', 'RDS'])
+        self.assertEqual(summary.by_age_group, {
+            '7 days': {'count': 1, 'size': 8},
+            '90 days': {'count': 2, 'size': 22},
+            '> 730 days': {'count': 1, 'size': 8}})
+
+    def test_top_idle_volumes_per_region(self):
+        aggregator = lambda_function.SummaryAggregator(top_n=2)
+        aggregator.add_volumes([self.volume('vol-a', 'us-east-1', 5),
+                                self.volume('vol-b', 'us-east-1', 50),
+                                self.volume('vol-c', 'us-east-1', 5),
+                                self.volume('vol-d', 'us-east-1', 1),
+                                self.volume('vol-e', 'eu-west-1', 0, size=3)])
+        summary = aggregator.result('123456789012', NOW)
+
+        self.assertEqual((summary.volume_count, summary.volume_size), (5, 43))
+        self.assertEqual([v.VolumeId for v in summary.volumes_by_region['us-east-1']['volumes']],
+                         ['vol-b', 'vol-a'])
+        self.assertEqual(summary.volumes_by_region['eu-west-1']['count'], 1)
+        self.assertEqual(json.loads(json.dumps(summary.to_dict()))['volumes_by_region']
+                         ['eu-west-1']['volumes'][0]['VolumeId'], 'vol-e')
+
+
+class TestSummaryRenderer(unittest.TestCase):
+    api_stats = {'pages': 3, 'items': 9, 'throttles': 1, 'retries': 2, 'by_collector': {
+        'EBS': {'pages': 3, 'items': 9, 'throttles': 1, 'retries': 2}}}
+
+    def summary(self, regions=1, volumes_per_region=1):
+        aggregator = lambda_function.SummaryAggregator()
+        aggregator.add_snapshots([lambda_function.SnapshotRecord(
+            'snap-1', 'EBS', 'us-east-1', NOW, 8, 3, '7 days', '123456789012')])
+        aggregator.add_volumes([
+            lambda_function.VolumeRecord(f'vol-{r}-{v}', f'region-{r:05d}', 10, 'available', v,
+                                         'gp3', NOW, '123456789012')
+            for r in range(regions) for v in range(volumes_per_region)])
+        return aggregator.result('123456789012', datetime(2024, 2, 10, 17, 1, 22), self.api_stats)
+
+    def test_text_layout(self):
+        text = lambda_function.SummaryRenderer().render(self.summary())
+
+        self.assertEqual(text.splitlines()[:12], [
+            'Snapshot Inventory Summary for Account 123456789012',
+            'Generated on: 2024-02-10 17:01:22',
+            '',
+            'Total Snapshots: 1',
+            '',
+            'Regional Breakdown:',
+            '-' * 40,
+            '',
+            'Region: us-east-1',
+            'Total: 1 snapshots, 8.00 GB',
+            'By Type:',
+            '  - EBS: 1 snapshots, 8.00 GB'])
+        self.assertIn('Total Unattached Volumes: 1\n\nRegion: region-00000\n', text)
+        self.assertTrue(text.endswith('EBS: 3 pages, 9 items fetched, 1 throttles, 2 retries'))
+
+    def test_budget_truncates_lowest_priority_entries(self):
+        summary = self.summary(regions=3000, volumes_per_region=5)
+        text = lambda_function.SummaryRenderer(budget=20000).render(summary)
+
+        self.assertLessEqual(len(text.encode('utf-8')), 20000)
+        self.assertIn('Region: us-east-1', text)
+        self.assertIn('API Usage:', text)
+        kept = text.count('Top Idle Volumes')
+        self.assertGreater(kept, 0)
+        self.assertIn(f'\u2026and {3000 - kept} more regions with unattached volumes', text)
+
+    def test_sns_message_stays_within_limit(self):
+        summary = self.summary(regions=3000, volumes_per_region=5)
+        links = '\n\nDetailed reports available in S3:\nSnapshots: s3://bucket/report.csv'
+        text = lambda_function.SummaryRenderer(
+            lambda_function.get_sns_summary_budget(links), lambda_function.json_escaped_length).render(summary)
+        message = json.dumps({'default': text, 'email': text + links})
+
+        self.assertLessEqual(len(message.encode('utf-8')), lambda_function.SNS_MAX_MESSAGE_BYTES)
+        self.assertGreater(len(message), lambda_function.SNS_MAX_MESSAGE_BYTES * 0.9)
+
+    def test_fitted_text_stays_within_budget(self):
+        rng = random.Random(7)
+        words = ['snap', 'r\u00e9gion', '\u2026', 'GB', '12', 'us-east-1', '\u00fc\u00fc']
+
+        def line():
+            return ' '.join(rng.choice(words) for _ in range(rng.randint(0, 6)))
+
+        def size(renderer, header, fitted):
+            return len(renderer.render_text(header, fitted).encode('utf-8'))
+
+        for _ in range(40):
+            header = [line() for _ in range(rng.randint(1, 4))]
+            sections = [lambda_function.ReportSection(
+                line(), [line() for _ in range(rng.randint(0, 3))],
+                [[line() for _ in range(rng.choice([1, 1, 2, 5]))] for _ in range(rng.randint(0, 8))],
+                'entries', rng.randint(0, 3)) for _ in range(rng.randint(1, 4))]
+            renderer = lambda_function.SummaryRenderer()
+            # Entries can be dropped down to the lines every section shows
+            smallest = size(renderer, header, [(section, 0) for section in sections])
+            largest = size(renderer, header, [(section, len(section.entries)) for section in sections])
+
+            for budget in range(smallest, largest + 1):
+                renderer.budget = budget
+                self.assertLessEqual(size(renderer, header, renderer.fit(header, sections)), budget)
+
+    def test_html_and_json_share_the_layout(self):
+        summary = self.summary(regions=40, volumes_per_region=2)
+        renderer = lambda_function.SummaryRenderer(budget=3000)
+        document = json.loads(renderer.render(summary, 'json'))
+        page = renderer.render(summary, 'html')
+
+        volumes = document['sections'][3]
+        self.assertEqual(volumes['title'], 'Unattached EBS Volumes Summary')
+        self.assertEqual(len(volumes['entries']) + volumes['omitted'], 40)
+        self.assertGreater(volumes['omitted'], 0)
+        self.assertEqual(page.count('<h3>Region: region-'), len(volumes['entries']))
+        self.assertIn("more regions with unattached volumes", page)
+        self.assertTrue(page.startswith('<h1>Snapshot Inventory Summary for Account 123456789012</h1>'))
+
+
+class TestAgeBucketer(unittest.TestCase):
+    def test_default_buckets_match_inclusive_upper_bounds(self):
+        bucketer = lambda_function.AgeBucketer()
+
+        self.assertEqual([bucketer.group(age) for age in (0, 7, 8, 30, 31, 730, 731)],
+                         ['7 days', '7 days', '15 days', '30 days', '90 days',
+                          '730 days', '> 730 days'])
+        self.assertEqual(lambda_function.AGE_GROUPS[-1], '> 730 days')
+
+    def test_custom_buckets_from_environment(self):
+        with patch.dict(os.environ, {'AGE_BUCKETS': '30,365,1095,1825'}):
+            bucketer = lambda_function.load_age_bucketer()
+
+        self.assertEqual(bucketer.labels, ('30 days', '365 days', '1095 days', '1825 days', '> 1825 days'))
+        self.assertEqual(bucketer.group(1000), '1095 days')
+
+    def test_invalid_buckets_fall_back_to_defaults(self):
+        with patch.dict(os.environ, {'AGE_BUCKETS': '7,a year'}):
+            bucketer = lambda_function.load_age_bucketer()
+
+        self.assertEqual(bucketer.labels, lambda_function.AGE_GROUPS)
+
+    def test_ages_use_one_reference_clock(self):
+        bucketer = lambda_function.AgeBucketer(now=NOW)
+
+        self.assertEqual(bucketer.age(NOW - timedelta(days=3, hours=23)), 3)
+        self.assertEqual(bucketer.age(NOW - timedelta(days=4)), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()